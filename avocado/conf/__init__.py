@@ -44,6 +44,13 @@ def test_setting_changed_handler(**kwargs):
     elif kwargs['setting'].startswith('AVOCADO_'):
         key = kwargs['setting'][8:]
         value = kwargs['value']
+
+        # Reverting an override of a setting that is not defined in the
+        # Django settings passes None, so the configured value is restored.
+        if value is None and not hasattr(django_settings, kwargs['setting']):
+            value = getattr(django_settings, 'AVOCADO', {}) \
+                .get(key, getattr(global_settings, key, None))
+
         setattr(settings._wrapped, key, value)
 
 
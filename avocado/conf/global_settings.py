@@ -65,6 +65,21 @@ INTERNAL_DATATYPE_FORMFIELDS = {
 # will only be applied to fields with a Avocado datatype of 'string'
 ENUMERABLE_MAXIMUM = 30
 
+# The number of values of an `in` condition from which the values are passed
+# to the database as a set rather than as a list of literals, which does not
+# scale to large lists and may exceed the variable limit of the backend. The
+# values are bound as a single array parameter on PostgreSQL and as a JSON
+# array on SQLite and MySQL 8, either of which is compiled into a subquery.
+# Set to `None` to always use a list of literals.
+IN_SUBQUERY_THRESHOLD = 500
+
+# The maximum number of rendered condition language strings that are kept
+# in-process. The language is keyed by the field (including its modification
+# time), the operator and the cleaned value, so repeated validation of the
+# same conditions does not render them again. Set to `None` (or 0) to
+# disable the cache.
+LANGUAGE_CACHE_MAX_ENTRIES = 1000
+
 # Flag for enabling the history API
 HISTORY_ENABLED = True
 
@@ -100,6 +115,62 @@ VALIDATION_WARNINGS = {}
 # for their most common data access methods.
 DATA_CACHE_ENABLED = True
 
+# Toggle tagging of cached data with the app, model and instance it is
+# derived from. Tags can be invalidated in bulk using `invalidate_tags` or
+# the `avocado cache --invalidate` command. The current tag generations are
+# fetched in the same round trip as the data.
+DATA_CACHE_TAGS_ENABLED = True
+
+# An optional in-process LRU cache that sits in front of `DATA_CACHE` for
+# cached DataField methods. Hits skip the cache backend entirely. The budget
+# can be limited by number of entries and/or the pickled size in bytes
+# (`None` for unlimited). Since entries are keyed by the same versioned keys
+# as the data cache, a `data_version` bump is seen immediately. The timeout
+# (in seconds) bounds how long a value flushed by another process may be
+# served from this process.
+DATA_CACHE_LOCAL_ENABLED = False
+DATA_CACHE_LOCAL_MAX_ENTRIES = 1000
+DATA_CACHE_LOCAL_MAX_BYTES = None
+DATA_CACHE_LOCAL_TIMEOUT = 60
+
+# Toggle single-flight computation of cached DataField methods. On a cache
+# miss only one process computes the data while others wait up to
+# `DATA_CACHE_LOCK_WAIT` seconds for it to become available before computing
+# it themselves. The lock expires after `DATA_CACHE_LOCK_TIMEOUT` seconds in
+# case the computing process dies. This can be enabled per method using
+# the `single_flight` argument of `cached_method`.
+DATA_CACHE_SINGLE_FLIGHT = False
+DATA_CACHE_LOCK_TIMEOUT = 300
+DATA_CACHE_LOCK_WAIT = 30
+
+# If enabled, the most recently computed data (for any version) is returned
+# while another process recomputes it rather than waiting. With background
+# refresh enabled, the process acquiring the lock also returns the stale
+# data and recomputes it in a background thread.
+DATA_CACHE_SERVE_STALE = False
+DATA_CACHE_BACKGROUND_REFRESH = False
+
+# Cached methods marked as `compact` (DataField values, labels and codes)
+# are stored using a compact encoding. Encoded payloads of at least
+# `DATA_CACHE_COMPRESS_THRESHOLD` bytes are compressed with zlib (`None`
+# disables compression). Payloads larger than `DATA_CACHE_MAX_ITEM_SIZE`
+# bytes are split across multiple keys to stay within the item size limit
+# of the cache backend, e.g. 1 MB for memcached (`None` disables chunking).
+DATA_CACHE_COMPRESS_THRESHOLD = 4096
+DATA_CACHE_MAX_ITEM_SIZE = 1000000
+
+# Toggle collection of statistics for cached methods, i.e. hits, misses,
+# compute time (in milliseconds), payload bytes and set failures per method.
+# Counters are kept in-process and merged into `DATA_CACHE` every
+# `DATA_CACHE_STATS_INTERVAL` seconds so `avocado cache --stats` can report
+# them across processes. `DATA_CACHE_STATS_HOOK` is an optional callable or
+# dotted path to one that is called with the method name, counter name and
+# amount of each event, e.g. to forward them to statsd. Set it to
+# `avocado.core.cache.stats.log_hook` to emit them using Python logging.
+DATA_CACHE_STATS_ENABLED = False
+DATA_CACHE_STATS_INTERVAL = 60
+DATA_CACHE_STATS_HOOK = None
+
 # These settings affect how queries can be shared between users.
 # A user is able to enter either a username or an email of another user
 # they wish to share the query with. To limit to only one type of sharing
@@ -121,5 +192,73 @@ PERMISSIONS_ENABLED = None
 DATA_CACHE = 'default'
 QUERY_CACHE = 'default'
 
+# The maximum number of open connections per database used for named
+# connections, i.e. queries that can be canceled. Connections are kept open
+# and leased to named connections rather than opening a new connection for
+# each query. A lease waits up to `QUERY_CONNECTION_POOL_TIMEOUT` seconds
+# (`None` to wait indefinitely) for a connection to be released once the
+# limit is reached. Pooling is disabled by default (`None` or 0), so a new
+# connection is opened for every named connection.
+QUERY_CONNECTION_POOL_SIZE = None
+QUERY_CONNECTION_POOL_TIMEOUT = None
+
+# Default budgets of result row queries. The time budget in seconds is
+# enforced by the database and the row and byte budgets as the rows are read.
+# A query exceeding one raises `avocado.query.utils.QueryBudgetExceeded` and
+# its connection is discarded. `None` means no budget. These can be
+# overridden per query with the `timeout`, `max_rows` and `max_bytes` query
+# options.
+QUERY_TIMEOUT = None
+QUERY_MAX_ROWS = None
+QUERY_MAX_BYTES = None
+
+# Toggle caching of the rows produced by `get_result_rows` in `QUERY_CACHE`.
+# Rows are keyed on the context and view JSON, the tree, processor, export
+# options and page as well as the `data_version` of every DataField the
+# context and view reference, so changing the query or bumping the data
+# version results in a new key. Rows are only cached once fully read and
+# if there are at most `QUERY_RESULT_CACHE_MAX_ROWS` of them (`None` for no
+# limit). Entries expire after `QUERY_RESULT_CACHE_TIMEOUT` seconds.
+QUERY_RESULT_CACHE_ENABLED = False
+QUERY_RESULT_CACHE_TIMEOUT = 60 * 10
+QUERY_RESULT_CACHE_MAX_ROWS = 10000
+
+# Toggle caching of compiled context plans, i.e. the condition, annotations
+# and extra modifiers produced by parsing and translating a context. Plans
+# are kept in-process since they reference Q objects and querysets. They
+# are keyed on the context JSON, the tree and the `data_version` and
+# modification time of every DataField and DataConcept the context
+# references, so applying the same context again skips parsing and
+# translation. At most `QUERY_PLAN_CACHE_MAX_ENTRIES` plans are kept and
+# each expires after `QUERY_PLAN_CACHE_TIMEOUT` seconds.
+QUERY_PLAN_CACHE_ENABLED = False
+QUERY_PLAN_CACHE_MAX_ENTRIES = 1000
+QUERY_PLAN_CACHE_TIMEOUT = 60 * 10
+
+# Toggle streaming of the rows returned by `QueryProcessor.get_iterable`
+# from a server-side cursor, i.e. a named cursor on PostgreSQL and an
+# unbuffered cursor on MySQL, rather than buffering the whole result set in
+# memory before the first row is returned. Rows are fetched in batches of
+# `QUERY_STREAMING_BATCH_SIZE`. Note, on MySQL no other query can be issued
+# on the connection until the rows have been exhausted.
+QUERY_STREAMING_ENABLED = False
+QUERY_STREAMING_BATCH_SIZE = 1000
+
+# Toggle the optimizer pass applied to a parsed context before it is applied
+# to a queryset. Nested branches are flattened, duplicate conditions are
+# removed, bounds on the same field are merged and `exact` conditions on the
+# same field are collapsed into `in`. A context with contradicting
+# conditions results in an empty queryset without a query. Disabled by
+# default since it changes the SQL of existing contexts.
+QUERY_OPTIMIZER_ENABLED = False
+
+# Toggle compiling the conditions of a context on fields across multi-valued
+# (many-to-many and reverse foreign key) relationships into semi-joins. The
+# conditions on the same relationship are grouped into a single `pk__in`
+# subquery on the root model rather than being joined, so the rows of the
+# root model are not multiplied by the related rows. Disabled by default
+# since it changes the SQL of existing contexts.
+QUERY_SEMIJOIN_ENABLED = False
+
 # Name of the queue to use for scheduling and working on async jobs.
 ASYNC_QUEUE = 'avocado'
@@ -1,5 +1,9 @@
 from .model import cache_key, instance_cache_key, cached_method  # noqa
+from .model import prefetch_cached, pk_cache_key  # noqa
 from .receivers import post_save_cache, pre_delete_uncache  # noqa
 from .managers import CacheManager  # noqa
 from .query import CacheQuerySet  # noqa
-from .proxy import CacheProxy  # noqa
+from .proxy import CacheProxy, LocalCache, get_local_cache  # noqa
+from .proxy import get_or_set_many  # noqa
+from .tags import app_tag, model_tag, instance_tag, invalidate_tags  # noqa
+from .stats import get_stats, reset_stats  # noqa
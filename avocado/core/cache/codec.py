@@ -0,0 +1,204 @@
+"""Compact serialization of cached value, label and code tuples.
+
+Tuples of integers and floats are stored as packed arrays (integers using
+the narrowest width that fits), tuples of text as a length-prefixed UTF-8
+blob and anything else is pickled using the highest protocol. Large payloads
+are compressed with zlib and payloads exceeding the item size limit of the
+cache backend are split across multiple keys.
+"""
+import zlib
+import uuid
+import struct
+import cPickle as pickle
+from collections import namedtuple
+from avocado.conf import settings
+
+INT = 'i'
+FLOAT = 'f'
+TEXT = 't'
+PICKLE = 'p'
+
+COMPRESSED = 'z'
+UNCOMPRESSED = '-'
+
+# Length denoting a None value in a text blob
+NULL_LENGTH = 0xFFFFFFFF
+
+# Struct formats and ranges of the integer widths, narrowest first
+INT_FORMATS = (
+    ('b', -2 ** 7, 2 ** 7 - 1),
+    ('h', -2 ** 15, 2 ** 15 - 1),
+    ('i', -2 ** 31, 2 ** 31 - 1),
+    ('q', -2 ** 63, 2 ** 63 - 1),
+)
+
+# Cached entry containing an encoded payload
+Encoded = namedtuple('Encoded', ('blob',))
+
+# Cached entry referencing a payload split across multiple keys. The token
+# is unique per write so chunks of different writes are never mixed.
+Chunked = namedtuple('Chunked', ('token', 'count'))
+
+
+def _kind(data):
+    types = set(type(x) for x in data)
+
+    if not types - set([int, long]):
+        return INT
+
+    if types == set([float]):
+        return FLOAT
+
+    if not types - set([unicode, type(None)]):
+        return TEXT
+
+    return PICKLE
+
+
+def _encode_int(data):
+    """Packs the integers using the narrowest width that fits all of them.
+    The format character is prepended to the packed data.
+    """
+    low = min(data) if data else 0
+    high = max(data) if data else 0
+
+    for fmt, minimum, maximum in INT_FORMATS:
+        if minimum <= low and high <= maximum:
+            return fmt + struct.pack('<{0}{1}'.format(len(data), fmt), *data)
+
+    raise struct.error('integer out of range')
+
+
+def _decode_int(blob):
+    fmt, blob = blob[0], blob[1:]
+    size = struct.calcsize('<' + fmt)
+    return struct.unpack('<{0}{1}'.format(len(blob) // size, fmt), blob)
+
+
+def _encode_text(data):
+    lengths = []
+    values = []
+
+    for x in data:
+        if x is None:
+            lengths.append(NULL_LENGTH)
+        else:
+            x = x.encode('utf8')
+            lengths.append(len(x))
+            values.append(x)
+
+    header = struct.pack('<I{0}I'.format(len(lengths)), len(lengths),
+                         *lengths)
+
+    return header + ''.join(values)
+
+
+def _decode_text(blob):
+    count, = struct.unpack_from('<I', blob)
+    lengths = struct.unpack_from('<{0}I'.format(count), blob, 4)
+
+    offset = 4 + 4 * count
+    values = []
+
+    for length in lengths:
+        if length == NULL_LENGTH:
+            values.append(None)
+        else:
+            values.append(blob[offset:offset + length].decode('utf8'))
+            offset += length
+
+    return tuple(values)
+
+
+def encode(data, compress_threshold=None):
+    "Encodes the data into a compact string."
+    kind = PICKLE
+    blob = None
+
+    if isinstance(data, tuple):
+        kind = _kind(data)
+
+        try:
+            if kind == INT:
+                blob = _encode_int(data)
+            elif kind == FLOAT:
+                blob = struct.pack('<{0}d'.format(len(data)), *data)
+            elif kind == TEXT:
+                blob = _encode_text(data)
+        # Integers outside of the 64-bit range
+        except struct.error:
+            kind = PICKLE
+
+    if kind == PICKLE:
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    flag = UNCOMPRESSED
+
+    if compress_threshold is not None and len(blob) >= compress_threshold:
+        blob = zlib.compress(blob)
+        flag = COMPRESSED
+
+    return kind + flag + blob
+
+
+def decode(blob):
+    "Decodes a string produced by `encode`."
+    kind, flag, blob = blob[0], blob[1], blob[2:]
+
+    if flag == COMPRESSED:
+        blob = zlib.decompress(blob)
+
+    if kind == INT:
+        return _decode_int(blob)
+
+    if kind == FLOAT:
+        return struct.unpack('<{0}d'.format(len(blob) // 8), blob)
+
+    if kind == TEXT:
+        return _decode_text(blob)
+
+    return pickle.loads(blob)
+
+
+def chunk_keys(key, chunked):
+    return [u'{0}:{1}:{2}'.format(key, chunked.token, i)
+            for i in xrange(chunked.count)]
+
+
+def pack(key, data):
+    """Returns the entry to cache under `key` and a dict of any additional
+    chunks that must be cached with it.
+    """
+    blob = encode(data, settings.DATA_CACHE_COMPRESS_THRESHOLD)
+    size = settings.DATA_CACHE_MAX_ITEM_SIZE
+
+    if not size or len(blob) <= size:
+        return Encoded(blob), {}
+
+    chunked = Chunked(uuid.uuid4().hex, (len(blob) + size - 1) // size)
+    keys = chunk_keys(key, chunked)
+
+    chunks = dict((k, blob[i * size:(i + 1) * size])
+                  for i, k in enumerate(keys))
+
+    return chunked, chunks
+
+
+def load(key, entry, cache):
+    """Returns the data of a cached entry fetching the chunks from the cache
+    if necessary. None is returned if any of the chunks are missing. Entries
+    that were not packed are returned as is.
+    """
+    if isinstance(entry, Encoded):
+        return decode(entry.blob)
+
+    if isinstance(entry, Chunked):
+        keys = chunk_keys(key, entry)
+        found = cache.get_many(keys)
+
+        if len(found) < len(keys):
+            return
+
+        return decode(''.join(found[k] for k in keys))
+
+    return entry
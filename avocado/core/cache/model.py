@@ -1,17 +1,44 @@
 import inspect
 import hashlib
 import logging
+import weakref
 import cPickle as pickle
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models.query import QuerySet
 from functools import wraps
 from avocado.conf import settings
-from .proxy import CacheProxy
+from .proxy import CacheProxy, get_or_set_many
 
 NEVER_EXPIRE = 60 * 60 * 24 * 30  # 30 days
 
+# Maximum number of memoized instance key prefixes before the memo is reset.
+MAX_PREFIXES = 10000
+
 
 logger = logging.getLogger(__name__)
 
+# Compiled SQL of QuerySets used as arguments, keyed by the QuerySet object.
+# QuerySets are cloned rather than changed when filtered, so the SQL is
+# computed once per object.
+_queryset_sql = weakref.WeakKeyDictionary()
+
+# Hashed instance key prefixes keyed by the app label, model name, primary
+# key and label.
+_prefixes = {}
+
+
+def _queryset_fingerprint(queryset):
+    "Returns the compiled SQL of the QuerySet."
+    try:
+        return _queryset_sql[queryset]
+    except KeyError:
+        pass
+
+    s, p = queryset.query.get_compiler(queryset.db).as_sql()
+    sql = _queryset_sql[queryset] = s % p
+
+    return sql
+
 
 def _pickling_value(v):
     "Returns an appropriate value to be pickled."
@@ -21,9 +48,7 @@ def _pickling_value(v):
         # hashing the query's internal dict. In addition, the variability
         # in SQL queries vs. the internal structure of query across Django
         # versions is at most the same if not less variable.
-        s, p = v.query.get_compiler(v.db).as_sql()
-
-        return s % p
+        return _queryset_fingerprint(v)
 
     if inspect.isclass(v) and not hasattr(v, '__getstate__'):
         # As with the QuerySet instance above, this could result in loading
@@ -78,14 +103,38 @@ def cache_key(label, version=None, args=None, kwargs=None):
 
     key = [label, version]
 
-    args, kwargs = _prep_pickling(args, kwargs)
-
+    # Pickling is skipped entirely if there are no arguments
     if args or kwargs:
-        key.append(pickle.dumps((args, kwargs)))
+        args, kwargs = _prep_pickling(args, kwargs)
+
+        if args or kwargs:
+            key.append(pickle.dumps((args, kwargs)))
 
     return cache_key_func(key)
 
 
+def _instance_prefix(opts, pk, label):
+    "Returns the memoized hashed prefix for an instance and label."
+    memo_key = (opts.app_label, opts.module_name, pk, label)
+
+    try:
+        return _prefixes[memo_key]
+    except KeyError:
+        pass
+
+    key = [opts.app_label, opts.module_name, pk]
+
+    if label is not None:
+        key.append(label)
+
+    if len(_prefixes) >= MAX_PREFIXES:
+        _prefixes.clear()
+
+    prefix = _prefixes[memo_key] = cache_key_func(key)
+
+    return prefix
+
+
 def instance_cache_key(instance, label=None, version=None, args=None,
                        kwargs=None):
     """Extends the base `cache_key` function to include model instance metadata
@@ -107,25 +156,44 @@ def instance_cache_key(instance, label=None, version=None, args=None,
     elif callable(version):
         version = version(instance)
 
-    opts = instance._meta
-    key = [opts.app_label, opts.module_name, instance.pk]
+    label = _instance_prefix(instance._meta, instance.pk, label)
 
-    if label is not None:
-        key.append(label)
+    return cache_key(label=label, version=version, args=args, kwargs=kwargs)
 
-    label = cache_key_func(key)
 
-    return cache_key(label=label, version=version, args=args, kwargs=kwargs)
+def pk_cache_key(model, pk, using=None):
+    """Returns the key a model instance is cached under given its primary key
+    and the alias of the database it is stored in. For the default database
+    this is the same key as `instance_cache_key(instance)`.
+    """
+    label = _instance_prefix(model._meta, pk, None)
+
+    if using is None or using == DEFAULT_DB_ALIAS:
+        return cache_key(label=label)
+
+    return cache_key(label=label, args=[using])
 
 
 def cached_method(func=None, version=None, timeout=NEVER_EXPIRE,
-                  key_func=instance_cache_key):
-    "Wraps a model instance method and caches the output indefinitely."
+                  key_func=instance_cache_key, single_flight=None,
+                  compact=False):
+    """Wraps a model instance method and caches the output indefinitely.
+
+    If `single_flight` is true, only one process will compute the output on
+    a cache miss while the others wait. It defaults to the
+    `DATA_CACHE_SINGLE_FLIGHT` setting.
+
+    If `compact` is true, the output is stored using the compact encoding in
+    `avocado.core.cache.codec`. This is intended for methods returning large
+    tuples of values or labels.
+    """
 
     def decorator(func):
         # Single cache proxy shared across all instances. All methods require
         # the instance to be passed.
-        cache_proxy = CacheProxy(func, version, timeout, key_func)
+        cache_proxy = CacheProxy(func, version, timeout, key_func,
+                                 single_flight=single_flight,
+                                 compact=compact)
 
         @wraps(func)
         def inner(self, *args, **kwargs):
@@ -149,9 +217,39 @@ def cached_method(func=None, version=None, timeout=NEVER_EXPIRE,
         inner.flush = flush
         inner.cached = cached
         inner.cache_key = cache_key
+        inner.cache_proxy = cache_proxy
 
         return inner
 
     if inspect.isfunction(func):
         return decorator(func)
     return decorator
+
+
+def prefetch_cached(instances, methods, args=None, kwargs=None):
+    """Pre-warms the cache of the `cached_method`s named in `methods` for
+    each instance using a single round trip to the cache for the lookup and
+    one for storing the computed misses.
+
+    A dict keyed by (instance pk, method name) of the data is returned. It
+    is empty if the data cache is disabled since there is nothing to warm.
+    """
+    items = []
+    names = []
+
+    for instance in instances:
+        for name in methods:
+            method = getattr(type(instance), name)
+
+            if not hasattr(method, 'cache_proxy'):
+                raise ValueError('"{0}" is not a cached method'.format(name))
+
+            items.append((method.cache_proxy, instance))
+            names.append((instance.pk, name))
+
+    if not items or not settings.DATA_CACHE_ENABLED:
+        return {}
+
+    data = get_or_set_many(items, args=args, kwargs=kwargs)
+
+    return dict(zip(names, data))
@@ -1,53 +1,465 @@
+import time
 import logging
+import threading
+import cPickle as pickle
+from collections import defaultdict
 from django.core.cache import get_cache
+from django.db import connections
 from avocado.conf import settings
+from . import codec
+from .stats import record, HITS, MISSES, COMPUTE_TIME, BYTES, SET_FAILURES
+from .tags import TaggedData, instance_cache_tags, get_generations, \
+    tag_key, unwrap
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+# Returned by lookups in place of the data if it is not cached, since None is
+# a valid value of a cached method.
+NOT_CACHED = object()
+
+
+class CachedNone(object):
+    """Stored in place of a None value since the data cache does not tell
+    a None value apart from a missing key.
+    """
+
+
+def _load(key, entry, cache):
+    "Returns the data of a cached entry or NOT_CACHED if there is none."
+    if entry is None:
+        return NOT_CACHED
+
+    if isinstance(entry, CachedNone):
+        return None
+
+    data = codec.load(key, entry, cache)
+
+    # Chunks of the entry are missing
+    if data is None:
+        return NOT_CACHED
+
+    return data
+
+
+class LocalCache(object):
+    """In-process LRU cache with an optional entry and byte budget.
+
+    Entries are evicted in least-recently-used order once either budget is
+    exceeded. The byte budget is measured using the pickled size of the
+    value which is only computed if `max_bytes` is set.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, timeout=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, NOT_CACHED) is not NOT_CACHED
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[1]
+
+        return entry
+
+    def _over_budget(self):
+        if self.max_entries and len(self._data) > self.max_entries:
+            return True
+
+        return bool(self.max_bytes) and self._bytes > self.max_bytes
+
+    def _evict(self):
+        "Evicts the least recently used entries until within budget."
+        while self._data and self._over_budget():
+            key, entry = self._data.popitem(last=False)
+            self._bytes -= entry[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._pop(key)
+
+            if entry is None:
+                return default
+
+            expires, size, value = entry
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Re-insert to mark as most recently used
+            self._data[key] = entry
+            self._bytes += size
+
+            return value
+
+    def set(self, key, value, timeout=None):
+        "Sets the value in the cache. Returns false if it could not be set."
+        if timeout is None:
+            timeout = self.timeout
+        elif self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+
+        size = 0
+
+        if self.max_bytes:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+        with self._lock:
+            self._pop(key)
+
+            # Values larger than the whole budget are never stored
+            if self.max_bytes and size > self.max_bytes:
+                return False
+
+            expires = None
+
+            if timeout:
+                expires = time.time() + timeout
+
+            self._data[key] = (expires, size, value)
+            self._bytes += size
+            self._evict()
+
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+_local_caches = {}
+_local_caches_lock = threading.Lock()
+
+
+def get_local_cache():
+    """Returns the in-process cache that sits in front of `DATA_CACHE` or
+    None if it is not enabled. A separate instance is kept per configuration
+    so changes to the settings take effect immediately.
+    """
+    if not settings.DATA_CACHE_LOCAL_ENABLED:
+        return
+
+    options = (settings.DATA_CACHE_LOCAL_MAX_ENTRIES,
+               settings.DATA_CACHE_LOCAL_MAX_BYTES,
+               settings.DATA_CACHE_LOCAL_TIMEOUT)
+
+    with _local_caches_lock:
+        if options not in _local_caches:
+            _local_caches[options] = LocalCache(*options)
+
+        return _local_caches[options]
+
+
+def _payload_size(entry, chunks):
+    "Returns the size in bytes of a cache entry and its chunks."
+    if isinstance(entry, TaggedData):
+        entry = entry.data
+
+    if isinstance(entry, codec.Encoded):
+        return len(entry.blob)
+
+    if chunks:
+        return sum(len(chunk) for chunk in chunks.values())
+
+    return len(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+
+
+def _record_set(name, entry, chunks):
+    if settings.DATA_CACHE_STATS_ENABLED:
+        record(name, BYTES, _payload_size(entry, chunks))
+
 
 class CacheProxy(object):
-    def __init__(self, func, version, timeout, key_func):
+    # Seconds between checks while waiting on another process to compute
+    # the data in single-flight mode.
+    lock_poll_interval = 0.1
+
+    def __init__(self, func, version, timeout, key_func, single_flight=None,
+                 compact=False):
         self.func = func
         self.label = func.__name__
         self.version = version
         self.timeout = timeout
         self.key_func = key_func
+        self.single_flight = single_flight
+        self.compact = compact
 
     def cache_key(self, instance, args=None, kwargs=None):
         return self.key_func(instance, label=self.label, version=self.version,
                              args=args, kwargs=kwargs)
 
-    def _set(self, key, data):
-        logger.debug('Compute property cache "{0}"'.format(key))
+    def stale_cache_key(self, instance, args=None, kwargs=None):
+        """Returns the unversioned key the most recently computed data is
+        stored under for serving stale data.
+        """
+        return self.key_func(instance, label=u'{0}:stale'.format(self.label),
+                             args=args, kwargs=kwargs)
+
+    def stats_name(self, instance):
+        "Returns the name statistics are recorded under, e.g. datafield.size"
+        return u'{0}.{1}'.format(instance._meta.module_name, self.label)
+
+    def lock_key(self, key):
+        return u'{0}:lock'.format(key)
+
+    def _use_single_flight(self):
+        if self.single_flight is not None:
+            return self.single_flight
+
+        return settings.DATA_CACHE_SINGLE_FLIGHT
+
+    def cache_tags(self, instance):
+        "Returns the tags for the instance's data if tagging is enabled."
+        if settings.DATA_CACHE_TAGS_ENABLED:
+            return instance_cache_tags(instance)
+
+    def _pack(self, key, data, generations=None):
+        """Returns the entry to cache under `key` and a dict of any
+        additional chunks the entry refers to.
+        """
+        entry, chunks = data, {}
+
+        if data is None:
+            entry = CachedNone()
+        elif self.compact:
+            entry, chunks = codec.pack(key, data)
+
+        if generations:
+            entry = TaggedData(generations, entry)
+
+        return entry, chunks
+
+    def _store(self, key, data, generations=None, name=None):
+        """Stores the data in the data cache. Failures are logged rather
+        than raised since the data can always be computed again.
+        """
         cache = get_cache(settings.DATA_CACHE)
+        entry, chunks = self._pack(key, data, generations)
 
-        if data is not None:
-            cache.set(key, data, timeout=self.timeout)
-            logger.debug('Set property cache "{0}"'.format(key))
+        try:
+            # Chunks are set first so the entry never refers to missing
+            # chunks.
+            if chunks:
+                cache.set_many(chunks, timeout=self.timeout)
+
+            cache.set(key, entry, timeout=self.timeout)
+        except Exception:
+            logger.exception('Error setting property cache "{0}"'
+                             .format(key))
+
+            if name is not None:
+                record(name, SET_FAILURES)
+        else:
+            if name is not None:
+                _record_set(name, entry, chunks)
+
+    def _set(self, key, data, generations=None, name=None):
+        self._store(key, data, generations, name)
+        self._set_local(key, data)
+        logger.debug('Set property cache "{0}"'.format(key))
+
+    def _set_local(self, key, data):
+        local = get_local_cache()
+
+        if local is not None:
+            local.set(key, data, timeout=self.timeout)
+
+    def _get(self, key, tags=None):
+        """Gets the data from the local cache falling back to the data cache.
+        The key is versioned, so local entries for an outdated version are
+        never hit and simply age out. NOT_CACHED is returned if the data is
+        in neither cache.
+
+        If tags are passed, the current tag generations are fetched along
+        with the data and the data is ignored if any of them were
+        invalidated.
+        """
+        local = get_local_cache()
+
+        if local is not None:
+            data = local.get(key, NOT_CACHED)
+
+            if data is not NOT_CACHED:
+                logger.debug('Get local property cache "{0}"'.format(key))
+                return data
 
-    def get(self, instance, args=None, kwargs=None):
-        key = self.cache_key(instance, args, kwargs)
         cache = get_cache(settings.DATA_CACHE)
-        data = cache.get(key)
+
+        if tags:
+            found = cache.get_many([key] + [tag_key(t) for t in tags])
+            entry = unwrap(found.get(key), found)
+        else:
+            entry = unwrap(cache.get(key), {})
+
+        data = _load(key, entry, cache)
+
         logger.debug('Get property cache "{0}"'.format(key))
+
+        if data is not NOT_CACHED and local is not None:
+            local.set(key, data, timeout=self.timeout)
+
         return data
 
-    def get_or_set(self, instance, args=None, kwargs=None):
-        # Reference to prevent the key from being changed mid-execution
+    def _record_lookup(self, instance, data):
+        record(self.stats_name(instance),
+               MISSES if data is NOT_CACHED else HITS)
+
+    def get(self, instance, args=None, kwargs=None):
+        "Returns the cached data or None if it is not cached."
         key = self.cache_key(instance, args, kwargs)
+        data = self._get(key, self.cache_tags(instance))
+        self._record_lookup(instance, data)
+
+        if data is NOT_CACHED:
+            return
+
+        return data
 
+    def _compute(self, instance, key, stale_key=None, args=None,
+                 kwargs=None):
+        if args is None:
+            args = ()
+
+        if kwargs is None:
+            kwargs = {}
+
+        # Generations are read prior to computing the data, so an
+        # invalidation during the computation is not lost.
+        generations = None
+        tags = self.cache_tags(instance)
+
+        if tags:
+            generations = get_generations(tags)
+
+        logger.debug('Compute property cache "{0}"'.format(key))
+        name = self.stats_name(instance)
+
+        t0 = time.time()
+        data = self.func(instance, *args, **kwargs)
+        record(name, COMPUTE_TIME, int((time.time() - t0) * 1000))
+
+        self._set(key, data, generations, name)
+
+        if stale_key is not None:
+            self._store(stale_key, data)
+
+        return data
+
+    def _get_stale(self, stale_key):
         cache = get_cache(settings.DATA_CACHE)
-        data = cache.get(key)
+        return _load(stale_key, cache.get(stale_key), cache)
 
-        if data is None:
-            if args is None:
-                args = ()
+    def _refresh(self, instance, key, stale_key, lock_key, args, kwargs):
+        "Computes the data in a background thread and releases the lock."
+        cache = get_cache(settings.DATA_CACHE)
+
+        try:
+            self._compute(instance, key, stale_key, args, kwargs)
+        except Exception:
+            logger.exception('Error refreshing property cache "{0}"'
+                             .format(key))
+        finally:
+            cache.delete(lock_key)
+
+            # Connections are thread local, close the ones opened by
+            # this thread.
+            for conn in connections.all():
+                conn.close()
+
+    def _get_or_set_single_flight(self, instance, key, args, kwargs):
+        """Only the process that acquires the lock computes the data. Others
+        wait until the data is available or the wait time has elapsed. If
+        serving stale data is enabled, others return the most recently
+        computed data immediately instead of waiting.
+        """
+        cache = get_cache(settings.DATA_CACHE)
+        lock_key = self.lock_key(key)
+        stale_key = None
+
+        if settings.DATA_CACHE_SERVE_STALE:
+            stale_key = self.stale_cache_key(instance, args, kwargs)
+
+        # `add` is atomic, so only one process will acquire the lock.
+        if cache.add(lock_key, 1, timeout=settings.DATA_CACHE_LOCK_TIMEOUT):
+            if stale_key is not None and \
+                    settings.DATA_CACHE_BACKGROUND_REFRESH:
+                stale = self._get_stale(stale_key)
+
+                if stale is not NOT_CACHED:
+                    thread = threading.Thread(target=self._refresh, args=(
+                        instance, key, stale_key, lock_key, args, kwargs))
+                    thread.daemon = True
+                    thread.start()
+
+                    logger.debug('Refresh property cache "{0}" in the '
+                                 'background'.format(key))
+
+                    return stale
+
+            try:
+                return self._compute(instance, key, stale_key, args, kwargs)
+            finally:
+                cache.delete(lock_key)
+
+        if stale_key is not None:
+            stale = self._get_stale(stale_key)
+
+            if stale is not NOT_CACHED:
+                logger.debug('Get stale property cache "{0}"'.format(key))
+                return stale
+
+        deadline = time.time() + settings.DATA_CACHE_LOCK_WAIT
+
+        tags = self.cache_tags(instance)
+
+        while time.time() < deadline:
+            time.sleep(self.lock_poll_interval)
+
+            data = self._get(key, tags)
+
+            if data is not NOT_CACHED:
+                return data
+
+            # The lock was released without the data being set
+            if lock_key not in cache:
+                break
+
+        logger.debug('Timed out waiting on property cache "{0}"'.format(key))
+
+        return self._compute(instance, key, stale_key, args, kwargs)
+
+    def get_or_set(self, instance, args=None, kwargs=None):
+        # Reference to prevent the key from being changed mid-execution
+        key = self.cache_key(instance, args, kwargs)
 
-            if kwargs is None:
-                kwargs = {}
+        data = self._get(key, self.cache_tags(instance))
+        self._record_lookup(instance, data)
 
-            data = self.func(instance, *args, **kwargs)
-            self._set(key, data)
+        if data is NOT_CACHED:
+            if self._use_single_flight():
+                data = self._get_or_set_single_flight(instance, key, args,
+                                                      kwargs)
+            else:
+                data = self._compute(instance, key, args=args, kwargs=kwargs)
 
         return data
 
@@ -55,10 +467,141 @@ class CacheProxy(object):
         "Flushes cached data for this method."
         key = self.cache_key(instance, args, kwargs)
         cache = get_cache(settings.DATA_CACHE)
-        cache.delete(key)
+        keys = [key, self.stale_cache_key(instance, args, kwargs)]
+
+        # Chunks of compact entries are deleted along with the entries
+        if self.compact:
+            for _key, entry in cache.get_many(keys).items():
+                if isinstance(entry, TaggedData):
+                    entry = entry.data
+
+                if isinstance(entry, codec.Chunked):
+                    keys.extend(codec.chunk_keys(_key, entry))
+
+        cache.delete_many(keys)
+
+        local = get_local_cache()
+
+        if local is not None:
+            local.delete(key)
+
         logger.debug('Delete property cache "{0}"'.format(key))
 
     def cached(self, instance, args=None, kwargs=None):
         "Checks if the data is in the cache."
-        cache = get_cache(settings.DATA_CACHE)
-        return self.cache_key(instance, args, kwargs) in cache
+        key = self.cache_key(instance, args, kwargs)
+        return self._get(key, self.cache_tags(instance)) is not NOT_CACHED
+
+
+def get_or_set_many(items, args=None, kwargs=None):
+    """Takes a sequence of (proxy, instance) pairs and returns a list of the
+    corresponding data. All keys are fetched from the data cache with a single
+    `get_many`, only the misses are computed and are then written back using
+    `set_many` (one call per distinct timeout).
+    """
+    items = list(items)
+    keys = [proxy.cache_key(instance, args, kwargs)
+            for proxy, instance in items]
+    tags = [proxy.cache_tags(instance) or () for proxy, instance in items]
+    timeouts = dict((key, proxy.timeout)
+                    for key, (proxy, _) in zip(keys, items))
+
+    data = {}
+    local = get_local_cache()
+
+    if local is not None:
+        for key in keys:
+            value = local.get(key, NOT_CACHED)
+
+            if value is not NOT_CACHED:
+                data[key] = value
+
+    cache = get_cache(settings.DATA_CACHE)
+    missing = [key for key in keys if key not in data]
+
+    # Tag generations are fetched in the same round trip
+    all_tags = set()
+
+    for key, _tags in zip(keys, tags):
+        if key not in data:
+            all_tags.update(_tags)
+
+    if missing:
+        found = cache.get_many(missing + [tag_key(t) for t in all_tags])
+        logger.debug('Get {0} property caches'.format(len(missing)))
+
+        for key in missing:
+            value = _load(key, unwrap(found.get(key), found), cache)
+
+            if value is NOT_CACHED:
+                continue
+
+            data[key] = value
+
+            if local is not None:
+                local.set(key, value, timeout=timeouts[key])
+
+    if args is None:
+        args = ()
+
+    if kwargs is None:
+        kwargs = {}
+
+    # Tags of the entries to be computed
+    all_tags = set()
+
+    for key, _tags in zip(keys, tags):
+        if key not in data:
+            all_tags.update(_tags)
+
+    generations = {}
+
+    if all_tags:
+        generations = get_generations(all_tags, cache=cache)
+
+    # Computed data grouped by timeout along with the entries set per
+    # method name for recording statistics.
+    pending = defaultdict(dict)
+    names = defaultdict(list)
+
+    for key, _tags, (proxy, instance) in zip(keys, tags, items):
+        name = proxy.stats_name(instance)
+
+        if key in data:
+            record(name, HITS)
+            continue
+
+        record(name, MISSES)
+
+        logger.debug('Compute property cache "{0}"'.format(key))
+
+        t0 = time.time()
+        value = data[key] = proxy.func(instance, *args, **kwargs)
+        record(name, COMPUTE_TIME, int((time.time() - t0) * 1000))
+
+        entry, chunks = proxy._pack(key, value, dict(
+            (t, generations[t]) for t in _tags))
+
+        pending[proxy.timeout].update(chunks)
+        pending[proxy.timeout][key] = entry
+        names[proxy.timeout].append((name, entry, chunks))
+
+        if local is not None:
+            local.set(key, value, timeout=proxy.timeout)
+
+    for timeout, values in pending.items():
+        try:
+            cache.set_many(values, timeout=timeout)
+        except Exception:
+            logger.exception('Error setting {0} property caches'
+                             .format(len(values)))
+
+            for name, entry, chunks in names[timeout]:
+                record(name, SET_FAILURES)
+        else:
+            logger.debug('Set {0} property caches'.format(len(values)))
+
+            for name, entry, chunks in names[timeout]:
+                _record_set(name, entry, chunks)
+
+    return [data[key] for key in keys]
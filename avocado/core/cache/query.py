@@ -1,35 +1,175 @@
 from django.core.cache import get_cache
+from django.core.exceptions import ValidationError
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
 from avocado.conf import settings
-from .model import cache_key_func
+from .model import pk_cache_key
 
 PK_LOOKUPS = ('pk', 'pk__exact')
+PK_IN_LOOKUPS = ('pk__in',)
 
 
 class CacheQuerySet(QuerySet):
-    def filter(self, *args, **kwargs):
-        """For primary-key-based lookups, instances may be cached to prevent
-        excessive database hits. If this is a primary-key lookup, the cache
-        will be checked and populated in the `_result_cache` if available.
+    # Primary keys of a lookup that is evaluated against the instance cache.
+    # This is not carried over to clones since any further change to the
+    # query would not be reflected in the cached instances.
+    _cache_pks = None
+
+    def _get_cache_pks(self, args, kwargs):
+        """Returns the list of primary keys if the filter is a lone primary
+        key lookup on an unfiltered queryset, otherwise None.
         """
-        clone = super(CacheQuerySet, self).filter(*args, **kwargs)
+        if args or len(kwargs) != 1:
+            return
+
+        query = self.query
+
+        if query.where.children or query.extra or query.select_related or \
+                query.order_by or query.low_mark or \
+                query.high_mark is not None or query.deferred_loading[0]:
+            return
 
-        pk = None
         opts = self.model._meta
         pk_name = opts.pk.name
+        key, value = kwargs.items()[0]
 
         # Look for `pk` and the actual name of the primary key field
-        for key in list(PK_LOOKUPS) + [pk_name, u'{0}__exact'.format(pk_name)]:
-            if key in kwargs:
-                pk = kwargs[key]
-                break
+        if key in PK_LOOKUPS or key in (pk_name, u'{0}__exact'
+                                        .format(pk_name)):
+            values = [value]
+        elif key in PK_IN_LOOKUPS or key == u'{0}__in'.format(pk_name):
+            # Subqueries and other iterables are not supported
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                return
 
-        if pk is not None:
-            key = cache_key_func([opts.app_label, opts.module_name, pk])
-            cache = get_cache(settings.DATA_CACHE)
-            obj = cache.get(key)
+            values = value
+        else:
+            return
+
+        pks = []
+
+        try:
+            for value in values:
+                pk = opts.pk.to_python(value)
+
+                if pk not in pks:
+                    pks.append(pk)
+        except (ValidationError, TypeError):
+            return
+
+        # The instances must be sorted by the default ordering of the model
+        if len(pks) > 1 and self._get_cache_ordering() is None:
+            return
+
+        return pks
 
-            if obj is not None:
-                clone._result_cache = [obj]
+    def _get_cache_ordering(self):
+        """Returns a list of the attribute names and directions the instances
+        are sorted by, or None if the default ordering of the model refers to
+        anything other than fields of the model.
+        """
+        ordering = []
+
+        if not self.query.default_ordering:
+            return ordering
+
+        opts = self.model._meta
+
+        for name in opts.ordering:
+            desc = name.startswith('-')
+            name = name.lstrip('-')
+
+            if name == 'pk':
+                name = opts.pk.name
 
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return
+
+            # Relations are ordered by the ordering of the related model
+            if field.rel:
+                return
+
+            ordering.append((field.attname, desc))
+
+        return ordering
+
+    def filter(self, *args, **kwargs):
+        """For primary-key-based lookups, instances may be cached to prevent
+        excessive database hits. If this is a primary-key lookup (`pk` or
+        `pk__in`), the cache is checked when the queryset is evaluated and
+        only the instances missing from the cache are fetched from the
+        database. The fetched instances are written back to the cache.
+
+        Instances are sorted by the default ordering of the model or returned
+        in the order of the primary keys in the lookup if the model has none.
+        Lookups of multiple instances of a model ordered by related fields
+        are not cached.
+        """
+        clone = super(CacheQuerySet, self).filter(*args, **kwargs)
+        clone._cache_pks = self._get_cache_pks(args, kwargs)
         return clone
+
+    def update(self, **kwargs):
+        """Removes the updated instances from the cache. Unlike saving an
+        instance, an update does not send the `post_save` signal that
+        caches the instance, so the cached instances would be outdated.
+        """
+        pks = list(self.values_list('pk', flat=True))
+        rows = super(CacheQuerySet, self).update(**kwargs)
+
+        if pks:
+            cache = get_cache(settings.DATA_CACHE)
+            cache.delete_many([pk_cache_key(self.model, pk, using=self.db)
+                               for pk in pks])
+
+        return rows
+
+    def _get_cached_instances(self):
+        pks = self._cache_pks
+
+        keys = dict((pk_cache_key(self.model, pk, using=self.db), pk)
+                    for pk in pks)
+
+        cache = get_cache(settings.DATA_CACHE)
+        found = cache.get_many(keys.keys())
+
+        objs = {}
+
+        for key, obj in found.items():
+            objs[keys[key]] = obj
+
+        missing = [pk for pk in pks if pk not in objs]
+
+        if missing:
+            # The unfiltered queryset is used so the lookup is not applied
+            # twice.
+            queryset = QuerySet(self.model, using=self._db) \
+                .filter(pk__in=missing)
+
+            fetched = {}
+
+            for obj in queryset:
+                objs[obj.pk] = obj
+                fetched[pk_cache_key(self.model, obj.pk, using=self.db)] = obj
+
+            if fetched:
+                cache.set_many(fetched)
+
+        instances = [objs[pk] for pk in pks if pk in objs]
+
+        # Sorted by the last attribute first since sorts are stable. A lone
+        # instance needs no sorting.
+        if len(pks) > 1:
+            for attname, desc in reversed(self._get_cache_ordering()):
+                instances.sort(key=lambda obj: getattr(obj, attname),
+                               reverse=desc)
+
+        return instances
+
+    def iterator(self):
+        if self._cache_pks is None or not settings.DATA_CACHE_ENABLED:
+            return super(CacheQuerySet, self).iterator()
+
+        return iter(self._get_cached_instances())
@@ -0,0 +1,191 @@
+"""Per-method statistics for cached methods.
+
+Counters are kept in-process per method and merged into the data cache
+periodically so they can be reported across processes, e.g. by
+`avocado cache --stats`. Every event is also passed to the optional
+`DATA_CACHE_STATS_HOOK` for forwarding to an external metrics system.
+"""
+import time
+import logging
+import hashlib
+import threading
+from collections import defaultdict
+from django.core.cache import get_cache
+from django.utils.importlib import import_module
+from avocado.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HITS = 'hits'
+MISSES = 'misses'
+COMPUTE_TIME = 'compute_time'
+BYTES = 'bytes'
+SET_FAILURES = 'set_failures'
+
+COUNTERS = (HITS, MISSES, COMPUTE_TIME, BYTES, SET_FAILURES)
+
+# Shared counters must outlive the interval they are merged at.
+STATS_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+
+def _stats_key(name, counter=None):
+    tok = u'stats:{0}:{1}'.format(name, counter or '')
+    return hashlib.sha256(tok.encode('utf8')).hexdigest()
+
+
+# Key of the set of method names with shared counters
+NAMES_KEY = _stats_key('names')
+
+
+def _new_counters():
+    return dict((counter, 0) for counter in COUNTERS)
+
+
+class CacheStats(object):
+    """Thread-safe in-process counters keyed by method name. Compute time
+    is tracked in milliseconds.
+    """
+    def __init__(self):
+        self._counters = defaultdict(_new_counters)
+        # Amounts not yet merged into the shared counters
+        self._pending = defaultdict(_new_counters)
+        self._merged = time.time()
+        self._lock = threading.Lock()
+
+    def incr(self, name, counter, amount=1):
+        with self._lock:
+            self._counters[name][counter] += amount
+            self._pending[name][counter] += amount
+
+    def snapshot(self):
+        "Returns a copy of the counters per method name."
+        with self._lock:
+            return dict((name, dict(counters))
+                        for name, counters in self._counters.items())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._pending.clear()
+
+    def merge_due(self, interval):
+        return time.time() - self._merged >= interval
+
+    def merge(self, cache=None):
+        "Merges the pending amounts into the shared counters."
+        if cache is None:
+            cache = get_cache(settings.DATA_CACHE)
+
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(_new_counters)
+            self._merged = time.time()
+
+        if not pending:
+            return
+
+        for name, counters in pending.items():
+            for counter, amount in counters.items():
+                if amount:
+                    _incr_shared(cache, _stats_key(name, counter), amount)
+
+        names = cache.get(NAMES_KEY) or set()
+
+        if not set(pending) <= names:
+            cache.set(NAMES_KEY, names | set(pending), timeout=STATS_TIMEOUT)
+
+
+def _incr_shared(cache, key, amount):
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # Another process may have initialized it in the mean time
+        if not cache.add(key, amount, timeout=STATS_TIMEOUT):
+            cache.incr(key, amount)
+
+
+stats = CacheStats()
+
+_hooks = {}
+
+
+def get_hook():
+    "Returns the callable referenced by `DATA_CACHE_STATS_HOOK`, if any."
+    path = settings.DATA_CACHE_STATS_HOOK
+
+    if not path:
+        return
+
+    if callable(path):
+        return path
+
+    if path not in _hooks:
+        module, attr = path.rsplit('.', 1)
+        _hooks[path] = getattr(import_module(module), attr)
+
+    return _hooks[path]
+
+
+def log_hook(name, counter, amount):
+    "Hook that emits each event as a log record."
+    logger.info('{0}.{1}:{2}'.format(name, counter, amount),
+                extra={'cache_method': name, 'cache_counter': counter,
+                       'cache_amount': amount})
+
+
+def record(name, counter, amount=1):
+    "Records an event for the method if statistics are enabled."
+    if not settings.DATA_CACHE_STATS_ENABLED:
+        return
+
+    stats.incr(name, counter, amount)
+
+    hook = get_hook()
+
+    if hook is not None:
+        try:
+            hook(name, counter, amount)
+        except Exception:
+            logger.exception('Error calling cache stats hook')
+
+    if stats.merge_due(settings.DATA_CACHE_STATS_INTERVAL):
+        try:
+            stats.merge()
+        except Exception:
+            logger.exception('Error merging cache stats')
+
+
+def get_stats():
+    """Returns the counters per method name aggregated across processes,
+    including the amounts of this process that are not merged yet.
+    """
+    cache = get_cache(settings.DATA_CACHE)
+    stats.merge(cache)
+
+    names = cache.get(NAMES_KEY) or set()
+    keys = {}
+
+    for name in names:
+        for counter in COUNTERS:
+            keys[_stats_key(name, counter)] = (name, counter)
+
+    found = cache.get_many(keys.keys())
+    totals = dict((name, _new_counters()) for name in names)
+
+    for key, value in found.items():
+        name, counter = keys[key]
+        totals[name][counter] = value
+
+    return totals
+
+
+def reset_stats():
+    "Resets the counters of this process and the shared counters."
+    cache = get_cache(settings.DATA_CACHE)
+    names = cache.get(NAMES_KEY) or set()
+
+    keys = [_stats_key(name, counter)
+            for name in names for counter in COUNTERS]
+
+    cache.delete_many(keys + [NAMES_KEY])
+    stats.reset()
@@ -0,0 +1,137 @@
+"""Tag-based invalidation of cached data.
+
+Each tag has a generation counter stored in the data cache. Cached data is
+stored along with the generations of its tags at the time it was computed.
+When read, the stored generations are compared to the current ones and the
+data is treated as a miss if any tag has been invalidated since. Invalidating
+a tag only increments its counter, so it is O(1) regardless of the number of
+keys that carry the tag.
+"""
+import time
+import hashlib
+from collections import namedtuple
+from django.core.cache import get_cache
+from avocado.conf import settings
+
+# Generation counters must outlive the data they tag.
+TAG_TIMEOUT = 60 * 60 * 24 * 30  # 30 days
+
+
+# Wrapper for cached data along with the generations of its tags.
+TaggedData = namedtuple('TaggedData', ('generations', 'data'))
+
+
+def app_tag(app_label):
+    return u'app:{0}'.format(app_label)
+
+
+def model_tag(app_label, model_name):
+    return u'model:{0}.{1}'.format(app_label, model_name.lower())
+
+
+def instance_tag(instance):
+    opts = instance._meta
+    return u'instance:{0}.{1}.{2}'.format(opts.app_label, opts.module_name,
+                                          instance.pk)
+
+
+def instance_cache_tags(instance):
+    """Returns the tags for data cached on behalf of the instance. Models can
+    define a `cache_tags` method to customize the tags, otherwise the app,
+    model and instance tags are used.
+    """
+    if hasattr(instance, 'cache_tags'):
+        return instance.cache_tags()
+
+    opts = instance._meta
+
+    return [
+        app_tag(opts.app_label),
+        model_tag(opts.app_label, opts.module_name),
+        instance_tag(instance),
+    ]
+
+
+def tag_key(tag):
+    "Returns the cache key of the generation counter for a tag."
+    return hashlib.sha256(u'tag:{0}'.format(tag).encode('utf8')).hexdigest()
+
+
+def _new_generation():
+    # Time-based so a counter that was evicted from the cache never
+    # reuses a previous generation.
+    return int(time.time() * 1000)
+
+
+def get_generations(tags, cache=None):
+    "Returns a dict of the current generation per tag, initializing any."
+    if cache is None:
+        cache = get_cache(settings.DATA_CACHE)
+
+    keys = dict((tag_key(tag), tag) for tag in tags)
+    found = cache.get_many(keys.keys())
+
+    generations = {}
+
+    for key, tag in keys.items():
+        generation = found.get(key)
+
+        if generation is None:
+            generation = _new_generation()
+
+            # Another process may have initialized it in the mean time
+            if not cache.add(key, generation, timeout=TAG_TIMEOUT):
+                generation = cache.get(key, generation)
+
+        generations[tag] = generation
+
+    return generations
+
+
+def is_current(entry, found):
+    """Returns true if the generations stored with `entry` match the current
+    ones in `found` which are keyed by the tag key.
+    """
+    for tag, generation in entry.generations.items():
+        if found.get(tag_key(tag)) != generation:
+            return False
+
+    return True
+
+
+def unwrap(entry, found):
+    """Returns the data of a cached entry or None if the entry is outdated.
+    Entries cached without tags are returned as is.
+    """
+    if isinstance(entry, TaggedData):
+        if not is_current(entry, found):
+            return
+
+        return entry.data
+
+    return entry
+
+
+def invalidate_tags(*tags):
+    """Invalidates all cached data carrying any of the tags by bumping the
+    generation counter of each tag.
+    """
+    from .proxy import get_local_cache
+
+    cache = get_cache(settings.DATA_CACHE)
+
+    for tag in tags:
+        key = tag_key(tag)
+
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation(), timeout=TAG_TIMEOUT)
+
+    # The local cache does not check generations, so entries in this
+    # process are dropped. Other processes see the invalidation once their
+    # local entries time out.
+    local = get_local_cache()
+
+    if local is not None:
+        local.clear()
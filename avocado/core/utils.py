@@ -12,17 +12,30 @@ from avocado.conf import settings
 USERNAME_CHARS = ascii_lowercase + digits + '@.+-_'
 
 
+# Form classes keyed by the name they were resolved from.
+_form_classes = {}
+
+
 def get_form_class(name):
+    try:
+        return _form_classes[name]
+    except KeyError:
+        pass
+
     # Absolute import if a period exists, otherwise assume the
     # name refers to a built-in Django class
     if '.' in name:
-        path = name.split('.')[:-1]
+        path, attr = name.rsplit('.', 1)
         module = import_module(path)
     else:
-        if not name.endswith('Field'):
-            name = name + 'Field'
+        attr = name
+        if not attr.endswith('Field'):
+            attr = attr + 'Field'
         module = forms
-    return getattr(module, name)
+
+    form_class = _form_classes[name] = getattr(module, attr)
+
+    return form_class
 
 
 def get_internal_type(field):
@@ -1,7 +1,8 @@
 import functools
 from multiprocessing.pool import ThreadPool
 from avocado.models import DataView
-from avocado.formatters import FormatterMismatchError, registry as formatters
+from avocado.formatters import FormatterMismatchError, \
+    prefetch_cached_methods, registry as formatters
 from cStringIO import StringIO
 
 
@@ -12,6 +13,10 @@ class BaseExporter(object):
     content_type = 'text/plain'
     preferred_formats = ()
 
+    # Cached DataField methods used by the exporter itself for coded fields,
+    # e.g. for writing out value labels.
+    cached_methods = ()
+
     # List of available readers by name. Call reader(name) to return
     # the specified reader.
     readers = (
@@ -41,7 +46,12 @@ class BaseExporter(object):
 
         for concept in concepts:
             formatter_class = formatters.get(concept.formatter)
-            self.add_formatter(formatter_class, concept=concept)
+            self.add_formatter(formatter_class, concept=concept,
+                               prefetch=False)
+
+        # Warm the cached data for all formatters at once rather than
+        # one formatter at a time.
+        self.prefetch_cached()
 
         self._format_cache = {}
 
@@ -50,12 +60,13 @@ class BaseExporter(object):
                                         len(self.params), self.row_length)
 
     def add_formatter(self, formatter_class, concept=None, keys=None,
-                      index=None):
+                      index=None, prefetch=True):
 
         # Initialize a formatter instance.
         formatter = formatter_class(concept=concept,
                                     keys=keys,
-                                    formats=self.preferred_formats)
+                                    formats=self.preferred_formats,
+                                    prefetch=prefetch)
 
         length = len(formatter.field_names)
 
@@ -77,6 +88,26 @@ class BaseExporter(object):
         else:
             self._header.append(header)
 
+    def get_cached_methods(self):
+        """Returns a list of (field, methods) pairs of the cached DataField
+        methods the formatters and this exporter depend on.
+        """
+        pairs = []
+
+        for formatter, length in self.params:
+            pairs.extend(formatter.get_cached_methods())
+
+            if self.cached_methods:
+                pairs.extend((f, self.cached_methods)
+                             for f in formatter.fields.values()
+                             if f.code_field)
+
+        return pairs
+
+    def prefetch_cached(self):
+        "Pre-warms the cached data for all fields in the view."
+        prefetch_cached_methods(self.get_cached_methods())
+
     @property
     def header(self):
         header = []
@@ -14,6 +14,9 @@ class RExporter(BaseExporter):
     file_extension = 'zip'
     content_type = 'application/zip'
 
+    # Value labels are written for coded fields
+    cached_methods = ('codes', 'labels')
+
     preferred_formats = ('r', 'coded')
 
     def _format_name(self, name):
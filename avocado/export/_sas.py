@@ -14,6 +14,9 @@ class SASExporter(BaseExporter):
     file_extension = 'zip'
     content_type = 'application/zip'
 
+    # Value labels are written for coded fields
+    cached_methods = ('codes', 'labels')
+
     preferred_formats = ('sas', 'coded')
 
     # informat/format mapping for all datatypes except strings
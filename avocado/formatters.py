@@ -73,6 +73,21 @@ def _unique_dict(fields):
     return OrderedDict(pairs)
 
 
+def prefetch_cached_methods(pairs):
+    """Takes a sequence of (field, methods) pairs and pre-warms the cached
+    methods with one bulk cache lookup per distinct set of methods.
+    """
+    from avocado.models import DataField
+
+    groups = OrderedDict()
+
+    for field, methods in pairs:
+        groups.setdefault(tuple(methods), []).append(field)
+
+    for methods, fields in groups.items():
+        DataField.objects.prefetch_cached(fields, methods=methods)
+
+
 def process_multiple(func):
     "Decorator for marking a formatter method to process multiple values."
     func.process_multiple = True
@@ -98,8 +113,19 @@ class Formatter(object):
         None: '<em>n/a</em>'
     }
 
-    def __init__(self, concept=None, keys=None, formats=None):
-        "Passing in a concept takes precedence over `keys`."
+    # Cached DataField methods used by the format methods. These are
+    # pre-warmed in bulk when the formatter is initialized.
+    cached_methods = {
+        'coded': ('codes', 'values'),
+    }
+
+    def __init__(self, concept=None, keys=None, formats=None, prefetch=True):
+        """Passing in a concept takes precedence over `keys`.
+
+        If `prefetch` is true, the cached data the selected formats depend on
+        is loaded for all fields at once. Callers that handle many formatters
+        can disable this and prefetch all formatters together.
+        """
         if not keys and not concept:
             raise ValueError('A concept or sequence of keys are required.')
 
@@ -123,6 +149,7 @@ class Formatter(object):
         self.multi_formats = []
 
         self.default_context = {}
+        self.formats = tuple(formats or ())
 
         if formats:
             for fmt in formats:
@@ -143,6 +170,9 @@ class Formatter(object):
         # Create a bare-bones record class.
         self._recordclass = namedtuple('record', self.field_names)
 
+        if prefetch:
+            self.prefetch_cached()
+
     def __contains__(self, choice):
         return hasattr(self, 'to_{0}'.format(choice))
 
@@ -199,6 +229,29 @@ class Formatter(object):
 
         return tuple(output)
 
+    def get_cached_methods(self):
+        """Returns a list of (field, methods) pairs of the cached DataField
+        methods the selected formats depend on.
+        """
+        methods = []
+
+        for fmt in self.formats:
+            for name in self.cached_methods.get(fmt, ()):
+                if name not in methods:
+                    methods.append(name)
+
+        if not methods:
+            return []
+
+        # Only fields with a code field require a database hit for
+        # their coded values.
+        return [(f, tuple(methods)) for f in self.fields.values()
+                if f.code_field]
+
+    def prefetch_cached(self):
+        "Pre-warms the cached data the selected formats depend on."
+        prefetch_cached_methods(self.get_cached_methods())
+
     def _process_single(self, method, value, field, context):
         output = method(value, field=field, context=context)
 
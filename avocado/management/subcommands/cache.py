@@ -1,11 +1,20 @@
 import sys
 import time
 import logging
+from multiprocessing import Pool
 from optparse import make_option
-from django.db import transaction
+from django.core.cache import get_cache
+from django.db import connections, transaction
 from django.core.management.base import BaseCommand, CommandError
+from django_rq import get_queue
+from avocado.conf import settings
 from avocado.models import DataField
+from avocado.core.cache import invalidate_tags, get_stats, reset_stats
+from avocado.core.cache.stats import HITS, MISSES, COMPUTE_TIME, BYTES, \
+    SET_FAILURES
+from avocado.core.cache.model import NEVER_EXPIRE, cache_key_func
 from avocado.management.base import DataFieldCommand
+from avocado.management.utils import get_tags_by_label, get_tags_by_concept
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +37,92 @@ METHOD_CHOICES = ', '.join(CACHED_METHODS)
 __doc__ = """\
 Pre-caches data produced by various DataField methods that are data dependent.
 Pass `--flush` to explicitly flush any existing cache for each method.
+
+Pass `--workers` to pre-cache fields in parallel processes or `--async` to
+queue a job per field on the async queue. Progress is recorded per field,
+so an interrupted run can be continued with `--resume`.
+
+Pass `--invalidate` to invalidate all cached data derived from the app,
+model or field labels rather than pre-caching. Use `--concept` to invalidate
+the cached data of a concept and its fields.
+
+Pass `--stats` to print the hits, misses, compute time, payload bytes and
+set failures per cached method collected across processes (requires the
+`DATA_CACHE_STATS_ENABLED` setting). Pass `--reset-stats` to reset them.
 """
 
 
+@transaction.commit_on_success
+def _warm_field_method(f, method, flush):
+    "Caches the method for the field, returns true if the data was cached."
+    func = getattr(f, method)
+
+    if flush:
+        func.flush(f)
+
+    if func.cached(f):
+        return False
+
+    func()
+    return True
+
+
+def warm_field(pk, methods, flush=False, run_key=None):
+    """Pre-caches the methods for a field and returns the counts of the
+    cached, skipped and errored methods. If a `run_key` is passed, the field
+    is marked as completed for the run so it can be resumed.
+    """
+    counts = {'cached': 0, 'skipped': 0, 'errors': 0}
+    f = DataField.objects.get(pk=pk)
+
+    for method in methods:
+        # By default, the settings run on sqlite3 DB so a
+        # DatabaseError will be triggered when the standard deviation
+        # or variance functions are used.
+        try:
+            if _warm_field_method(f, method, flush):
+                counts['cached'] += 1
+            else:
+                counts['skipped'] += 1
+        except Exception:
+            counts['errors'] += 1
+            log.exception('error populating cache for "{0}" {1}'
+                          .format(f, method))
+
+    if run_key is not None:
+        cache = get_cache(settings.DATA_CACHE)
+        cache.set(_progress_key(run_key, pk), True, timeout=NEVER_EXPIRE)
+
+    return counts
+
+
+def _warm_field_task(args):
+    "Pool-friendly wrapper around `warm_field`."
+    return args[0], warm_field(*args)
+
+
+def warm_run_key(pks, methods, flush):
+    "Returns a key identifying a run for the fields and options."
+    return cache_key_func(['warm', sorted(pks), sorted(methods), flush])
+
+
+def _progress_key(run_key, pk):
+    return cache_key_func([run_key, pk])
+
+
+def completed_fields(run_key, pks):
+    "Returns the set of field pks that are completed for the run."
+    cache = get_cache(settings.DATA_CACHE)
+    keys = dict((_progress_key(run_key, pk), pk) for pk in pks)
+    found = cache.get_many(keys.keys())
+    return set(keys[key] for key in found)
+
+
+def reset_progress(run_key, pks):
+    cache = get_cache(settings.DATA_CACHE)
+    cache.delete_many([_progress_key(run_key, pk) for pk in pks])
+
+
 class Command(DataFieldCommand):
     help = __doc__
 
@@ -46,26 +138,119 @@ class Command(DataFieldCommand):
                     default=CACHED_METHODS,
                     help='Select which methods to pre-cache. Choices: {0}'
                          .format(METHOD_CHOICES)),
+
+        make_option('--workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to pre-cache fields with.'),
+
+        make_option('--async',
+                    action='store_true',
+                    dest='use_async',
+                    default=False,
+                    help='Queue a job per field on the async queue rather '
+                         'than pre-caching in this process.'),
+
+        make_option('--resume',
+                    action='store_true',
+                    default=False,
+                    help='Skip fields completed by a previous run with the '
+                         'same labels and options.'),
+
+        make_option('--invalidate',
+                    action='store_true',
+                    help='Invalidates all cached data for the labels.',
+                    default=False),
+
+        make_option('--concept',
+                    action='append',
+                    dest='concepts',
+                    type='int',
+                    default=[],
+                    help='Concept id to invalidate cached data for. '
+                         'Implies --invalidate.'),
+
+        make_option('--stats',
+                    action='store_true',
+                    default=False,
+                    help='Prints the statistics of the cached methods.'),
+
+        make_option('--reset-stats',
+                    action='store_true',
+                    dest='reset_stats',
+                    default=False,
+                    help='Resets the statistics of the cached methods.'),
     )
 
-    @transaction.commit_on_success
-    def _handle_field_method(self, f, method, flush):
-        func = getattr(f, method)
+    def handle(self, *labels, **options):
+        concepts = options.get('concepts')
 
-        if flush:
-            func.flush(f)
+        if options.get('stats') or options.get('reset_stats'):
+            return self.handle_stats(options.get('reset_stats'))
 
-        if func.cached(f):
-            self.skipped += 1
-        else:
-            data = func()
+        if options.get('invalidate') or concepts:
+            return self.handle_invalidate(labels, concepts)
+
+        return super(Command, self).handle(*labels, **options)
+
+    def handle_invalidate(self, labels, concepts):
+        if not labels and not concepts:
+            raise CommandError('At least one label or concept must be '
+                               'specified to invalidate.')
+
+        try:
+            tags = get_tags_by_label(labels)
+        except ValueError as e:
+            raise CommandError(e.message)
+
+        if concepts:
+            tags.extend(get_tags_by_concept(concepts))
+
+        invalidate_tags(*tags)
+
+        print(u'{0} cache tags have been invalidated.'.format(len(tags)))
+
+    def handle_stats(self, reset=False):
+        if reset:
+            reset_stats()
+            print(u'Cache statistics have been reset.')
+            return
+
+        if not settings.DATA_CACHE_STATS_ENABLED:
+            print(u'Warning: DATA_CACHE_STATS_ENABLED is off, no statistics '
+                  'are being collected.')
+
+        stats = get_stats()
+
+        if not stats:
+            print(u'No cache statistics have been recorded.')
+            return
 
-            if data is not None:
-                self.cached += 1
+        row = u'{0:<30} {1:>10} {2:>10} {3:>8} {4:>12} {5:>14} {6:>8}'
+
+        print(row.format('method', 'hits', 'misses', 'hit %', 'compute (s)',
+                         'bytes', 'failures'))
+
+        # Most expensive methods first
+        names = sorted(stats, key=lambda n: stats[n][COMPUTE_TIME],
+                       reverse=True)
+
+        for name in names:
+            counters = stats[name]
+            lookups = counters[HITS] + counters[MISSES]
+            ratio = 100.0 * counters[HITS] / lookups if lookups else 0
+
+            print(row.format(name, counters[HITS], counters[MISSES],
+                             round(ratio, 1),
+                             round(counters[COMPUTE_TIME] / 1000.0, 2),
+                             counters[BYTES], counters[SET_FAILURES]))
 
     def handle_fields(self, fields, **options):
         flush = options.get('flush')
         methods = options.get('methods')
+        workers = options.get('workers') or 1
+        use_async = options.get('use_async')
+        resume = options.get('resume')
 
         # Validate methods
         for method in methods:
@@ -73,6 +258,30 @@ class Command(DataFieldCommand):
                 raise CommandError('Invalid method {0}. Choices are {1}'
                                    .format(method, METHOD_CHOICES))
 
+        methods = tuple(methods)
+        all_pks = list(fields.values_list('pk', flat=True))
+        run_key = warm_run_key(all_pks, methods, flush)
+
+        # Skip fields that were completed by a previous run that was
+        # interrupted.
+        if resume:
+            done = completed_fields(run_key, all_pks)
+            pks = [pk for pk in all_pks if pk not in done]
+            print(u'Resuming, {0} fields are already done.'.format(len(done)))
+        else:
+            pks = all_pks
+            reset_progress(run_key, all_pks)
+
+        if use_async:
+            queue = get_queue(settings.ASYNC_QUEUE)
+
+            for pk in pks:
+                queue.enqueue(warm_field, pk, methods, flush, run_key)
+
+            print(u'{0} fields queued on "{1}"'
+                  .format(len(pks), settings.ASYNC_QUEUE))
+            return
+
         self.total = 0
         self.skipped = 0
         self.cached = 0
@@ -80,25 +289,37 @@ class Command(DataFieldCommand):
 
         t0 = time.time()
 
-        for f in fields:
-            for method in methods:
-                self.total += 1
-
-                # By default, the settings run on sqlite3 DB so a
-                # DatabaseError will be triggered when the standard deviation
-                # or variance functions are used.
-                try:
-                    self._handle_field_method(f, method, flush)
-                except Exception:
-                    self.errors += 1
-                    log.exception('error populating cache for "{0}" {1}'
-                                  .format(f, method))
-
-            if self.total % 10 == 0:
-                sys.stdout.write('\r{0}/{1}/{2}/{3} '
+        tasks = [(pk, methods, flush, run_key) for pk in pks]
+
+        if workers > 1:
+            # Connections must not be shared with the forked processes.
+            for conn in connections.all():
+                conn.close()
+
+            pool = Pool(workers)
+            results = pool.imap_unordered(_warm_field_task, tasks)
+        else:
+            pool = None
+            results = (_warm_field_task(task) for task in tasks)
+
+        try:
+            for i, (pk, counts) in enumerate(results):
+                self.total += sum(counts.values())
+                self.cached += counts['cached']
+                self.skipped += counts['skipped']
+                self.errors += counts['errors']
+
+                sys.stdout.write('\r[{0}/{1}] field {2}: {3}/{4}/{5}/{6} '
                                  'cached/skipped/errors/total'
-                                 .format(self.cached, self.skipped,
-                                         self.errors, self.total))
+                                 .format(i + 1, len(tasks), pk, self.cached,
+                                         self.skipped, self.errors,
+                                         self.total))
                 sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        # The run is complete, so there is nothing left to resume.
+        reset_progress(run_key, all_pks)
 
         print('\nTook {0} s'.format(round(time.time() - t0, 2)))
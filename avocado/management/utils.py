@@ -1,5 +1,6 @@
 from django.db.models import Q
-from avocado.models import DataField
+from avocado.core.cache import app_tag, model_tag, instance_tag
+from avocado.models import DataField, DataConcept
 
 
 def get_fields_by_label(labels):
@@ -35,3 +36,43 @@ def get_fields_by_label(labels):
         fields = fields.filter(q).distinct()
 
     return fields
+
+
+def get_tags_by_label(labels):
+    """Returns the cache tags given a list of labels.
+
+    The label format can be <app>, <app.model> or <app.model.field>. Fields
+    resolve to the tags of the corresponding DataField instances.
+    """
+    tags = []
+
+    for label in labels:
+        toks = label.split('.')
+
+        if len(toks) == 3:
+            fields = get_fields_by_label([label])
+
+            if not fields.exists():
+                raise ValueError(u'No DataField matches "{0}"'.format(label))
+
+            tags.extend(instance_tag(f) for f in fields)
+        elif len(toks) == 2:
+            tags.append(model_tag(*toks))
+        else:
+            tags.append(app_tag(toks[0]))
+
+    return tags
+
+
+def get_tags_by_concept(ids):
+    """Returns the cache tags for each concept and the fields associated
+    with them.
+    """
+    tags = []
+
+    for concept in DataConcept.objects.filter(pk__in=ids) \
+            .prefetch_related('fields'):
+        tags.append(instance_tag(concept))
+        tags.extend(instance_tag(f) for f in concept.fields.all())
+
+    return tags
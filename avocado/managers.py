@@ -6,6 +6,7 @@ from django.conf import settings as djsettings
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models.manager import ManagerDescriptor
 from avocado.conf import OPTIONAL_DEPS, dep_supported, settings
+from avocado.core.cache import prefetch_cached
 from avocado.core.managers import PublishedManager, PublishedQuerySet
 
 
@@ -243,6 +244,20 @@ class DataFieldManager(PublishedManager, DataFieldSearchMixin):
             values = [app_name, model_name, field_name]
         return queryset.get(**dict(zip(keys, values)))
 
+    def prefetch_cached(self, fields, methods=('values', 'labels', 'codes'),
+                        queryset=None):
+        """Pre-warms the cached data methods for `fields` in bulk. All cache
+        keys are fetched at once and only the misses are computed.
+
+        Returns a dict keyed by (field pk, method name).
+        """
+        kwargs = None
+
+        if queryset is not None:
+            kwargs = {'queryset': queryset}
+
+        return prefetch_cached(fields, methods, kwargs=kwargs)
+
 
 class DataConceptManager(PublishedManager, DataConceptSearchMixin):
     "Manager for the `DataConcept` model."
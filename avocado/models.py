@@ -15,7 +15,7 @@ from avocado.core import utils
 from avocado.core.structures import ChoicesDict
 from avocado.core.models import Base, BasePlural, PublishArchiveMixin
 from avocado.core.cache import post_save_cache, pre_delete_uncache, \
-    cached_method
+    cached_method, app_tag, model_tag, instance_tag
 from avocado.conf import settings
 from avocado import managers, history
 from avocado.query.translators import registry as translators
@@ -424,6 +424,16 @@ class DataField(BasePlural, PublishArchiveMixin):
 
         return smart_unicode(value)
 
+    def cache_tags(self):
+        """Returns the tags of the cached data derived from this field, that
+        is the app and model of the underlying data as well as this field.
+        """
+        return [
+            app_tag(self.app_name),
+            model_tag(self.app_name, self.model_name),
+            instance_tag(self),
+        ]
+
     def _has_predefined_choices(self):
         """Returns true if the base field has pre-defined choices and no
         alternative label field has been defined.
@@ -440,7 +450,7 @@ class DataField(BasePlural, PublishArchiveMixin):
 
         return self.values_list(queryset=queryset).count()
 
-    @cached_method(version='data_version')
+    @cached_method(version='data_version', compact=True)
     def values(self, queryset=None):
         "Returns a distinct list of values."
         if self._has_predefined_choices():
@@ -448,7 +458,7 @@ class DataField(BasePlural, PublishArchiveMixin):
 
         return tuple(self.values_list(queryset=queryset))
 
-    @cached_method(version='data_version')
+    @cached_method(version='data_version', compact=True)
     def labels(self, queryset=None):
         "Returns a distinct list of labels."
         if self._has_predefined_choices():
@@ -458,7 +468,7 @@ class DataField(BasePlural, PublishArchiveMixin):
         return tuple(
             smart_unicode(l) for l in self.labels_list(queryset=queryset))
 
-    @cached_method(version='data_version')
+    @cached_method(version='data_version', compact=True)
     def codes(self, queryset=None):
         "Returns a distinct set of coded values for this field"
         if self._has_predefined_choices():
@@ -576,21 +586,32 @@ class DataField(BasePlural, PublishArchiveMixin):
         return tuple(queryset)
 
     # Translator Convenience Methods
+    @property
+    def prepared_translator(self):
+        """Returns the translator of this datafield prepared for it. It is
+        prepared once and prepared again only if the translator changes.
+        """
+        prepared = getattr(self, '_prepared_translator', None)
+
+        if prepared is None or prepared.name != self.translator:
+            prepared = translators[self.translator].prepare(self)
+
+        return prepared
+
     @property
     def operators(self):
         "Returns the valid operators for this datafield."
-        trans = translators[self.translator]
         return [(x, operators[x].verbose_name) for x
-                in trans.get_operators(self)]
+                in self.prepared_translator.field_operators]
 
     def translate(self, operator=None, value=None, tree=None, **context):
         "Convenince method for performing a translation on a query condition."
-        trans = translators[self.translator]
+        trans = self.prepared_translator.translator
         return trans.translate(self, operator, value, tree, **context)
 
     def validate(self, operator=None, value=None, tree=None, **context):
         "Convenince method for performing a translation on a query condition."
-        trans = translators[self.translator]
+        trans = self.prepared_translator.translator
         return trans.validate(self, operator, value, tree, **context)
 
     def random(self, k, queryset=None):
@@ -827,7 +848,9 @@ class DataContext(Base):
         "Applies this context to a QuerySet."
         if tree is None and queryset is not None:
             tree = queryset.model
-        return self.parse(tree=tree, **context).apply(queryset=queryset)
+        return parsers.datacontext.compile_node(self.json, tree=tree,
+                                                **context) \
+            .apply(queryset=queryset)
 
     def language(self, tree=None, **context):
         return self.parse(tree=tree, **context).language
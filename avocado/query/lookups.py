@@ -0,0 +1,135 @@
+"""Lookup values that are compiled into a subquery rather than a list of
+literals. An `in` condition with a large number of values produces a long
+`IN (...)` clause which is planned poorly and may exceed the number of
+variables the database backend supports.
+
+The values are bound as a single parameter, so compiling the query has no
+side effects on the database. On PostgreSQL they are bound as an array and
+expanded with `unnest`. On SQLite and MySQL 8 they are bound as a JSON array
+and expanded with `json_each` and `JSON_TABLE` respectively. The version of
+MySQL is only known once a connection to the database has been opened.
+Until then and on other backends the values fall back to the list of
+literals.
+"""
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+# Result of checking whether SQLite was built with the JSON functions
+_sqlite_json = None
+
+# Server versions of MySQL databases keyed by their host, port and name
+_mysql_versions = {}
+
+
+def _sqlite_supports_json():
+    global _sqlite_json
+
+    if _sqlite_json is None:
+        from django.db.backends.sqlite3.base import Database
+
+        # Checked on a separate in-memory database so no statements are
+        # executed on the connection the query is compiled for.
+        conn = Database.connect(':memory:')
+
+        try:
+            conn.execute("SELECT json('[]')")
+        except Database.Error:
+            _sqlite_json = False
+        else:
+            _sqlite_json = True
+        finally:
+            conn.close()
+
+    return _sqlite_json
+
+
+def _mysql_version(connection):
+    """Returns the server version of the MySQL database or None if it is not
+    known yet. The version is only read from an open connection, so no
+    connection is opened while a query is compiled.
+    """
+    settings_dict = connection.settings_dict
+    key = (settings_dict['HOST'], settings_dict['PORT'],
+           settings_dict['NAME'])
+
+    if key not in _mysql_versions:
+        if connection.connection is None:
+            return
+
+        _mysql_versions[key] = connection.mysql_version
+
+    return _mysql_versions[key]
+
+
+def supports_json_values(connection):
+    "Returns true if the values can be bound as a JSON array."
+    if connection.vendor == 'sqlite':
+        return _sqlite_supports_json()
+
+    if connection.vendor == 'mysql':
+        version = _mysql_version(connection)
+        return version is not None and version >= (8, 0, 4)
+
+    return False
+
+
+class ValuesSubquery(object):
+    "Set of values of a model field used as the right-hand side of `in`."
+    def __init__(self, field, values):
+        self.field = field
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return u'<ValuesSubquery: {0} values>'.format(len(self.values))
+
+    def _prepare(self):
+        return self
+
+    def _db_type(self, connection):
+        field = self.field
+
+        if isinstance(field, models.ForeignKey):
+            field = field.rel.get_related_field()
+
+        # The column holds values of the field, not generated keys
+        if isinstance(field, models.AutoField):
+            field = models.IntegerField()
+
+        return field.db_type(connection)
+
+    def _db_values(self, connection):
+        values = []
+        seen = set()
+
+        for value in self.values:
+            value = self.field.get_db_prep_value(value, connection)
+
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+
+        return values
+
+    def _as_sql(self, connection):
+        db_type = self._db_type(connection)
+        values = self._db_values(connection)
+
+        if connection.vendor == 'postgresql':
+            return 'SELECT unnest(%s::{0}[])'.format(db_type), [values]
+
+        if not supports_json_values(connection):
+            return ', '.join(['%s'] * len(values)), values
+
+        values = json.dumps(values, cls=DjangoJSONEncoder)
+
+        if connection.vendor == 'sqlite':
+            return 'SELECT value FROM json_each(%s)', [values]
+
+        return ("SELECT value FROM JSON_TABLE(%s, '$[*]' "
+                "COLUMNS (value {0} PATH '$')) AS {1}".format(
+                    db_type, connection.ops.quote_name('_avocado_values')),
+                [values])
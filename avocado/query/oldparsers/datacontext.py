@@ -1,6 +1,12 @@
+import json
+import threading
 from warnings import warn
+import django
 from django.db import models
+from avocado.conf import settings
 from avocado.core import utils
+from avocado.core.cache.proxy import LocalCache
+from avocado.query.lookups import ValuesSubquery
 from modeltree.tree import trees
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
@@ -40,11 +46,102 @@ def is_composite(obj):
         return True
 
 
+def _hashable_key(key):
+    "Returns a hashable form of a field key."
+    if isinstance(key, list):
+        return tuple(key)
+    return key
+
+
+def _collect_keys(attrs, field_keys, concept_keys):
+    """Walks the tree and collects the field keys and concept ids of the
+    conditions. Composites are skipped since they are resolved when parsed.
+    """
+    if not attrs or type(attrs) is not dict or is_composite(attrs):
+        return
+
+    if is_condition(attrs):
+        field_key = attrs.get('field', attrs.get('id'))
+
+        if isinstance(field_key, (int, basestring, list, tuple)):
+            field_keys.add(_hashable_key(field_key))
+
+        if attrs.get('concept') is not None:
+            concept_keys.add(attrs['concept'])
+
+    elif is_branch(attrs) and isinstance(attrs['children'], (list, tuple)):
+        for child in attrs['children']:
+            _collect_keys(child, field_keys, concept_keys)
+
+
+def _matches(field, lookup):
+    for key, value in lookup.items():
+        if key == 'pk':
+            if field.pk != value:
+                return False
+        elif getattr(field, key) != value:
+            return False
+    return True
+
+
+def resolve(attrs):
+    """Resolves the fields and concepts referenced by the conditions in the
+    tree in bulk rather than one query per condition.
+
+    Returns a dict with the `fields` keyed by field key, the `concepts` keyed
+    by id and the `concept_fields` as a set of field ids keyed by concept id.
+    Keys that are ambiguous or do not exist are left out, so the nodes fall
+    back to looking them up individually and raise the appropriate error.
+    """
+    from avocado.models import DataField, DataConcept, DataConceptField
+
+    resolved = {'fields': {}, 'concepts': {}, 'concept_fields': {}}
+
+    field_keys = set()
+    concept_keys = set()
+    _collect_keys(attrs, field_keys, concept_keys)
+
+    if field_keys:
+        lookups = {}
+
+        for key in field_keys:
+            lookups[key] = utils.parse_field_key(
+                list(key) if isinstance(key, tuple) else key)
+
+        q = reduce(lambda q1, q2: q1 | q2,
+                   [models.Q(**lookup) for lookup in lookups.values()])
+
+        fields = list(DataField.objects.filter(q))
+
+        for key, lookup in lookups.items():
+            matches = [f for f in fields if _matches(f, lookup)]
+
+            if len(matches) == 1:
+                resolved['fields'][key] = matches[0]
+
+    if concept_keys:
+        # Primary key lookups are served from the instance cache if present
+        for concept in DataConcept.objects.filter(pk__in=list(concept_keys)):
+            resolved['concepts'][concept.pk] = concept
+
+        concept_fields = DataConceptField.objects \
+            .filter(concept__pk__in=resolved['concepts'].keys()) \
+            .values_list('concept', 'field')
+
+        for concept_id, field_id in concept_fields:
+            resolved['concept_fields'].setdefault(concept_id, set()) \
+                .add(field_id)
+
+    return resolved
+
+
 class Node(object):
     condition = None
     annotations = None
     extra = None
     language = None
+    # Flags a tree that can never match
+    empty = False
 
     def __init__(self, tree=None, **context):
         self.tree = tree
@@ -59,11 +156,36 @@ class Node(object):
             queryset = queryset.filter(self.condition)
         if self.extra:
             queryset = queryset.extra(**self.extra)
-        if distinct:
+        if distinct and needs_distinct(queryset):
             queryset = queryset.distinct()
+        if self.empty:
+            queryset = queryset.none()
         return queryset
 
 
+class Empty(Node):
+    "Node for a tree with contradicting conditions which never matches."
+    empty = True
+
+
+class CompiledNode(Node):
+    """Node holding the query modifiers of a compiled tree. The language
+    is not compiled, so it is parsed from the attributes when requested.
+    """
+    def __init__(self, attrs, condition=None, annotations=None, extra=None,
+                 empty=False, **context):
+        self.attrs = attrs
+        self.condition = condition
+        self.annotations = annotations
+        self.extra = extra
+        self.empty = empty
+        super(CompiledNode, self).__init__(**context)
+
+    @property
+    def language(self):
+        return parse(self.attrs, tree=self.tree, **self.context).language
+
+
 class Condition(Node):
     "Contains information for a single query condition."
     def __init__(self, value, operator, id=None, field=None,
@@ -82,9 +204,37 @@ class Condition(Node):
 
         super(Condition, self).__init__(**context)
 
+    def bind(self, resolved):
+        """Binds the field and concept of this condition from the bulk
+        resolved objects, if present.
+        """
+        concept = None
+
+        if self.concept_key:
+            concept = resolved['concepts'].get(self.concept_key)
+
+            if concept is None:
+                return
+
+            self._concept = concept
+
+        field = resolved['fields'].get(_hashable_key(self.field_key))
+
+        if field is None:
+            return
+
+        # The field must be one of the concept's fields
+        if concept is not None and \
+                field.pk not in resolved['concept_fields'].get(concept.pk, ()):
+            return
+
+        self._field = field
+
     @property
     def _meta(self):
-        if not hasattr(self, '__meta'):
+        # The attribute name is mangled, so `hasattr` must check the
+        # mangled name for the translation to be memoized.
+        if not hasattr(self, '_Condition__meta'):
             self.__meta = self.field.translate(operator=self.operator,
                                                value=self.value,
                                                tree=self.tree, **self.context)
@@ -196,7 +346,61 @@ class Branch(Node):
         return out
 
 
+def _displayed_values(operator, value):
+    """Returns the values of a list that are displayed in the language of the
+    condition and the number of values left out. Like the text of the
+    operator, the first `max_list_size` values and the last one are shown.
+    """
+    if isinstance(value, QuerySet):
+        value = list(value)
+
+    limit = getattr(operator, 'max_list_size', None)
+
+    if limit is None or not isinstance(value, (list, tuple)) or \
+            len(value) <= limit + 1:
+        return value, 0
+
+    return list(value[:limit]) + [value[-1]], len(value) - limit - 1
+
+
+def _value_labels(field, value):
+    """Returns the labels of the values of an enumerable or key field. The
+    labels of all values are used for enumerable fields since they have a
+    small set of values. Key fields have as many values as there are rows,
+    so only the labels of the displayed values are looked up. This is not
+    cached since the values differ from one condition to the next.
+    """
+    if field.enumerable or field._has_predefined_choices():
+        return field.value_labels()
+
+    if isinstance(value, (list, tuple)):
+        values = [x for x in value if x is not None]
+    else:
+        values = [value]
+
+    values = [x.pk if isinstance(x, models.Model) else x for x in values]
+
+    if not values:
+        return {}
+
+    threshold = settings.IN_SUBQUERY_THRESHOLD
+
+    if threshold is not None and len(values) >= threshold:
+        values = ValuesSubquery(field.field, values)
+
+    queryset = field.model.objects.filter(**{
+        u'{0}__in'.format(field.value_field.name): values,
+    }).values_list(field.value_field.name, field.label_field.name)
+
+    return dict((value, smart_unicode(label))
+                for value, label in queryset.distinct())
+
+
 def validate(attrs, **context):
+    return _validate(attrs, resolve(attrs), **context)
+
+
+def _validate(attrs, resolved, **context):
     if not attrs:
         return None
 
@@ -226,36 +430,29 @@ def validate(attrs, **context):
                           .format(attrs['id']))
 
     elif is_condition(attrs):
-        from avocado.models import DataField, DataConcept
-        field_key = attrs.get('field', attrs.get('id'))
-        # Parse to get into a consistent format
-        field_key = utils.parse_field_key(field_key)
-
         try:
-            if 'concept' in attrs:
-                concept = DataConcept.objects.get(id=attrs['concept'])
-                field = concept.fields.get(**field_key)
-            else:
-                field = DataField.objects.get(**field_key)
-            field.validate(operator=attrs['operator'], value=attrs['value'])
-            node = parse(attrs, **context)
+            # The field (and concept) are bound from the resolved objects
+            node = _parse(attrs, resolved, **context)
+            field = node.field
+
+            # Translating the condition validates it
             attrs['language'] = node.language['language']
 
             value = node._meta['cleaned_data']['value']
             cleaned = None
 
             if field.enumerable or field.simple_type == 'key':
-                value_labels = field.value_labels()
-
-                if isinstance(value, QuerySet):
-                    cleaned = [{
-                        'value': val.pk,
-                        'label': value_labels[val.pk]
-                    } for val in value]
-                elif isinstance(value, (list, tuple)):
+                operator = node._meta['cleaned_data']['operator']
+                value, more = _displayed_values(operator, value)
+                value_labels = _value_labels(field, value)
+
+                if isinstance(value, (list, tuple)):
                     cleaned = []
 
                     for val in value:
+                        if isinstance(val, models.Model):
+                            val = val.pk
+
                         if val in value_labels:
                             label = value_labels[val]
                         else:
@@ -287,6 +484,10 @@ def validate(attrs, **context):
             if cleaned:
                 attrs['cleaned_value'] = cleaned
 
+                # Number of values left out as in the language
+                if more:
+                    attrs['cleaned_value_more'] = more
+
         except ObjectDoesNotExist:
             enabled = False
             errors.append('Field does not exist')
@@ -295,7 +496,8 @@ def validate(attrs, **context):
         if attrs['type'] not in LOGICAL_OPERATORS:
             enabled = False
         else:
-            map(lambda x: validate(x, **context), attrs['children'])
+            map(lambda x: _validate(x, resolved, **context),
+                attrs['children'])
     else:
         enabled = False
         errors.append('Unknown node type')
@@ -314,6 +516,13 @@ def validate(attrs, **context):
 
 
 def parse(attrs, **context):
+    """Parses the tree into nodes. The fields and concepts referenced by
+    the conditions are resolved in bulk up front.
+    """
+    return _parse(attrs, resolve(attrs), **context)
+
+
+def _parse(attrs, resolved, **context):
     if not attrs or attrs.get('enabled') is False:
         node = Node(**context)
     elif is_composite(attrs):
@@ -327,8 +536,600 @@ def parse(attrs, **context):
     elif is_condition(attrs):
         node = Condition(operator=attrs['operator'], value=attrs['value'],
                          id=attrs.get('id'), field=attrs.get('field'),
-                         **context)
+                         concept=attrs.get('concept'), **context)
+        node.bind(resolved)
     else:
         node = Branch(type=attrs['type'], **context)
-        node.children = map(lambda x: parse(x, **context), attrs['children'])
+        node.children = map(lambda x: _parse(x, resolved, **context),
+                            attrs['children'])
     return node
+
+
+_plan_caches = {}
+_plan_caches_lock = threading.Lock()
+
+
+def get_plan_cache():
+    """Returns the in-process cache of compiled plans or None if it is not
+    enabled. The plans reference Q objects and querysets which are not safe
+    to pickle, so they are never stored in a shared cache.
+    """
+    if not settings.QUERY_PLAN_CACHE_ENABLED:
+        return
+
+    options = (settings.QUERY_PLAN_CACHE_MAX_ENTRIES, None,
+               settings.QUERY_PLAN_CACHE_TIMEOUT)
+
+    with _plan_caches_lock:
+        if options not in _plan_caches:
+            _plan_caches[options] = LocalCache(*options)
+
+        return _plan_caches[options]
+
+
+def _has_composite(attrs):
+    if not attrs or type(attrs) is not dict:
+        return False
+
+    if is_composite(attrs):
+        return True
+
+    if is_branch(attrs) and isinstance(attrs['children'], (list, tuple)):
+        return any(_has_composite(child) for child in attrs['children'])
+
+    return False
+
+
+def plan_key(attrs, tree, resolved, context=None):
+    """Returns the key of the compiled plan of the tree or None if it
+    cannot be cached. Every field and concept must have been resolved so the
+    key reflects their current `data_version` and modification time. The
+    context and the settings the plan is compiled with are included, so the
+    values of the context must be hashable.
+    """
+    field_keys = set()
+    concept_keys = set()
+    _collect_keys(attrs, field_keys, concept_keys)
+
+    if not field_keys <= set(resolved['fields']) or \
+            not concept_keys <= set(resolved['concepts']):
+        return
+
+    try:
+        canonical = json.dumps(attrs, sort_keys=True)
+    except (TypeError, ValueError):
+        return
+
+    fields = sorted((f.pk, f.data_version, f.modified)
+                    for f in resolved['fields'].values())
+
+    concepts = sorted((c.pk, c.modified)
+                      for c in resolved['concepts'].values())
+
+    context = tuple(sorted((context or {}).items()))
+
+    try:
+        hash(context)
+    except TypeError:
+        return
+
+    options = (settings.IN_SUBQUERY_THRESHOLD,
+               settings.QUERY_OPTIMIZER_ENABLED,
+               settings.QUERY_SEMIJOIN_ENABLED)
+
+    return (canonical, trees[tree], tuple(fields), tuple(concepts), context,
+            options)
+
+
+def compile_node(attrs, tree=None, **context):
+    """Returns a node with the query modifiers of the parsed tree.
+
+    If `QUERY_PLAN_CACHE_ENABLED` is true, the condition, annotations and
+    extra modifiers are cached in-process keyed on the canonical JSON, the
+    tree, the versions of the referenced fields and concepts, the additional
+    context, e.g. the user, and the settings the plan is compiled with, so
+    applying the same tree again skips parsing and translation. Trees with
+    composites or unhashable context are always parsed.
+
+    The parsed tree is optimized and, if `QUERY_SEMIJOIN_ENABLED` is true,
+    conditions across multi-valued relationships are compiled into
+    semi-joins. See `optimize` and `semijoin_condition`.
+    """
+    cache = get_plan_cache()
+
+    if cache is None or not attrs or _has_composite(attrs):
+        plan = _compile(parse(attrs, tree=tree, **context))
+    else:
+        resolved = resolve(attrs)
+        key = plan_key(attrs, tree, resolved, context)
+        plan = None
+
+        if key is not None:
+            plan = cache.get(key)
+
+        if plan is None:
+            plan = _compile(_parse(attrs, resolved, tree=tree, **context))
+
+            if key is not None:
+                cache.set(key, plan)
+
+    condition, annotations, extra, empty = plan
+
+    return CompiledNode(attrs, condition=condition, annotations=annotations,
+                        extra=extra, empty=empty, tree=tree, **context)
+
+
+def _compile(node):
+    "Returns the query modifiers of the optimized node."
+    node = _optimize(node)
+
+    if settings.QUERY_SEMIJOIN_ENABLED:
+        condition = semijoin_condition(node)
+    else:
+        condition = node.condition
+
+    return (condition, node.annotations, node.extra, node.empty)
+
+
+def _optimize(node):
+    if not settings.QUERY_OPTIMIZER_ENABLED:
+        return node
+    return optimize(node)
+
+
+# Operators of the conditions that bound the values of a field
+LOWER_BOUNDS = {'gt': False, 'gte': True}
+UPPER_BOUNDS = {'lt': False, 'lte': True}
+BOUND_OPERATORS = ('gt', 'gte', 'lt', 'lte', 'range')
+
+# Simple types whose cleaned values are compared by the optimizer. Strings
+# are excluded since their comparison depends on the database collation.
+ORDERED_TYPES = ('number', 'date', 'datetime', 'time')
+
+
+def optimize(node):
+    """Returns a tree equivalent to the parsed `node` which is cheaper to
+    query. Nested branches of the same type are flattened, duplicate
+    conditions are removed, bounds on the same field are merged in `and`
+    branches and `exact` conditions on the same field are collapsed into an
+    `in` condition in `or` branches. Contradicting conditions produce an
+    `Empty` node, so the tree is applied as `none()` without a query.
+    """
+    if not isinstance(node, Branch):
+        return node
+
+    children = []
+    empty = False
+
+    for child in node.children:
+        child = optimize(child)
+
+        if child.empty:
+            # A contradiction in an `and` branch applies to all of it
+            if node.type == AND:
+                return Empty(tree=node.tree, **node.context)
+
+            empty = True
+        elif isinstance(child, Branch) and child.type == node.type:
+            children.extend(child.children)
+        # Disabled nodes do not contribute to the condition
+        elif type(child) is not Node:
+            children.append(child)
+
+    children = _remove_duplicates(children)
+
+    if node.type == AND:
+        children = _merge_bounds(children)
+
+        if children is None:
+            return Empty(tree=node.tree, **node.context)
+    else:
+        children = _collapse_exact(children)
+
+    if not children:
+        if empty:
+            return Empty(tree=node.tree, **node.context)
+        return Node(tree=node.tree, **node.context)
+
+    if len(children) == 1:
+        return children[0]
+
+    branch = Branch(type=node.type, tree=node.tree, **node.context)
+    branch.children = children
+
+    return branch
+
+
+def _node_key(node):
+    """Returns a hashable key which is equal for equivalent nodes or None
+    if the node cannot be compared.
+    """
+    if isinstance(node, Condition):
+        try:
+            value = json.dumps(node.value, sort_keys=True)
+        except (TypeError, ValueError):
+            return
+
+        return (node.field.pk, node.operator, value)
+
+    if isinstance(node, Branch):
+        keys = [_node_key(child) for child in node.children]
+
+        if None in keys:
+            return
+
+        return (node.type, frozenset(keys))
+
+
+def _remove_duplicates(children):
+    keys = set()
+    unique = []
+
+    for child in children:
+        key = _node_key(child)
+
+        if key is not None:
+            if key in keys:
+                continue
+
+            keys.add(key)
+
+        unique.append(child)
+
+    return unique
+
+
+def _derive(node, operator, value):
+    "Returns a condition on the field of `node` for the operator and value."
+    condition = Condition(operator=operator, value=value,
+                          field=node.field_key, concept=node.concept_key,
+                          tree=node.tree, **node.context)
+
+    condition._field = node.field
+    condition._concept = node.concept
+
+    return condition
+
+
+def _is_plain(node):
+    "Returns true if the condition only modifies the queryset's filter."
+    return not node.annotations and not node.extra
+
+
+def _merge_bounds(children):
+    """Merges the bounds and exact values on each ordered field into the
+    tightest bounds. Returns None if the conditions on any field
+    contradict each other.
+    """
+    fields = {}
+
+    for child in children:
+        if isinstance(child, Condition) and \
+                child.operator in BOUND_OPERATORS + ('exact',) and \
+                child.field.simple_type in ORDERED_TYPES:
+            fields.setdefault(child.field.pk, []).append(child)
+
+    merged = {}
+
+    for pk, nodes in fields.items():
+        if len(nodes) < 2 or not all(_is_plain(n) for n in nodes):
+            continue
+
+        # Bounds are (value, inclusive, node)
+        lower = []
+        upper = []
+        exact = set()
+
+        for node in nodes:
+            value = node._meta['cleaned_data']['value']
+
+            if node.operator == 'exact':
+                exact.add(value)
+            elif node.operator == 'range':
+                lower.append((value[0], True, node))
+                upper.append((value[1], True, node))
+            elif node.operator in LOWER_BOUNDS:
+                lower.append((value, LOWER_BOUNDS[node.operator], node))
+            else:
+                upper.append((value, UPPER_BOUNDS[node.operator], node))
+
+        if None in exact:
+            continue
+
+        # Exclusive bounds are tighter for equal values
+        low = max(lower, key=lambda b: (b[0], not b[1])) if lower else None
+        high = min(upper, key=lambda b: (b[0], b[1])) if upper else None
+
+        if len(exact) > 1:
+            return
+
+        if low and high and (low[0] > high[0] or
+                             (low[0] == high[0] and
+                              not (low[1] and high[1]))):
+            return
+
+        if exact:
+            value = list(exact)[0]
+
+            if low and (value < low[0] or
+                        (value == low[0] and not low[1])):
+                return
+
+            if high and (value > high[0] or
+                         (value == high[0] and not high[1])):
+                return
+
+            # The exact value is within the bounds
+            continue
+
+        nodes = []
+
+        if low and high and low[2] is high[2]:
+            nodes.append(low[2])
+        else:
+            if low:
+                if low[2].operator == 'range':
+                    nodes.append(_derive(low[2], 'gte', low[0]))
+                else:
+                    nodes.append(low[2])
+
+            if high:
+                if high[2].operator == 'range':
+                    nodes.append(_derive(high[2], 'lte', high[0]))
+                else:
+                    nodes.append(high[2])
+
+        merged[pk] = nodes
+
+    if not merged:
+        return children
+
+    optimized = []
+
+    for child in children:
+        if isinstance(child, Condition) and child in fields.get(
+                child.field.pk, ()) and child.field.pk in merged:
+            # The merged conditions take the place of the first one
+            optimized.extend(merged[child.field.pk])
+            merged[child.field.pk] = ()
+        else:
+            optimized.append(child)
+
+    return optimized
+
+
+def _collapse_exact(children):
+    "Collapses the `exact` and `in` conditions on each field into `in`."
+    fields = {}
+
+    for child in children:
+        if isinstance(child, Condition) and \
+                child.operator in ('exact', 'in'):
+            fields.setdefault(child.field.pk, []).append(child)
+
+    collapsed = {}
+
+    for pk, nodes in fields.items():
+        if len(nodes) < 2 or 'in' not in dict(nodes[0].field.operators):
+            continue
+
+        values = []
+
+        for node in nodes:
+            if node.operator == 'in' and isinstance(node.value, list):
+                values.extend(node.value)
+            else:
+                values.append(node.value)
+
+        collapsed[pk] = _derive(nodes[0], 'in', values)
+
+    if not collapsed:
+        return children
+
+    optimized = []
+
+    for child in children:
+        if isinstance(child, Condition) and child in fields.get(
+                child.field.pk, ()) and child.field.pk in collapsed:
+            # The collapsed condition takes the place of the first one
+            if collapsed[child.field.pk] is not None:
+                optimized.append(collapsed[child.field.pk])
+                collapsed[child.field.pk] = None
+        else:
+            optimized.append(child)
+
+    return optimized
+
+
+def multivalued_joins(query):
+    """Returns the aliases of the joins in the query which may produce more
+    than one row per row of the model, i.e. the joins across many-to-many
+    and reverse foreign key relationships. Additional tables are joined
+    without a condition, so they are always considered multi-valued.
+    """
+    aliases = list(query.extra_tables)
+
+    for alias, join in query.alias_map.items():
+        if not query.alias_refcount.get(alias):
+            continue
+
+        if _multivalued_join(join):
+            aliases.append(alias)
+
+    return aliases
+
+
+# Map of (table, column) to whether the column is unique, used to determine
+# multi-valued joins prior to Django 1.6. It is reset when a model is loaded.
+_unique_columns = None
+
+
+def _reset_unique_columns(**kwargs):
+    global _unique_columns
+    _unique_columns = None
+
+
+models.signals.class_prepared.connect(_reset_unique_columns)
+
+
+def _get_unique_columns():
+    global _unique_columns
+
+    if _unique_columns is None:
+        columns = {}
+
+        for model in models.get_models(include_auto_created=True):
+            for field in model._meta.local_fields:
+                columns[(model._meta.db_table, field.column)] = field.unique
+
+        _unique_columns = columns
+
+    return _unique_columns
+
+
+def _multivalued_join(join):
+    if django.VERSION < (1, 6):
+        # Only the columns of the join are known, so the join is multi-valued
+        # unless it is made on a unique column of the joined table. The base
+        # table has no join column.
+        if join.lhs_alias is None:
+            return False
+
+        unique = _get_unique_columns().get(
+            (join.table_name, join.rhs_join_col))
+
+        return not unique
+
+    from django.db.models.fields.related import ForeignObjectRel
+
+    # Reverse joins are made on the relation of the foreign key which
+    # is only single-valued for one-to-one relationships
+    return isinstance(join.join_field, ForeignObjectRel) and \
+        not join.join_field.field.unique
+
+
+def needs_distinct(queryset):
+    """Returns true if the queryset may return duplicate rows. This is the
+    case if it joins across multi-valued relationships or, for values
+    querysets, if the primary key is not selected.
+    """
+    if multivalued_joins(queryset.query):
+        return True
+
+    fields = getattr(queryset, '_fields', None)
+
+    if fields:
+        pk = queryset.model._meta.pk
+        return not set(fields) & set(['pk', pk.name, pk.attname])
+
+    return False
+
+
+def fanout_path(tree, model):
+    """Returns the query path from the root model of the tree up to the
+    first multi-valued relationship on the way to `model`, or None if every
+    relationship is single-valued.
+    """
+    tree = trees[tree]
+    names = []
+
+    for node in tree._node_path(model) or ():
+        names.append(node.related_name)
+
+        if node.relation == 'manytomany' or \
+                (node.relation == 'foreignkey' and node.reverse):
+            return '__'.join(names)
+
+
+def _fanouts(node, cache):
+    "Returns the set of fanout paths the conditions of the node are on."
+    if node not in cache:
+        if isinstance(node, Condition):
+            path = fanout_path(node.tree, node.field.model)
+            cache[node] = frozenset([path] if path else [])
+        elif isinstance(node, Branch):
+            cache[node] = frozenset().union(
+                *[_fanouts(child, cache) for child in node.children])
+        else:
+            cache[node] = frozenset()
+
+    return cache[node]
+
+
+def semijoin_condition(node, blocked=frozenset(), cache=None):
+    """Returns the condition of the node with the conditions on fields across
+    multi-valued relationships grouped by their fanout path. Each group is
+    compiled into a single `pk__in` subquery on the root model, so the root
+    rows are not multiplied by the joined rows.
+
+    Within a single filter, Django joins each path once, so all conditions
+    on a path apply to the same related row. A group is therefore only
+    formed in the branch whose children contain every condition on the path
+    and only if none of those children are on other paths as well. Paths
+    that are shared by such children are `blocked` for the whole subtree.
+    """
+    if not isinstance(node, Branch):
+        return node.condition
+
+    if cache is None:
+        cache = {}
+
+    groups = {}
+    blocked = set(blocked)
+
+    for path in _fanouts(node, cache):
+        children = [c for c in node.children if path in _fanouts(c, cache)]
+
+        if path in blocked:
+            continue
+
+        if all(_fanouts(c, cache) == frozenset([path]) for c in children):
+            groups[path] = children
+        # Conditions on a path shared with other paths within a single child
+        # are grouped within that child
+        elif len(children) > 1:
+            blocked.add(path)
+
+    blocked = frozenset(blocked)
+    condition = None
+
+    for child in node.children:
+        paths = _fanouts(child, cache)
+
+        if len(paths) == 1 and list(paths)[0] in groups:
+            children = groups[list(paths)[0]]
+
+            # The subquery takes the place of the first child in the group
+            if child is not children[0]:
+                continue
+
+            child_condition = _subquery_condition(node, children)
+        else:
+            child_condition = semijoin_condition(child, blocked, cache)
+
+        if child_condition:
+            if condition:
+                condition = node._combine(child_condition, condition)
+            else:
+                condition = child_condition
+
+    return condition
+
+
+def _subquery_condition(branch, children):
+    condition = None
+
+    for child in children:
+        if child.condition:
+            if condition:
+                condition = branch._combine(child.condition, condition)
+            else:
+                condition = child.condition
+
+    if not condition:
+        return
+
+    model = trees[branch.tree].root_model
+    queryset = model._base_manager.filter(condition).values('pk')
+
+    return models.Q(pk__in=queryset)
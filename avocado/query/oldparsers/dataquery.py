@@ -11,8 +11,18 @@ class Node(object):
         self.dataview_node = dataview_node
 
     def apply(self, queryset=None, distinct=True, include_pk=True):
-        queryset = \
-            self.datacontext_node.apply(queryset=queryset, distinct=distinct)
+        # The context only applies distinct if its joins may duplicate rows.
+        # Without the primary key, rows with equal values must be removed
+        # and the joins of the view may duplicate rows as well.
+        force = distinct and \
+            (not include_pk or self.dataview_node.multivalued())
+
+        queryset = self.datacontext_node.apply(
+            queryset=queryset, distinct=distinct and not force)
+
+        if force:
+            queryset = queryset.distinct()
+
         return \
             self.dataview_node.apply(queryset=queryset, include_pk=include_pk)
 
@@ -40,7 +50,8 @@ def parse(attrs, tree=None, **context):
 
     datacontext_attrs = attrs.get('context', {})
     datacontext_node = \
-        datacontext_parser.parse(datacontext_attrs, tree=tree, **context)
+        datacontext_parser.compile_node(datacontext_attrs, tree=tree,
+                                        **context)
 
     dataview_attrs = attrs.get('view', {})
     dataview_node = \
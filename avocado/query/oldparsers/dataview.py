@@ -159,6 +159,22 @@ class Node(object):
 
         return queryset
 
+    def multivalued(self):
+        """Returns true if any of the fields selected or ordered by are
+        across a multi-valued relationship of the tree, in which case the
+        view may duplicate the rows of the root model.
+        """
+        from .datacontext import fanout_path
+
+        ids = list(self.concept_ids) + [c for c, s in self.ordering]
+
+        for fields in self._get_fields_for_concepts(ids).values():
+            for f in fields:
+                if fanout_path(self.tree, f.model):
+                    return True
+
+        return False
+
     # Additional public methods for general use and interrogation
     def get_concepts_for_select(self):
         return self._get_concepts(self.concept_ids)
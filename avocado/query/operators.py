@@ -64,7 +64,7 @@ class ContainerTypeOperator(BaseOperator):
         return hasattr(value, '__iter__')
 
     def text(self, value):
-        value = map(self.coerce_to_unicode, value)
+        value = list(value)
         length = len(value)
 
         if length == 1:
@@ -72,15 +72,13 @@ class ContainerTypeOperator(BaseOperator):
                 name = NotExact.verbose_name
             else:
                 name = Exact.verbose_name
-            return u'{0} {1}'.format(name, value[0])
+            return u'{0} {1}'.format(name, self.coerce_to_unicode(value[0]))
 
-        last = value.pop()
+        # Only the values that are displayed are coerced
+        last = self.coerce_to_unicode(value.pop())
         length -= 1
 
-        if length > self.max_list_size:
-            head = value[:self.max_list_size]
-        else:
-            head = value
+        head = map(self.coerce_to_unicode, value[:self.max_list_size])
 
         text = '{0} {1}'.format(self.verbose_name, ', '.join(head))
 
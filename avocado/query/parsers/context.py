@@ -4,7 +4,8 @@ from avocado.query import operators
 from avocado.query.validators import Validator, FieldValidator
 from avocado.models import DataContext
 
-__all__ = ('BranchParser', 'ConditionParser', 'CompositeParser', 'TreeParser')
+__all__ = ('BranchParser', 'ConditionParser', 'CompositeParser', 'TreeParser',
+           'apply_patch')
 
 
 BRANCH_TYPES = ('and', 'or')
@@ -46,6 +47,147 @@ def get_parser(data):
         return BranchParser
 
 
+def parse(data, reuse=None, **context):
+    """Returns a validated parser for the node or None if the node is not
+    recognized. If `reuse` contains a parser of this same node object, it is
+    returned rather than validating the node again.
+    """
+    if reuse:
+        match = reuse.get(id(data))
+
+        if match is not None and match[0] is data:
+            return match[1]
+
+    parser_class = get_parser(data)
+
+    if not parser_class:
+        return
+
+    parser = parser_class(data, **context)
+    parser.reuse = reuse
+    parser.is_valid()
+    parser.reuse = None
+
+    return parser
+
+
+def _parse_pointer(path):
+    "Returns the list of reference tokens of a JSON pointer."
+    if path == '':
+        return []
+
+    if not isinstance(path, basestring) or not path.startswith('/'):
+        raise ValueError('Invalid JSON pointer: {0!r}'.format(path))
+
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in path[1:].split('/')]
+
+
+def _get_key(container, token, insert=False):
+    "Returns the key or index of the token in the container."
+    if isinstance(container, dict):
+        if not insert and token not in container:
+            raise ValueError('Key not found: {0!r}'.format(token))
+        return token
+
+    if not isinstance(container, list):
+        raise ValueError('Cannot index a {0}'.format(type(container)))
+
+    if insert and token == '-':
+        return len(container)
+
+    try:
+        index = int(token)
+    except ValueError:
+        raise ValueError('Invalid list index: {0!r}'.format(token))
+
+    upper = len(container) if insert else len(container) - 1
+
+    if not 0 <= index <= upper:
+        raise ValueError('List index out of range: {0}'.format(index))
+
+    return index
+
+
+def _get(doc, tokens):
+    for token in tokens:
+        doc = doc[_get_key(doc, token)]
+    return doc
+
+
+def _update(doc, tokens, op, value=None):
+    """Returns a copy of the document with the operation applied to the
+    location of the tokens. Only the containers along the path are copied,
+    the rest of the document is shared with the original.
+    """
+    if not tokens:
+        if op == 'remove':
+            raise ValueError('The document root cannot be removed')
+        return value
+
+    root = parent = _copy(doc)
+
+    for token in tokens[:-1]:
+        key = _get_key(parent, token)
+        parent[key] = _copy(parent[key])
+        parent = parent[key]
+
+    key = _get_key(parent, tokens[-1], insert=(op == 'add'))
+
+    if op == 'remove':
+        del parent[key]
+    elif op == 'add' and isinstance(parent, list):
+        parent.insert(key, value)
+    else:
+        parent[key] = value
+
+    return root
+
+
+def _copy(container):
+    if isinstance(container, dict):
+        return dict(container)
+    if isinstance(container, list):
+        return list(container)
+    raise ValueError('Cannot index a {0}'.format(type(container)))
+
+
+def apply_patch(data, patch):
+    """Applies a JSON patch (RFC 6902) to the context data. The data is not
+    changed, a patched copy is returned which shares all nodes untouched by
+    the patch with the original data.
+    """
+    for operation in patch:
+        op = operation.get('op')
+        tokens = _parse_pointer(operation.get('path'))
+
+        if op in ('add', 'replace'):
+            if 'value' not in operation:
+                raise ValueError('The {0} operation requires a value'
+                                 .format(op))
+            if op == 'replace':
+                _get(data, tokens)
+            data = _update(data, tokens, op, operation['value'])
+        elif op == 'remove':
+            data = _update(data, tokens, op)
+        elif op in ('move', 'copy'):
+            source = _parse_pointer(operation.get('from'))
+            value = _get(data, source)
+            if op == 'move':
+                if tokens[:len(source)] == source and tokens != source:
+                    raise ValueError('A value cannot be moved into itself')
+                data = _update(data, source, 'remove')
+            data = _update(data, tokens, 'add', value)
+        elif op == 'test':
+            if _get(data, tokens) != operation.get('value'):
+                raise ValueError('Test failed for path {0!r}'
+                                 .format(operation['path']))
+        else:
+            raise ValueError('Invalid patch operation: {0!r}'.format(op))
+
+    return data
+
+
 class BranchParser(Validator):
     "Parser and validator for context branch nodes."
 
@@ -63,6 +205,9 @@ class BranchParser(Validator):
 
     fields = ('type', 'children')
 
+    # Parsers of previously validated nodes that may be reused
+    reuse = None
+
     def validate_type(self):
         "Validates the branch type."
         branch_type = self.data.get('type', '').lower()
@@ -79,13 +224,18 @@ class BranchParser(Validator):
         children = self.data.get('children')
         cleaned_children = []
 
+        # Parsers aligned with the children, None for invalid children
+        self.child_parsers = []
+
         if children:
             for child in children:
-                parser = get_parser(child)
+                parser = parse(child, self.reuse, **self.context)
+                self.child_parsers.append(parser)
+
                 if not parser:
                     self.warn('invalid_child')
                     continue
-                cleaned_children.append(parser(child, **self.context))
+                cleaned_children.append(parser)
         else:
             self.warn('empty_branch')
         return cleaned_children
@@ -116,8 +266,12 @@ class ConditionParser(FieldValidator):
         if not field:
             return
 
+        value = self.data.get('value')
+
         try:
-            return field.to_python(self.data.get('value'))
+            if isinstance(value, (list, tuple)):
+                return [field.field.to_python(x) for x in value]
+            return field.field.to_python(value)
         except ValidationError:
             self.error('invalid_value_type')
 
@@ -131,7 +285,7 @@ class ConditionParser(FieldValidator):
         operator = self.data.get('operator')
 
         # Check if this is a valid operator for the field
-        if operator not in field.operators:
+        if operator not in field.prepared_translator.allowed_operators:
             self.error('invalid_operator')
 
         # Double check this is also registered (in case the above
@@ -190,9 +344,48 @@ class TreeParser(Validator):
         'invalid': 'invalid data',
     }
 
+    # Parsers of previously validated nodes that may be reused
+    reuse = None
+
+    def __init__(self, data, **context):
+        super(TreeParser, self).__init__(data, **context)
+        self.source = data
+
     def validate(self):
-        parser = get_parser(self.data)
+        parser = parse(self.source, self.reuse, **self.context)
+        self.reuse = None
+
         if parser:
-            self.cleaned_data['tree'] = parser(self.data, **self.context)
+            self.cleaned_data['tree'] = parser
         else:
             self.error('invalid')
+
+    def _node_parsers(self):
+        "Returns the parsers of the validated nodes keyed by the node."
+        parsers = {}
+        stack = [(self.source, self.cleaned_data.get('tree'))]
+
+        while stack:
+            data, parser = stack.pop()
+
+            if parser is None:
+                continue
+
+            parsers[id(data)] = (data, parser)
+
+            if isinstance(parser, BranchParser):
+                stack.extend(zip(data.get('children') or (),
+                                 getattr(parser, 'child_parsers', ())))
+
+        return parsers
+
+    def patch(self, patch):
+        """Returns a new parser of the tree with the JSON patch applied.
+        When it is validated, only the nodes changed by the patch and the
+        branches containing them are validated again. The parsers of the
+        untouched nodes are reused.
+        """
+        parser = self.__class__(apply_patch(self.source, patch),
+                                **self.context)
+        parser.reuse = self._node_parsers()
+        return parser
@@ -1,4 +1,14 @@
+import sys
+import uuid
+from contextlib import contextmanager
+from functools import partial
+import django
+from django.conf import settings as django_settings
+from django.db import connections
 from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.constants import MULTI
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import six
 from django.utils.importlib import import_module
 from modeltree.tree import trees
 from avocado.formatters import RawFormatter
@@ -7,6 +17,280 @@ from avocado.conf import settings
 
 QUERY_PROCESSOR_DEFAULT_ALIAS = 'default'
 
+# Aliases of the columns used to select the first of the duplicate rows
+ROW_NUMBER_ALIAS = '_avocado_row_number'
+ROW_POSITION_ALIAS = '_avocado_row_position'
+
+
+def supports_window_functions(connection):
+    "Returns true if the database supports the `ROW_NUMBER` window function."
+    if connection.vendor == 'postgresql':
+        return True
+
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25)
+
+    if connection.vendor == 'mysql':
+        from avocado.query.utils import ensure_connection
+
+        ensure_connection(connection)
+        return connection.mysql_version >= (8, 0, 2)
+
+    return False
+
+
+def _get_columns(compiler):
+    "Returns the columns of the compiled query and their params."
+    if django.VERSION < (1, 6):
+        return compiler.get_columns(), []
+
+    return compiler.get_columns()
+
+
+def _get_ordering(compiler):
+    "Returns the ORDER BY expressions of the compiled query and their params."
+    if django.VERSION < (1, 6):
+        ordering, group_by = compiler.get_ordering()
+        return ordering, []
+
+    ordering, params, group_by = compiler.get_ordering()
+    return ordering, list(params) + list(compiler.ordering_params)
+
+
+def distinct_compiler(queryset, length, offset=None, limit=None):
+    """Returns a compiler of the queryset that returns only the first of the
+    rows that are equal in their first `length` columns, in the order of the
+    queryset. The offset and limit apply to the distinct rows. Two columns
+    used to select the rows are prepended to each row.
+
+    None is returned if the database does not support window functions or
+    the columns or ordering cannot be referenced in one.
+    """
+    connection = connections[queryset.db]
+
+    if not supports_window_functions(connection):
+        return
+
+    # The column and ordering expressions are determined from a compiled
+    # copy of the query. They do not change when the window columns are
+    # added since those do not require any joins.
+    compiler = queryset.query.clone().get_compiler(queryset.db)
+    compiler.as_sql(with_limits=False)
+
+    columns, params = _get_columns(compiler)
+    ordering, ordering_params = _get_ordering(compiler)
+
+    if (params or ordering_params or ordering_aliases(compiler) or
+            not ordering or len(columns) < length or
+            compiler.query.extra_select or compiler.query.aggregate_select):
+        return
+
+    partition = ', '.join(columns[:length])
+    ordering = ', '.join(ordering)
+
+    query = queryset.query.clone()
+    query.clear_limits()
+    query.add_extra({
+        ROW_NUMBER_ALIAS: 'ROW_NUMBER() OVER (PARTITION BY {0} ORDER BY {1})'
+                          .format(partition, ordering),
+        ROW_POSITION_ALIAS: 'ROW_NUMBER() OVER (ORDER BY {0})'
+                            .format(ordering),
+    }, None, None, None, None, None)
+    query.set_extra_mask([ROW_NUMBER_ALIAS, ROW_POSITION_ALIAS])
+
+    compiler = query.get_compiler(queryset.db)
+    inner_as_sql = compiler.as_sql
+    qn = connection.ops.quote_name
+
+    def as_sql(*args, **kwargs):
+        # The columns of the derived table must have unique names, so
+        # columns of the same name in different tables are aliased.
+        sql, params = inner_as_sql(with_limits=False, with_col_aliases=True)
+
+        sql = ['SELECT * FROM ({0}) AS {1} WHERE {2} = 1 ORDER BY {3}'.format(
+            sql, qn('_avocado_rows'), qn(ROW_NUMBER_ALIAS),
+            qn(ROW_POSITION_ALIAS))]
+
+        if limit:
+            sql.append('LIMIT %d' % limit)
+
+        if offset:
+            if not limit:
+                no_limit = connection.ops.no_limit_value()
+
+                if no_limit:
+                    sql.append('LIMIT %d' % no_limit)
+
+            sql.append('OFFSET %d' % offset)
+
+        return ' '.join(sql), params
+
+    compiler.as_sql = as_sql
+
+    return compiler
+
+
+def ordering_aliases(compiler):
+    "Returns the columns the compiled query only selects for ordering."
+    if django.VERSION < (1, 6):
+        return compiler.query.ordering_aliases
+
+    return compiler.ordering_aliases
+
+
+class ServerSideCursor(object):
+    """Wraps the cursor of a database driver so its errors are raised as
+    Django database errors. If a transaction was begun for the cursor, it
+    is ended and autocommit is restored when the cursor is closed.
+    """
+    def __init__(self, connection, cursor, autocommit=False):
+        self.connection = connection
+        self.cursor = cursor
+        self.autocommit = autocommit
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def execute(self, sql, params=None):
+        with wrap_database_errors(self.connection):
+            return self.cursor.execute(sql, params)
+
+    def fetchmany(self, size):
+        with wrap_database_errors(self.connection):
+            return self.cursor.fetchmany(size)
+
+    def close(self):
+        try:
+            with wrap_database_errors(self.connection):
+                self.cursor.close()
+        finally:
+            if self.autocommit:
+                # The rows are only read, so the transaction is rolled back
+                with wrap_database_errors(self.connection):
+                    self.connection.connection.rollback()
+
+                set_autocommit(self.connection, True)
+
+
+@contextmanager
+def wrap_database_errors(connection):
+    "Raises the errors of the database driver as Django database errors."
+    if django.VERSION >= (1, 6):
+        with connection.wrap_database_errors:
+            yield
+        return
+
+    from django.db import utils
+
+    Database = sys.modules[type(connection).__module__].Database
+
+    try:
+        yield
+    except Database.IntegrityError as e:
+        six.reraise(utils.IntegrityError, utils.IntegrityError(*e.args),
+                    sys.exc_info()[2])
+    except Database.DatabaseError as e:
+        six.reraise(utils.DatabaseError, utils.DatabaseError(*e.args),
+                    sys.exc_info()[2])
+
+
+def set_autocommit(connection, autocommit):
+    "Sets the autocommit mode of the connection to the database."
+    if django.VERSION < (1, 6):
+        connection.connection.autocommit = autocommit
+    else:
+        connection.set_autocommit(autocommit)
+
+
+def server_side_cursor(connection):
+    """Returns a cursor that fetches the rows from the database as they are
+    requested rather than buffering the whole result set in memory. This is
+    a named cursor on PostgreSQL and an unbuffered cursor on MySQL. Other
+    backends return a regular cursor.
+    """
+    from avocado.query.utils import ensure_connection
+
+    ensure_connection(connection)
+
+    if connection.vendor == 'postgresql':
+        from django.db.backends.postgresql_psycopg2.base import \
+            utc_tzinfo_factory
+
+        # Named cursors only live for the duration of a transaction. A
+        # cursor held open in autocommit mode would only return the first
+        # row once the whole result set is built, so a transaction is begun
+        # for the cursor instead.
+        autocommit = connection.connection.autocommit
+
+        if autocommit:
+            set_autocommit(connection, False)
+
+        try:
+            with wrap_database_errors(connection):
+                cursor = connection.connection.cursor(
+                    name='avocado_{0}'.format(uuid.uuid4().hex))
+        except Exception:
+            if autocommit:
+                set_autocommit(connection, True)
+            raise
+
+        cursor.tzinfo_factory = utc_tzinfo_factory \
+            if django_settings.USE_TZ else None
+
+        return ServerSideCursor(connection, cursor, autocommit=autocommit)
+
+    if connection.vendor == 'mysql':
+        from MySQLdb.cursors import SSCursor
+
+        with wrap_database_errors(connection):
+            cursor = connection.connection.cursor(SSCursor)
+
+        return ServerSideCursor(connection, cursor)
+
+    return connection.cursor()
+
+
+def stream_sql(compiler, result_type=MULTI, batch_size=None):
+    """Replacement of `SQLCompiler.execute_sql` which yields the rows in
+    batches of `batch_size` from a server-side cursor. The query is only
+    executed once the first batch is requested and the cursor is closed
+    when the rows are exhausted or the iterator is closed.
+    """
+    if result_type != MULTI:
+        raise ValueError('Only multiple results can be streamed')
+
+    try:
+        sql, params = compiler.as_sql()
+        if not sql:
+            raise EmptyResultSet
+    except EmptyResultSet:
+        return
+
+    if not batch_size:
+        batch_size = settings.QUERY_STREAMING_BATCH_SIZE
+
+    # Columns only selected for ordering are trimmed from the rows
+    trim = len(ordering_aliases(compiler))
+
+    cursor = server_side_cursor(compiler.connection)
+
+    try:
+        cursor.execute(sql, params)
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+
+            if not rows:
+                break
+
+            if trim:
+                rows = [row[:-trim] for row in rows]
+
+            yield rows
+    finally:
+        cursor.close()
+
 
 class QueryProcessor(object):
     """Prepares and builds a QuerySet for export.
@@ -25,6 +309,16 @@ class QueryProcessor(object):
         if self.context:
             queryset = self.context.apply(queryset=queryset, tree=self.tree)
 
+        # The context only applies distinct if its joins may duplicate rows.
+        # Without the primary key, rows with equal values must be removed
+        # and the joins of the view may duplicate rows as well.
+        if not self.include_pk or (
+                self.view and self.view.parse(tree=self.tree).multivalued()):
+            if queryset is None:
+                queryset = trees[self.tree].get_queryset()
+
+            queryset = queryset.distinct()
+
         if self.view:
             queryset = self.view.apply(queryset=queryset, tree=self.tree,
                                        include_pk=self.include_pk)
@@ -48,8 +342,14 @@ class QueryProcessor(object):
 
         return exporter
 
-    def get_iterable(self, offset=None, limit=None, queryset=None, **kwargs):
-        "Returns an iterable that can be used by an exporter."
+    def get_iterable(self, offset=None, limit=None, queryset=None,
+                     stream=None, **kwargs):
+        """Returns an iterable that can be used by an exporter.
+
+        If `stream` is true, the rows are fetched in batches from a
+        server-side cursor as they are iterated. It defaults to the
+        `QUERY_STREAMING_ENABLED` setting.
+        """
         if queryset is None:
             queryset = self.get_queryset(**kwargs)
 
@@ -67,6 +367,57 @@ class QueryProcessor(object):
 
         compiler = queryset.query.get_compiler(queryset.db)
 
+        return self._results_iter(compiler, stream)
+
+    def get_distinct_iterable(self, length, offset=None, limit=None,
+                              queryset=None, stream=None, **kwargs):
+        """Returns an iterable of the rows that are distinct in their first
+        `length` columns, keeping the first of the equal rows in order. This
+        is used when columns are selected for ordering only. Unlike removing
+        the duplicate rows as they are read, the offset and limit are
+        applied by the database.
+
+        None is returned if the database does not support the window
+        functions used to remove the duplicate rows. Errors of the query are
+        raised as the rows are read.
+        """
+        if queryset is None:
+            queryset = self.get_queryset(**kwargs)
+
+        if isinstance(queryset, EmptyQuerySet):
+            return iter(())
+
+        # The primary key is the first column. If the view does not span a
+        # multi-valued relationship, each row is for a distinct object.
+        if self.include_pk and length and not (
+                self.view and self.view.parse(tree=self.tree).multivalued()):
+            return self.get_iterable(offset=offset, limit=limit,
+                                     queryset=queryset, stream=stream)
+
+        # Whether the database supports window functions is checked before
+        # the query is executed, so a failing query is not retried on a
+        # connection whose transaction may have been aborted.
+        try:
+            compiler = distinct_compiler(queryset, length, offset=offset,
+                                         limit=limit)
+        except EmptyResultSet:
+            return iter(())
+
+        if compiler is None:
+            return
+
+        rows = self._results_iter(compiler, stream)
+
+        # Trim the columns used to select the rows
+        return (row[2:] for row in rows)
+
+    def _results_iter(self, compiler, stream=None):
+        if stream is None:
+            stream = settings.QUERY_STREAMING_ENABLED
+
+        if stream:
+            compiler.execute_sql = partial(stream_sql, compiler)
+
         return compiler.results_iter()
 
 
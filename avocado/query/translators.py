@@ -1,17 +1,115 @@
+import threading
 from django import forms
 from django.db import models
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
+from django.utils.encoding import smart_unicode
 from modeltree.tree import trees
 from avocado.core import loader
+from avocado.core.cache.proxy import LocalCache
 from avocado.conf import settings
 from avocado.core.utils import get_form_class
+from .lookups import ValuesSubquery
 from .operators import registry as operators
 
 
 OPERATORS = settings.OPERATORS
 INTERNAL_DATATYPE_FORMFIELDS = settings.INTERNAL_DATATYPE_FORMFIELDS
 
+# Form fields whose values can be converted as a whole list rather than
+# cleaned one at a time. The conversion must match the `to_python` method of
+# the form field and raise a `ValueError` or `TypeError` for any value it
+# would reject.
+BULK_CONVERSIONS = {
+    forms.IntegerField: lambda x: int(str(x)),
+    forms.FloatField: float,
+    forms.CharField: smart_unicode,
+}
+
+# Types of the values that may be converted in bulk
+BULK_TYPES = (basestring, int, long, float)
+
+_language_caches = {}
+_language_caches_lock = threading.Lock()
+
+
+def get_language_cache():
+    """Returns the in-process cache of rendered condition language or None
+    if it is not enabled.
+    """
+    max_entries = settings.LANGUAGE_CACHE_MAX_ENTRIES
+
+    if not max_entries:
+        return
+
+    with _language_caches_lock:
+        if max_entries not in _language_caches:
+            _language_caches[max_entries] = LocalCache(max_entries)
+
+        return _language_caches[max_entries]
+
+
+def _value_key(value):
+    """Returns a hashable key of a cleaned value. A `TypeError` is raised if
+    the value cannot be keyed.
+    """
+    if isinstance(value, models.Model):
+        return (value.__class__, value.pk)
+
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_value_key(x) for x in value))
+
+    if isinstance(value, QuerySet):
+        raise TypeError('QuerySets are not keyed')
+
+    # The type distinguishes values that are equal but rendered differently
+    hash(value)
+    return (type(value), value)
+
+
+class PreparedTranslator(object):
+    """A translator bound to a `DataField` instance. The lookups a
+    translation depends on that only vary by field are resolved once:
+    the form class used for validation, the allowed operators and the
+    internal and simple types of the field.
+    """
+    def __init__(self, translator, field):
+        self.translator = translator
+        self.name = field.translator
+        self.internal_type = field.internal_type
+        self.simple_type = field.simple_type
+        self.is_key = self.simple_type == 'key'
+        self.is_auto = isinstance(field.field, models.AutoField)
+        self.form_class = translator.get_form_class(field)
+
+        operators = tuple(translator.get_operators(field))
+
+        # The operators of the translator itself for display
+        self.field_operators = operators
+
+        # Special case for fields that are nullable
+        if field.field.null:
+            operators += ('isnull', '-isnull')
+
+        # The first operator is the default one
+        self.operators = operators
+        self.allowed_operators = frozenset(operators)
+
+    def normalize(self, value):
+        """Normalizes a cleaned value from some non-primitive type
+        such as a model or queryset instance.
+        """
+        if self.is_key:
+            if isinstance(value, (list, tuple, QuerySet)):
+                return [x.pk if isinstance(x, models.Model) else x
+                        for x in value]
+            return value.pk
+        if isinstance(value, QuerySet):
+            return [x.pk for x in value]
+        if isinstance(value, models.Model):
+            return value.pk
+        return value
+
 
 class Translator(object):
     """Given a `DataField` instance, a raw value and operator, a
@@ -52,16 +150,37 @@ class Translator(object):
         # Determine list of allowed operators
         return self.operators or OPERATORS[field.simple_type]
 
-    def _validate_operator(self, field, uid, **kwargs):
-        # Determine list of allowed operators
-        allowed_operators = self.get_operators(field)
+    def get_form_class(self, field):
+        """Returns the form class used to validate values for the field.
+        If None, the model field's default form class is used.
+        """
+        # Check to see if this translator has a form_class defined or if
+        # there is a custom form_class specified for this datatype
+        if self.form_class:
+            return self.form_class
+
+        for datatype in (field.internal_type, field.simple_type):
+            if datatype in INTERNAL_DATATYPE_FORMFIELDS:
+                return get_form_class(INTERNAL_DATATYPE_FORMFIELDS[datatype])
+
+    def prepare(self, field):
+        """Returns this translator prepared for the field. It is built once
+        and cached on the field instance.
+        """
+        prepared = getattr(field, '_prepared_translator', None)
 
-        # Special case for fields that are nullable
-        if field.field.null:
-            allowed_operators += ('isnull', '-isnull')
+        if prepared is None or prepared.translator is not self or \
+                prepared.name != field.translator:
+            prepared = PreparedTranslator(self, field)
+            field._prepared_translator = prepared
+
+        return prepared
+
+    def _validate_operator(self, field, uid, **kwargs):
+        prepared = self.prepare(field)
 
         # If uid is None, the default operator will be used
-        uid = uid or allowed_operators[0]
+        uid = uid or prepared.operators[0]
 
         # Attempt to retrieve the operator.
         operator = operators.get(uid)
@@ -71,32 +190,31 @@ class Translator(object):
             raise ValidationError(u'"{0}" is not a valid operator'.format(uid))
 
         # Ensure the operator is allowed
-        if operator.uid not in allowed_operators:
+        if operator.uid not in prepared.allowed_operators:
             raise ValidationError(u'Operator "{0}" cannot be used for '
                                   'this translator'.format(operator))
 
         return operator
 
     def _validate_value(self, field, value, **kwargs):
-        # If a form class is not specified, check to see if there is a custom
-        # form_class specified for this datatype or if this translator has
-        # one defined
-        if 'form_class' not in kwargs:
-            if self.form_class:
-                kwargs['form_class'] = self.form_class
-            elif field.internal_type in INTERNAL_DATATYPE_FORMFIELDS:
-                name = INTERNAL_DATATYPE_FORMFIELDS[field.internal_type]
-                kwargs['form_class'] = get_form_class(name)
-            elif field.simple_type in INTERNAL_DATATYPE_FORMFIELDS:
-                name = INTERNAL_DATATYPE_FORMFIELDS[field.simple_type]
-                kwargs['form_class'] = get_form_class(name)
+        prepared = self.prepare(field)
+
+        # If a form class is not specified, use the one resolved for the
+        # field, if any
+        if 'form_class' not in kwargs and prepared.form_class:
+            kwargs['form_class'] = prepared.form_class
 
         # The formfield is being used to clean the value, thus no
         # 'required' validation errors should be raised.
         kwargs['required'] = False
 
+        # Lists of keys are validated in bulk rather than fetching each
+        # instance only for them to be normalized back to keys.
+        if prepared.is_key and hasattr(value, '__iter__'):
+            return self._validate_keys(field, value)
+
         # Special handling for primary keys
-        if isinstance(field.field, models.AutoField):
+        if prepared.is_auto:
             kwargs.pop('form_class', None)
             queryset = field.objects
             if hasattr(value, '__iter__'):
@@ -106,11 +224,6 @@ class Translator(object):
             cleaned_value = formfield.clean(value)
             return cleaned_value
 
-        # If this field is flagged as enumerable, use a select multiple
-        # by default.
-        if field.enumerable and 'widget' not in kwargs:
-            kwargs['widget'] = forms.SelectMultiple(choices=field.choices())
-
         # The model field instance has a convenience method called `formfield`
         # that is suited for the field type
         formfield = field.field.formfield(**kwargs)
@@ -121,6 +234,11 @@ class Translator(object):
         # of them is to lookup NULL values. Note, the None is handled
         # downstream and is contained with the query directly.
         if hasattr(value, '__iter__'):
+            cleaned_value = self._convert_values(formfield, value)
+
+            if cleaned_value is not None:
+                return cleaned_value
+
             cleaned_value = []
             for x in value:
                 if x is not None:
@@ -133,6 +251,79 @@ class Translator(object):
             return cleaned_value
         return formfield.clean(value)
 
+    def _convert_values(self, formfield, values):
+        """Converts a list of values in bulk if supported by the form field.
+        The form field validation and validators, if any, are still run per
+        value. None is returned if the values cannot be converted in bulk, in
+        which case they must be cleaned individually so the form field's
+        error is raised for any invalid value.
+        """
+        convert = BULK_CONVERSIONS.get(type(formfield))
+
+        if convert is None or formfield.localize:
+            return
+
+        for x in values:
+            if x is not None and not isinstance(x, BULK_TYPES):
+                return
+
+        try:
+            cleaned = [x if x is None else convert(x) for x in values]
+        except (ValueError, TypeError):
+            return
+
+        # Same as the remainder of `clean`, e.g. float fields reject NaN and
+        # infinity in `validate`
+        for x in cleaned:
+            if x is not None:
+                formfield.validate(x)
+                formfield.run_validators(x)
+
+        return cleaned
+
+    def _validate_keys(self, field, values):
+        """Validates a list of primary or foreign keys using a single query
+        for the keys that exist. The keys are returned rather than the model
+        instances. None values are passed through.
+        """
+        if isinstance(field.field, models.AutoField):
+            queryset = field.model._default_manager.all()
+            target = field.field
+        else:
+            rel = field.field.rel
+            target = rel.get_related_field()
+
+            # Same choices as the form field of the foreign key
+            queryset = rel.to._default_manager \
+                .complex_filter(rel.limit_choices_to)
+
+        messages = forms.ModelMultipleChoiceField.default_error_messages
+        keys = []
+
+        for x in values:
+            if x is None:
+                keys.append(None)
+                continue
+
+            try:
+                keys.append(target.to_python(x))
+            except ValidationError:
+                raise ValidationError(messages['invalid_pk_value'] %
+                                      {'pk': x})
+
+        lookup = {u'{0}__in'.format(target.name):
+                  set(x for x in keys if x is not None)}
+
+        existing = set(queryset.filter(**lookup)
+                       .values_list(target.name, flat=True))
+
+        for x in keys:
+            if x is not None and x not in existing:
+                raise ValidationError(messages['invalid_choice'] %
+                                      {'value': x})
+
+        return keys
+
     def _get_not_null_pk(self, field, tree):
         """The below logic is required to get the expected results back
         when querying for NULL values. Performing a LEFT OUTER JOIN will
@@ -182,6 +373,11 @@ class Translator(object):
                     add_null = True
                     value.remove(None)
 
+                threshold = settings.IN_SUBQUERY_THRESHOLD
+
+                if threshold is not None and len(value) >= threshold:
+                    value = ValuesSubquery(field.field, value)
+
             # Process a normal value
             if value is not None:
                 condition = \
@@ -219,15 +415,7 @@ class Translator(object):
         """Normalizes a cleaned value from some non-primitive type
         such as a model or queryset instance.
         """
-        if field.simple_type == 'key':
-            if isinstance(value, (list, tuple, QuerySet)):
-                return [x.pk for x in value]
-            return value.pk
-        if isinstance(value, QuerySet):
-            return [x.pk for x in value]
-        if isinstance(value, models.Model):
-            return value.pk
-        return value
+        return self.prepare(field).normalize(value)
 
     def validate(self, field, operator, value, tree, **kwargs):
         value = self._get_value(value)
@@ -249,6 +437,31 @@ class Translator(object):
     def language(self, field, operator, value, **kwargs):
         return u'{0} {1}'.format(field.name, operator.text(value))
 
+    def _language(self, field, operator, value, **kwargs):
+        """Returns the language of the condition memoized by the field,
+        operator and value. The language is rendered directly if additional
+        context is passed since it may vary by it.
+        """
+        cache = get_language_cache()
+
+        if cache is None or kwargs:
+            return self.language(field, operator, value, **kwargs)
+
+        try:
+            key = (self.__class__, field.pk, field.modified,
+                   field.data_version, field.name, operator.uid,
+                   _value_key(value))
+        except TypeError:
+            return self.language(field, operator, value)
+
+        language = cache.get(key)
+
+        if language is None:
+            language = self.language(field, operator, value)
+            cache.set(key, language)
+
+        return language
+
     def translate(self, field, roperator, rvalue, tree, **kwargs):
         """Returns two types of queryset modifiers including:
             - the raw operator and value supplied
@@ -262,7 +475,7 @@ class Translator(object):
         operator, value = \
             self.validate(field, roperator, rvalue, tree, **kwargs)
         condition = self._condition(field, operator, value, tree)
-        language = self.language(field, operator, value, **kwargs)
+        language = self._language(field, operator, value, **kwargs)
 
         return {
             'field': field.pk,
@@ -1,13 +1,27 @@
+import json
+import hashlib
 import logging
+import weakref
+import functools
+import threading
+from datetime import date, time
+from time import time as now
+from decimal import Decimal
 
 import django
+from django.core import signing
 from django.core.cache import get_cache
 from django.db import connections, DEFAULT_DB_ALIAS, DatabaseError
+from django.db.utils import load_backend
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
 from django_rq import get_queue
 
 from avocado.conf import settings
+from avocado.core.utils import parse_field_key
 from avocado.export import HTMLExporter, registry as exporters
 from avocado.query import pipeline
+from avocado.query.oldparsers.datacontext import multivalued_joins
 
 
 logger = logging.getLogger(__name__)
@@ -15,6 +29,23 @@ logger = logging.getLogger(__name__)
 DEFAULT_LIMIT = 20
 TEMP_DB_ALIAS_PREFIX = '_db:{0}'
 
+# Number of virtual machine instructions SQLite executes between checks of
+# the time budget of a query.
+SQLITE_PROGRESS_INSTRUCTIONS = 1000
+
+# Statement prefixes for getting the query plan by database vendor
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+# Database vendors that sort NULL values after all other values in
+# ascending order
+NULLS_LARGEST_VENDORS = ('postgresql', 'oracle')
+
+KEYSET_CURSOR_SALT = 'avocado.query.keyset'
+
 
 def ensure_connection(conn):
     if django.VERSION < (1, 6):
@@ -23,6 +54,233 @@ def ensure_connection(conn):
         conn.ensure_connection()
 
 
+class ConnectionPoolExhausted(DatabaseError):
+    "Raised when no pooled connection becomes available in time."
+
+
+class ConnectionInUse(DatabaseError):
+    "Raised when a named connection is leased by another thread."
+
+
+class ConnectionPool(object):
+    """Bounded pool of open connections to a database that are leased to
+    named connections.
+
+    At most `max_size` connections are open at once, either leased or idle.
+    Leasing a connection waits up to `timeout` seconds for one to be
+    released once the pool is full. The backend process ID of a connection
+    is determined when it is opened and kept with it.
+
+    Connections are owned by the thread that leased them and can only be
+    closed by it. A connection that is released from another thread, e.g.
+    when its query is canceled, is not reused but still counts towards the
+    size of the pool until its owner discards it or it is garbage collected.
+    """
+    def __init__(self, db, max_size=None, timeout=None):
+        self.db = db
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self._idle = []
+        self._leased = {}
+        self._orphans = {}
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        "Returns the number of open connections, leased, idle or orphaned."
+        return self._size
+
+    def _connect(self):
+        connections.ensure_defaults(self.db)
+        settings_dict = connections.databases[self.db]
+        backend = load_backend(settings_dict['ENGINE'])
+
+        conn = backend.DatabaseWrapper(settings_dict, self.db)
+        ensure_connection(conn)
+
+        # The pool manages the lifetime of the connection rather than the
+        # CONN_MAX_AGE database setting.
+        conn.close_at = None
+        conn.backend_pid = _get_backend_pid(conn)
+        conn.connection_pool = self
+
+        return conn
+
+    def _reusable(self, conn):
+        if conn.connection is None:
+            return False
+
+        if django.VERSION < (1, 6):
+            if conn.transaction_state:
+                return False
+
+            # End the implicit transaction of the queries
+            try:
+                conn._rollback()
+            except DatabaseError:
+                return False
+
+            return True
+
+        if conn.in_atomic_block or \
+                conn.get_autocommit() != conn.settings_dict['AUTOCOMMIT']:
+            return False
+
+        if conn.errors_occurred:
+            if not conn.is_usable():
+                return False
+            conn.errors_occurred = False
+
+        return True
+
+    def _owned(self, conn):
+        return conn._thread_ident == threading.current_thread().ident
+
+    def _forget(self, key, ref=None):
+        with self._cond:
+            if self._orphans.pop(key, None) is not None:
+                self._size -= 1
+                self._cond.notify()
+
+    def lease(self, alias):
+        "Leases a connection which is bound to `alias`."
+        deadline = None
+
+        if self.timeout is not None:
+            deadline = now() + self.timeout
+
+        with self._cond:
+            while not self._idle and self.max_size and \
+                    self._size >= self.max_size:
+                remaining = None
+
+                if deadline is not None:
+                    remaining = deadline - now()
+
+                    if remaining <= 0:
+                        raise ConnectionPoolExhausted(
+                            'No connection to "{0}" became available within '
+                            '{1} seconds.'.format(self.db, self.timeout))
+
+                self._cond.wait(remaining)
+
+            conn = None
+
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                self._size += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        # Transfer the connection to this thread
+        conn._thread_ident = threading.current_thread().ident
+        conn.alias = alias
+
+        with self._cond:
+            self._leased[alias] = conn
+
+        return conn
+
+    def leased(self, alias):
+        "Returns the connection leased to `alias` if any."
+        return self._leased.get(alias)
+
+    def orphaned(self, conn):
+        "Returns true if the connection was released by another thread."
+        return id(conn) in self._orphans
+
+    def release(self, alias, discard=False):
+        """Returns the connection leased to `alias` to the pool. If `discard`
+        is true or the connection is no longer usable, it is closed instead.
+        """
+        with self._cond:
+            conn = self._leased.pop(alias, None)
+
+        if conn is None:
+            return
+
+        # The owner may still be using the connection, so it is left to the
+        # owner to close it.
+        if not self._owned(conn):
+            key = id(conn)
+
+            with self._cond:
+                self._orphans[key] = weakref.ref(
+                    conn, functools.partial(self._forget, key))
+            return
+
+        reuse = not discard and self._reusable(conn)
+
+        # Remove the time budget of the query before it is reused.
+        if reuse and getattr(conn, 'query_timeout', None):
+            try:
+                set_query_timeout(conn, None)
+            except DatabaseError:
+                reuse = False
+
+        if not reuse and conn.connection is not None:
+            conn.close()
+
+        with self._cond:
+            if reuse:
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+
+            self._cond.notify()
+
+    def discard(self, conn):
+        """Closes a connection which was released by another thread. This
+        must be called by the thread owning the connection.
+        """
+        if conn.connection is not None:
+            conn.close()
+
+        self._forget(id(conn))
+
+    def close(self):
+        "Closes the idle connections of the pool."
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            conn._thread_ident = threading.current_thread().ident
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(db=DEFAULT_DB_ALIAS):
+    """Returns the pool of connections to the database used for named
+    connections or None if pooling is disabled.
+    """
+    max_size = settings.QUERY_CONNECTION_POOL_SIZE
+
+    if not max_size:
+        return
+
+    key = (db, max_size, settings.QUERY_CONNECTION_POOL_TIMEOUT)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(*key)
+
+        return _pools[key]
+
+
 def isolate_queryset(name, queryset):
     """Creates a temporary named connection and binds a queryset.
 
@@ -45,8 +303,9 @@ def named_connection(name, db=DEFAULT_DB_ALIAS):
     thread. This is not appropriate for potentially long-running queries
     which may need to be canceled.
 
-    This function creates a new connection to a database using the same
-    options defined in the database settings.
+    This function leases a connection to a database from the pool of
+    connections of the database, if pooling is enabled, or otherwise creates
+    a new connection using the same options defined in the database settings.
 
     Note: Adding the connection to django.db.connections is required
     because only database aliases are referenced in QuerySets, not the
@@ -56,23 +315,49 @@ def named_connection(name, db=DEFAULT_DB_ALIAS):
     # Define a new database alias.
     temp_db = TEMP_DB_ALIAS_PREFIX.format(name)
 
+    pool = get_connection_pool(db)
+
     if temp_db in connections.databases:
+        # Pooled connections can only be used by the thread that leased them.
+        # Any other thread would open an unpooled connection under the name.
+        leasing = _leasing_pool(temp_db)
+
+        if leasing is not None and \
+                not leasing._owned(leasing.leased(temp_db)):
+            raise ConnectionInUse('The connection "{0}" is leased by another '
+                                  'thread.'.format(name))
+
         conn = connections[temp_db]
         logger.debug('reusing connection for %s', name)
     else:
         # Get the settings of the real database being connected to.
         connections.ensure_defaults(db)
 
+        # Lease the connection before the database entry is added, so it is
+        # not left behind if the pool is exhausted.
+        if pool is not None:
+            leased = pool.lease(temp_db)
+
         # Add new database entry into connections handler so when the query
         # executes the new connection will be accessible.
         connections.databases[temp_db] = connections.databases[db]
 
+        if pool is not None:
+            connections[temp_db] = leased
+            logger.debug('leasing connection for %s', name)
+        else:
+            logger.debug('initializing connection for %s', name)
+
         conn = connections[temp_db]
-        logger.debug('initializing connection for %s', name)
 
     # Get the backend specific process ID for the query. This will open a
-    # connection to the database if not already open.
-    pid = _get_backend_pid(conn)
+    # connection to the database if not already open. Pooled connections
+    # keep the process ID of the connection when it was opened.
+    if pool is not None and pool.leased(temp_db) is conn and \
+            conn.connection is not None:
+        pid = conn.backend_pid
+    else:
+        pid = _get_backend_pid(conn)
 
     # Put real database alias and PID in centralized cache so multiple threads
     # and/or processes can access it.
@@ -96,29 +381,74 @@ def cancel_query(name):
         db, pid = info
         canceled = _cancel_query(name, db, pid)
 
-    # Clean up the connection.
-    close_connection(name)
+    # Clean up the connection. The cache entry is removed once a query is
+    # finished, so the connection of a query that may have been canceled is
+    # not reused.
+    close_connection(name, discard=info is not None)
 
     return canceled
 
 
-def close_connection(name):
-    "Closes a temporary connection by name and removes it from the handler."
+def close_connection(name, discard=False):
+    """Closes a temporary connection by name and removes it from the handler.
+    A pooled connection is returned to its pool unless `discard` is true.
+    """
     temp_db = TEMP_DB_ALIAS_PREFIX.format(name)
 
+    # Connection bound to the name in this thread.
+    conn = getattr(connections._connections, temp_db, None)
+    pool = getattr(conn, 'connection_pool', None)
+
+    # The connection was released by another thread, e.g. it was canceled
+    # while its query was running in this thread. The name may since have
+    # been leased again, which is left to its own query.
+    if pool is not None and pool.orphaned(conn):
+        logger.debug('discarding connection %s', name)
+        _unbind_connection(temp_db)
+        pool.discard(conn)
+        return
+
     # Remove the cache entry.
     cache = get_cache(settings.QUERY_CACHE)
     cache.delete(temp_db)
 
-    # Remove connection from handler if in the same thread.
-    if temp_db in connections.databases:
+    if temp_db not in connections.databases:
+        return
+
+    pool = _leasing_pool(temp_db)
+
+    if pool is not None:
+        logger.debug('releasing connection %s', name)
+
+        # Unbind the connection if leased by this thread.
+        if pool.leased(temp_db) is conn:
+            _unbind_connection(temp_db)
+
+        pool.release(temp_db, discard=discard)
+    else:
+        # Remove connection from handler if in the same thread.
         logger.debug('closing connection %s', name)
 
         conn = connections[temp_db]
         ensure_connection(conn)
         conn.close()
 
-        del connections.databases[temp_db]
+        _unbind_connection(temp_db)
+
+    del connections.databases[temp_db]
+
+
+def _leasing_pool(alias):
+    "Returns the pool which leased a connection to the alias if any."
+    for pool in _pools.values():
+        if pool.leased(alias) is not None:
+            return pool
+
+
+def _unbind_connection(alias):
+    # ConnectionHandler does not support deleting connections on Django 1.5
+    if hasattr(connections._connections, alias):
+        delattr(connections._connections, alias)
 
 
 def _get_backend_pid(conn):
@@ -192,6 +522,201 @@ def _cancel_query(name, db, pid):
     logger.warn('canceling queries for {0} is not supported'.format(engine))
 
 
+class QueryBudgetExceeded(DatabaseError):
+    """Raised when a query exceeds its time, row or byte budget.
+
+    The `budget` is the name of the exceeded budget, one of 'timeout',
+    'max_rows' or 'max_bytes', and `limit` is its value.
+    """
+    def __init__(self, budget, limit):
+        self.budget = budget
+        self.limit = limit
+
+        super(QueryBudgetExceeded, self).__init__(
+            'Query exceeded its {0} budget of {1}.'.format(budget, limit))
+
+
+def set_query_timeout(conn, timeout):
+    """Sets the time budget in seconds of queries executed on a connection.
+
+    The budget is enforced by the database, using `statement_timeout` on
+    PostgreSQL and `max_execution_time` on MySQL, which apply to each
+    statement. SQLite uses a progress handler which interrupts queries once
+    `timeout` seconds have passed since the budget was set. A `timeout` of
+    None removes the budget.
+    """
+    engine = conn.settings_dict['ENGINE']
+    ensure_connection(conn)
+
+    milliseconds = int(timeout * 1000) if timeout else 0
+
+    if engine == 'django.db.backends.postgresql_psycopg2':
+        c = conn.cursor()
+        c.execute('SET statement_timeout = %s', (milliseconds,))
+
+    elif engine == 'django.db.backends.mysql':
+        c = conn.cursor()
+        c.execute('SET SESSION max_execution_time = %s', (milliseconds,))
+
+    elif engine == 'django.db.backends.sqlite3':
+        if timeout:
+            deadline = now() + timeout
+
+            conn.connection.set_progress_handler(
+                lambda: now() > deadline, SQLITE_PROGRESS_INSTRUCTIONS)
+        else:
+            conn.connection.set_progress_handler(None, 0)
+
+    elif timeout:
+        logger.warn('query timeouts for {0} are not supported'.format(engine))
+        return
+
+    conn.query_timeout = timeout or None
+    conn.query_started = now()
+
+
+def _timed_out(conn, error):
+    "Returns true if the error is due to the time budget of the connection."
+    timeout = getattr(conn, 'query_timeout', None)
+
+    if not timeout:
+        return False
+
+    engine = conn.settings_dict['ENGINE']
+
+    # Django wraps errors raised by the database driver. Django 1.5 does not
+    # chain the driver error, but the wrapping error has the same arguments,
+    # so the error code is only checked if present.
+    cause = getattr(error, '__cause__', None) or error
+
+    if engine == 'django.db.backends.postgresql_psycopg2':
+        return getattr(cause, 'pgcode', '57014') == '57014' and \
+            'statement timeout' in str(cause)
+
+    if engine == 'django.db.backends.mysql':
+        return bool(cause.args) and cause.args[0] == 3024
+
+    # Interrupts due to the progress handler cannot be told apart from
+    # canceled queries other than by the time passed.
+    if engine == 'django.db.backends.sqlite3':
+        return 'interrupted' in str(cause) and \
+            now() - conn.query_started >= timeout
+
+    return False
+
+
+def _row_size(row):
+    """Returns the approximate size in bytes of the values of a row. Text is
+    measured by its UTF-8 encoded length, other values by the length of
+    their string representation.
+    """
+    size = 0
+
+    for value in row:
+        if value is None:
+            continue
+
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        elif not isinstance(value, str):
+            value = str(value)
+
+        size += len(value)
+
+    return size
+
+
+def enforce_budget(iterable, name, max_rows=None, max_bytes=None):
+    """Iterates over the rows of a query executed on a named connection and
+    raises QueryBudgetExceeded if the query exceeds its time budget or more
+    than `max_rows` rows or `max_bytes` bytes are read.
+
+    The connection is released once the rows are exhausted or the iteration
+    is stopped, so it can be reused by the next query. It is discarded if the
+    query fails or exceeds a budget, so the query no longer holds it.
+    """
+    conn = connections[TEMP_DB_ALIAS_PREFIX.format(name)]
+    rows = iter(iterable)
+
+    count = 0
+    size = 0
+    discard = True
+
+    try:
+        for row in rows:
+            count += 1
+
+            if max_rows is not None and count > max_rows:
+                raise QueryBudgetExceeded('max_rows', max_rows)
+
+            if max_bytes is not None:
+                size += _row_size(row)
+
+                if size > max_bytes:
+                    raise QueryBudgetExceeded('max_bytes', max_bytes)
+
+            yield row
+
+        discard = False
+    except GeneratorExit:
+        discard = False
+        raise
+    except QueryBudgetExceeded:
+        raise
+    except Exception as e:
+        if not _timed_out(conn, e):
+            raise
+
+        raise QueryBudgetExceeded('timeout', conn.query_timeout)
+    finally:
+        # Close the cursor of the query before the connection is reused.
+        if hasattr(rows, 'close'):
+            rows.close()
+
+        close_connection(name, discard=discard)
+
+
+def explain(queryset):
+    """Returns the SQL of the queryset and the query plan of the database.
+
+    The output includes whether `DISTINCT` is applied and the tables joined
+    across multi-valued relationships, which are what make it necessary.
+    Contexts and queries only apply `DISTINCT` if there are any. The `plan`
+    is None if the database does not support explaining queries or the
+    queryset is known to be empty.
+    """
+    query = queryset.query
+    joins = multivalued_joins(query)
+
+    output = {
+        'sql': None,
+        'params': (),
+        'distinct': query.distinct,
+        'multivalued_joins': [query.alias_map[alias].table_name
+                              if alias in query.alias_map else alias
+                              for alias in joins],
+        'plan': None,
+    }
+
+    try:
+        sql, params = query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return output
+
+    output['sql'] = sql
+    output['params'] = params
+
+    conn = connections[queryset.db]
+    prefix = EXPLAIN_PREFIXES.get(conn.vendor)
+
+    if prefix:
+        cursor = conn.cursor()
+        cursor.execute(prefix + sql, params)
+        output['plan'] = cursor.fetchall()
+
+    return output
+
+
 def get_exporter_class(export_type):
     """
     Returns the exporter class for the supplied export type name.
@@ -209,6 +734,257 @@ def get_exporter_class(export_type):
     return exporters[export_type]
 
 
+def _context_references(attrs, fields, concepts, composites, seen):
+    """Collects the field keys, concept ids and the JSON of composite
+    contexts referenced by the context JSON `attrs`.
+    """
+    if not attrs or not isinstance(attrs, dict):
+        return
+
+    if 'composite' in attrs:
+        from avocado.models import DataContext
+
+        pk = attrs['composite']
+
+        # Guard against cyclic composites
+        if pk in seen:
+            return
+
+        seen.add(pk)
+
+        try:
+            composite = DataContext.objects.get(pk=pk).json
+        except DataContext.DoesNotExist:
+            return
+
+        composites.append((pk, composite))
+        _context_references(composite, fields, concepts, composites, seen)
+
+    elif 'children' in attrs:
+        for child in attrs['children']:
+            _context_references(child, fields, concepts, composites, seen)
+
+    else:
+        key = attrs.get('field', attrs.get('id'))
+
+        if key is not None:
+            fields.append(key)
+
+        if attrs.get('concept') is not None:
+            concepts.add(attrs['concept'])
+
+
+def get_data_versions(field_keys=(), concept_ids=()):
+    """Returns a sorted list of (pk, data_version) pairs for the fields
+    referenced by key and the fields of the concepts. A single query is
+    used for all of them.
+    """
+    from avocado.models import DataField
+
+    lookups = [Q(**parse_field_key(key)) for key in field_keys]
+
+    if concept_ids:
+        lookups.append(Q(concepts__pk__in=list(concept_ids)))
+
+    if not lookups:
+        return []
+
+    q = reduce(lambda q1, q2: q1 | q2, lookups)
+
+    return sorted(set(DataField.objects.filter(q)
+                      .values_list('pk', 'data_version')))
+
+
+def result_cache_key(context, view, options):
+    """Returns the key the result rows are cached under. The key is a
+    hash of the context and view JSON (including composite contexts), the
+    `options` that affect the rows and the data version of every DataField
+    referenced by the context or view.
+    """
+    fields = []
+    concepts = set()
+    composites = []
+
+    if context is not None:
+        _context_references(context.json, fields, concepts, composites,
+                            set())
+
+    if view is not None:
+        for facet in view.parse().facets:
+            if facet.get('concept') is not None:
+                concepts.add(facet['concept'])
+
+    key = {
+        'context': context.json if context is not None else None,
+        'composites': composites,
+        'view': view.json if view is not None else None,
+        'options': options,
+        'data_versions': get_data_versions(fields, concepts),
+    }
+
+    # Canonical representation, non-JSON values such as a model class
+    # for the tree fall back to their repr.
+    raw = json.dumps(key, sort_keys=True, separators=(',', ':'),
+                     default=repr)
+
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _cache_rows(rows, key):
+    """Yields the rows and caches them once exhausted, as long as there
+    are at most `QUERY_RESULT_CACHE_MAX_ROWS` of them.
+    """
+    max_rows = settings.QUERY_RESULT_CACHE_MAX_ROWS
+    cached = []
+
+    for row in rows:
+        if cached is not None:
+            cached.append(row)
+
+            if max_rows is not None and len(cached) > max_rows:
+                cached = None
+
+        yield row
+
+    if cached is not None:
+        cache = get_cache(settings.QUERY_CACHE)
+
+        try:
+            cache.set(key, cached,
+                      timeout=settings.QUERY_RESULT_CACHE_TIMEOUT)
+        except Exception:
+            logger.exception('error caching result rows')
+
+
+def _keyset_value(value):
+    "Returns a JSON serializable representation of an ordering value."
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return unicode(value)
+    return value
+
+
+def encode_cursor(order_by, values):
+    """Returns an opaque token for the position in the rows ordered by the
+    `order_by` lookups, given the values of the last row seen.
+    """
+    return signing.dumps({
+        'order_by': order_by,
+        'values': [_keyset_value(x) for x in values],
+    }, salt=KEYSET_CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token, order_by):
+    """Returns the values of the row the cursor token points after. A
+    `ValueError` is raised if the token is invalid or does not match the
+    `order_by` lookups.
+    """
+    try:
+        data = signing.loads(token, salt=KEYSET_CURSOR_SALT)
+    except signing.BadSignature:
+        raise ValueError('Invalid cursor.')
+
+    if data.get('order_by') != order_by:
+        raise ValueError('Cursor does not match the ordering.')
+
+    return data['values']
+
+
+def keyset_condition(order_by, values, nulls_largest=False):
+    """Returns a condition matching the rows that come after the row with
+    `values` in the order of the `order_by` lookups. Descending lookups are
+    prefixed with a hyphen. If `nulls_largest` is true, NULL values sort
+    after all other values in ascending order.
+    """
+    condition = None
+    prefix = Q()
+
+    for lookup, value in zip(order_by, values):
+        desc = lookup.startswith('-')
+        name = lookup.lstrip('-')
+
+        # Whether NULL values come after all other values in this direction
+        nulls_after = nulls_largest != desc
+
+        if value is None:
+            after = Q(**{name + '__isnull': False}) if not nulls_after \
+                else None
+            equal = Q(**{name + '__isnull': True})
+        else:
+            after = Q(**{name + ('__lt' if desc else '__gt'): value})
+
+            if nulls_after:
+                after |= Q(**{name + '__isnull': True})
+
+            equal = Q(**{name: value})
+
+        if after is not None:
+            after = prefix & after
+            condition = after if condition is None else condition | after
+
+        prefix &= equal
+
+    # Nothing can come after the row
+    if condition is None:
+        condition = Q(pk__in=[])
+
+    return condition
+
+
+def keyset_page(queryset, order_by, cursor):
+    """Returns the queryset of the rows that come after the `cursor`
+    position in the `order_by` order and the lookups the rows are ordered
+    by. The root primary key is used as a tiebreaker so rows are totally
+    ordered. This requires each row to be for a distinct primary key.
+    """
+    pk_name = queryset.model._meta.pk.name
+    order_by = list(order_by) + [pk_name]
+
+    queryset = queryset.order_by(*order_by)
+
+    if cursor is not None:
+        values = decode_cursor(cursor, order_by)
+        vendor = connections[queryset.db].vendor
+
+        queryset = queryset.filter(keyset_condition(
+            order_by, values, vendor in NULLS_LARGEST_VENDORS))
+
+    return queryset, order_by
+
+
+def keyset_cursor(queryset, order_by, limit):
+    """Returns the cursor token of the page after the first `limit` rows of
+    a keyset page, or None if there are no more rows. Only the ordering
+    values of the last row of the page and the row after it are fetched.
+    """
+    names = [x.lstrip('-') for x in order_by]
+    rows = list(queryset.values_list(*names)[limit - 1:limit + 1])
+
+    # The last row of the page is the last row
+    if len(rows) < 2:
+        return
+
+    return encode_cursor(order_by, rows[0])
+
+
+def _keyset_cursor(name, queryset, order_by, limit):
+    """Returns the `keyset_cursor` of a queryset isolated to the named
+    connection. The connection is discarded if the query fails.
+    """
+    conn = connections[queryset.db]
+
+    try:
+        return keyset_cursor(queryset, order_by, limit)
+    except Exception as e:
+        close_connection(name, discard=True)
+
+        if not _timed_out(conn, e):
+            raise
+
+        raise QueryBudgetExceeded('timeout', conn.query_timeout)
+
+
 def async_get_result_rows(context, view, query_options, job_options=None):
     """
     Creates a new job to asynchronously get result rows and returns the job ID.
@@ -260,6 +1036,20 @@ def get_result_rows(context, view, query_options, evaluate_rows=False):
                 * export_type: Export type to use for result rows.
                 * reader: Reader type to use when exporting, see
                     export._base.BaseExporter.readers for available readers.
+                * cache: Whether to use the result cache. Defaults to the
+                    QUERY_RESULT_CACHE_ENABLED setting.
+                * keyset: Whether to paginate by the position of the rows in
+                    the view ordering rather than by page. Pages are
+                    requested with a cursor rather than a page number, the
+                    `limit` is the size of the page.
+                * cursor: Cursor of the page to return when paginating by
+                    keyset, the first page if not defined.
+                * timeout: Time budget of the query in seconds. Defaults to
+                    the QUERY_TIMEOUT setting.
+                * max_rows: Maximum number of rows read from the database.
+                    Defaults to the QUERY_MAX_ROWS setting.
+                * max_bytes: Maximum number of bytes read from the database.
+                    Defaults to the QUERY_MAX_BYTES setting.
 
     Kwargs:
         evaluate_rows (default=False): When this is True, the generator
@@ -279,6 +1069,8 @@ def get_result_rows(context, view, query_options, evaluate_rows=False):
                 * queryset: The queryset used to gather results.
                 * rows: The result rows themselves.
                 * stop_page: The stop page of the result rows collection.
+                * cursor: The cursor of the next page when paginating by
+                    keyset, None if there are no more rows.
 
     """
     offset = None
@@ -291,8 +1083,23 @@ def get_result_rows(context, view, query_options, evaluate_rows=False):
     tree = query_options.get('tree')
     export_type = query_options.get('export_type') or 'html'
     reader = query_options.get('reader')
-
-    if page is not None:
+    use_cache = query_options.get('cache')
+    keyset = query_options.get('keyset')
+    cursor = query_options.get('cursor')
+    next_cursor = None
+    timeout = query_options.get('timeout', settings.QUERY_TIMEOUT)
+    max_rows = query_options.get('max_rows', settings.QUERY_MAX_ROWS)
+    max_bytes = query_options.get('max_bytes', settings.QUERY_MAX_BYTES)
+
+    if use_cache is None:
+        use_cache = settings.QUERY_RESULT_CACHE_ENABLED
+
+    if keyset:
+        if not limit:
+            raise ValueError('A limit is required for keyset pagination.')
+
+        page = stop_page = None
+    elif page is not None:
         page = int(page)
 
         # Pages are 1-based.
@@ -322,44 +1129,139 @@ def get_result_rows(context, view, query_options, evaluate_rows=False):
     processor = QueryProcessor(context=context, view=view, tree=tree)
     queryset = processor.get_queryset()
 
-    # Isolate this query to a named connection. This will cancel an
-    # outstanding queries of the same name if one is present.
-    cancel_query(query_name)
-    queryset = isolate_queryset(query_name, queryset)
-
     # 0 limit means all for pagination, however the read method requires
     # an explicit limit of None
     limit = limit or None
 
+    view_node = view.parse(tree=tree)
+
+    # The page is selected by the position of the rows in the ordering
+    # rather than skipping rows, so the cost is the same for any page.
+    if keyset:
+        if view_node.multivalued():
+            raise ValueError('Keyset pagination requires one row per '
+                             'object of the tree.')
+
+        queryset, order_by = keyset_page(
+            queryset, view_node._get_order_by(), cursor)
+
+    # Cancel an outstanding query of the same name if one is present.
+    cancel_query(query_name)
+
+    cache_key = None
+    rows = None
+
+    if use_cache:
+        cache_key = result_cache_key(context, view, {
+            'processor': processor_name,
+            'tree': tree,
+            'export_type': export_type,
+            'reader': reader,
+            'offset': offset,
+            'limit': limit,
+            'cursor': cursor if keyset else None,
+        })
+
+        rows = get_cache(settings.QUERY_CACHE).get(cache_key)
+
+    # Isolate the queries to a named connection. The time budget is
+    # enforced by the database, the row and byte budgets as the rows are
+    # read. A budget is removed when the connection is reused for a query
+    # without one.
+    def isolate(queryset):
+        queryset = isolate_queryset(query_name, queryset)
+        conn = connections[queryset.db]
+
+        if timeout or getattr(conn, 'query_timeout', None):
+            set_query_timeout(conn, timeout)
+
+        return queryset
+
+    if rows is not None:
+        logger.debug('result rows cache hit for %s', query_name)
+
+        # The position of the next page is not cached with the rows
+        if keyset:
+            next_cursor = _keyset_cursor(query_name, isolate(queryset),
+                                         order_by, limit)
+            close_connection(query_name)
+
+        if not evaluate_rows:
+            rows = iter(rows)
+
+        return {
+            'context': context,
+            'cursor': next_cursor,
+            'export_type': export_type,
+            'limit': limit,
+            'offset': offset,
+            'page': page,
+            'processor': processor,
+            'queryset': queryset,
+            'rows': rows,
+            'stop_page': stop_page,
+            'view': view,
+        }
+
+    queryset = isolate(queryset)
+
+    if keyset:
+        next_cursor = _keyset_cursor(query_name, queryset, order_by, limit)
+
+    # The rows are only read through the budget if one is set. Otherwise the
+    # named connection is left open, so the returned queryset can still be
+    # used, until it is closed by the caller or the next query of the name.
+    def budget(iterable):
+        if not timeout and max_rows is None and max_bytes is None:
+            return iterable
+
+        return enforce_budget(iterable, query_name, max_rows=max_rows,
+                              max_bytes=max_bytes)
+
     # We use HTMLExporter in Serrano but Avocado has it disabled. Until it
     # is enabled in Avocado, we can reference the HTMLExporter directly here.
     exporter = processor.get_exporter(get_exporter_class(export_type))
 
-    # This is an optimization when concepts are selected for ordering
-    # only. There is no guarantee to how many rows are required to get
-    # the desired `limit` of rows, so the query is unbounded. If all
-    # ordering facets are visible, the limit and offset can be pushed
-    # down to the query.
+    # When concepts are selected for ordering only, the rows may contain
+    # duplicates of the visible columns. The rows are de-duplicated by the
+    # database if possible, so the limit and offset are applied to the
+    # distinct rows. Otherwise, there is no guarantee to how many rows are
+    # required to get the desired `limit` of rows, so the query is
+    # unbounded. The rows of a keyset page are already distinct.
     order_only = lambda f: not f.get('visible', True)
-    view_node = view.parse()
 
     if filter(order_only, view_node.facets):
-        iterable = processor.get_iterable(queryset=queryset)
-        rows = exporter.manual_read(iterable,
-                                    offset=offset,
-                                    limit=limit)
+        if keyset:
+            iterable = processor.get_iterable(queryset=queryset, limit=limit)
+        else:
+            iterable = processor.get_distinct_iterable(
+                exporter.row_length, queryset=queryset, offset=offset,
+                limit=limit)
+
+        if iterable is not None:
+            rows = exporter.manual_read(budget(iterable),
+                                        force_distinct=False)
+        else:
+            iterable = processor.get_iterable(queryset=queryset)
+            rows = exporter.manual_read(budget(iterable),
+                                        offset=offset,
+                                        limit=limit)
     else:
         iterable = processor.get_iterable(queryset=queryset,
                                           limit=limit,
                                           offset=offset)
         method = exporter.reader(reader)
-        rows = method(iterable)
+        rows = method(budget(iterable))
+
+    if cache_key is not None:
+        rows = _cache_rows(rows, cache_key)
 
     if evaluate_rows:
         rows = list(rows)
 
     return {
         'context': context,
+        'cursor': next_cursor,
         'export_type': export_type,
         'limit': limit,
         'offset': offset,
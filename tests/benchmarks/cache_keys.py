@@ -0,0 +1,123 @@
+"""Microbenchmark comparing the throughput of the cache key functions against
+the previous implementation which re-hashed the instance prefix, prepared
+the arguments for pickling and compiled QuerySet arguments on every call.
+
+Run from the repository root:
+
+    python tests/benchmarks/cache_keys.py [iterations]
+"""
+import os
+import sys
+import timeit
+import hashlib
+import cPickle as pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+from django.db.models.query import QuerySet  # noqa
+from avocado.core.cache.model import instance_cache_key  # noqa
+from tests.cases.core.models import Foo  # noqa
+
+
+def _legacy_pickling_value(v):
+    if isinstance(v, QuerySet):
+        s, p = v.query.get_compiler(v.db).as_sql()
+        return s % p
+    return v
+
+
+def _legacy_prep_pickling(args, kwargs):
+    if args:
+        args = [_legacy_pickling_value(v) for v in args]
+    else:
+        args = None
+
+    _kwargs = {}
+
+    if kwargs:
+        for k, v in kwargs.items():
+            if v is not None:
+                _kwargs[k] = _legacy_pickling_value(v)
+
+        kwargs = _kwargs or None
+    else:
+        kwargs = None
+
+    return args, kwargs
+
+
+def _legacy_cache_key_func(l):
+    raw = ':'.join([str(x) for x in l])
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _legacy_cache_key(label, version=None, args=None, kwargs=None):
+    if version is None:
+        version = '-'
+
+    key = [label, version]
+    args, kwargs = _legacy_prep_pickling(args, kwargs)
+
+    if args or kwargs:
+        key.append(pickle.dumps((args, kwargs)))
+
+    return _legacy_cache_key_func(key)
+
+
+def legacy_instance_cache_key(instance, label=None, version=None, args=None,
+                              kwargs=None):
+    if isinstance(version, basestring) and hasattr(instance, version):
+        version = getattr(instance, version)
+
+        if callable(version):
+            version = version()
+
+    opts = instance._meta
+    key = [opts.app_label, opts.module_name, instance.pk]
+
+    if label is not None:
+        key.append(label)
+
+    label = _legacy_cache_key_func(key)
+
+    return _legacy_cache_key(label=label, version=version, args=args,
+                             kwargs=kwargs)
+
+
+def main(iterations=20000):
+    instance = Foo(pk=1)
+    queryset = Foo.objects.filter(value__gt=1)
+
+    cases = (
+        ('no arguments', (), {}),
+        ('queryset argument', (), {'queryset': queryset}),
+    )
+
+    for name, args, kwargs in cases:
+        old = legacy_instance_cache_key(instance, 'values', 'get_version',
+                                        args=args, kwargs=kwargs)
+        new = instance_cache_key(instance, 'values', 'get_version',
+                                 args=args, kwargs=kwargs)
+
+        assert old == new, 'keys differ'
+
+        results = []
+
+        for func in (legacy_instance_cache_key, instance_cache_key):
+            seconds = timeit.timeit(
+                lambda: func(instance, 'values', 'get_version',
+                             args=args, kwargs=kwargs),
+                number=iterations)
+            results.append(iterations / seconds)
+
+        print('{0:<20} old: {1:>10.0f} keys/s  new: {2:>10.0f} keys/s  '
+              '({3:.1f}x)'.format(name, results[0], results[1],
+                                  results[1] / results[0]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -1,9 +1,14 @@
 import time
 import cPickle as pickle
+from django.core.cache import get_cache
 from django.db import models
 from django.test import TestCase
 from django.test.utils import override_settings
-from avocado.core.cache import CacheProxy, instance_cache_key
+from avocado.core.cache import CacheProxy, LocalCache, get_local_cache, \
+    instance_cache_key, invalidate_tags, app_tag, model_tag, instance_tag
+from avocado.core.cache import codec, get_stats, reset_stats, \
+    prefetch_cached, proxy
+from avocado.core.cache.stats import stats
 from ..models import Foo
 
 
@@ -17,6 +22,9 @@ class ComplexNumber(models.Model):
     def as_string(self, *args, **kwargs):
         return '2+3i'
 
+    def as_labels(self, *args, **kwargs):
+        return tuple(u'Label {0}'.format(i) for i in xrange(1000))
+
 
 class CacheProxyTestCase(TestCase):
     def setUp(self):
@@ -78,6 +86,446 @@ class CacheProxyTestCase(TestCase):
         self.assertFalse(self.cp.cached(c, args, kwargs))
 
 
+class LocalCacheTestCase(TestCase):
+    def test_entries(self):
+        cache = LocalCache(max_entries=2)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Touch 'a' so 'b' is the least recently used
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_bytes(self):
+        cache = LocalCache(max_bytes=100)
+
+        # Too large to ever be stored
+        self.assertFalse(cache.set('a', 'x' * 200))
+        self.assertIsNone(cache.get('a'))
+
+        self.assertTrue(cache.set('b', 'x' * 60))
+        self.assertTrue(cache.set('c', 'x' * 60))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'x' * 60)
+
+    def test_timeout(self):
+        cache = LocalCache(timeout=1)
+
+        # The smaller of the two timeouts is used
+        cache.set('a', 1, timeout=10)
+        self.assertTrue('a' in cache)
+
+        time.sleep(1.1)
+        self.assertFalse('a' in cache)
+
+    def test_delete(self):
+        cache = LocalCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+        cache.set('b', 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class LocalCacheProxyTestCase(TestCase):
+    def setUp(self):
+        self.cp = CacheProxy(ComplexNumber.as_string,
+                             version='get_version',
+                             timeout=2,
+                             key_func=instance_cache_key)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_LOCAL_ENABLED=True)
+    def test(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        local = get_local_cache()
+        key = self.cp.cache_key(c)
+
+        self.assertIsNone(local.get(key))
+        self.assertEqual(self.cp.get_or_set(c), '2+3i')
+
+        # Populated in both tiers
+        self.assertEqual(local.get(key), '2+3i')
+        self.assertTrue(self.cp.cached(c))
+
+        # Flushing removes it from both tiers
+        self.cp.flush(c)
+        self.assertIsNone(local.get(key))
+        self.assertFalse(self.cp.cached(c))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_LOCAL_ENABLED=True)
+    def test_version(self):
+        f = Foo(value=1)
+        f.save()
+
+        local = get_local_cache()
+
+        self.assertEqual(f.versioned(), [2])
+        key = f.versioned.cache_key(f)
+        self.assertEqual(local.get(key), [2])
+
+        # A new version results in a new key, so the stale local entry
+        # is never served.
+        f.get_version = lambda label=None: 2
+        self.assertNotEqual(f.versioned.cache_key(f), key)
+        self.assertFalse(f.versioned.cached(f))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_LOCAL_ENABLED=True)
+    def test_no_backend_calls(self):
+        f = Foo(value=1)
+        f.save()
+        f.default_versioned.flush(f)
+
+        self.assertEqual(f.default_versioned(), [1])
+
+        calls = []
+        get_cache = proxy.get_cache
+
+        class Counted(object):
+            def __init__(self, cache):
+                self.cache = cache
+
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(self.cache, name)
+
+        def counted(*args, **kwargs):
+            return Counted(get_cache(*args, **kwargs))
+
+        proxy.get_cache = counted
+        self.addCleanup(setattr, proxy, 'get_cache', get_cache)
+
+        # Local hits do not touch the data cache
+        self.assertEqual(f.default_versioned(), [1])
+        self.assertEqual(prefetch_cached([f], ['default_versioned']),
+                         {(f.pk, 'default_versioned'): [1]})
+        self.assertEqual(calls, [])
+
+
+class CodecTestCase(TestCase):
+    def assertRoundTrip(self, data, kind):
+        blob = codec.encode(data)
+        self.assertEqual(blob[0], kind)
+        self.assertEqual(codec.decode(blob), data)
+
+    def test_types(self):
+        self.assertRoundTrip((), codec.INT)
+        self.assertRoundTrip((1, -2, 2 ** 62), codec.INT)
+        self.assertRoundTrip((1.5, -2.25), codec.FLOAT)
+        self.assertRoundTrip((u'a', None, u'\u00e9', u''), codec.TEXT)
+
+        # Mixed types, booleans, large integers and non-tuples are pickled
+        self.assertRoundTrip((1, 1.5), codec.PICKLE)
+        self.assertRoundTrip((True, False), codec.PICKLE)
+        self.assertRoundTrip((2 ** 64,), codec.PICKLE)
+        self.assertRoundTrip((1, None), codec.PICKLE)
+        self.assertRoundTrip([1, 2], codec.PICKLE)
+
+        self.assertEqual(type(codec.decode(codec.encode((True,)))[0]), bool)
+
+    def test_compact(self):
+        data = tuple(xrange(1000))
+        self.assertLess(len(codec.encode(data)),
+                        len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+
+    def test_compress(self):
+        data = tuple(u'Label' for i in xrange(1000))
+
+        blob = codec.encode(data, compress_threshold=100)
+        self.assertEqual(blob[1], codec.COMPRESSED)
+        self.assertLess(len(blob), len(codec.encode(data)))
+        self.assertEqual(codec.decode(blob), data)
+
+        blob = codec.encode((u'a',), compress_threshold=100)
+        self.assertEqual(blob[1], codec.UNCOMPRESSED)
+
+
+class CompactCacheProxyTestCase(TestCase):
+    def setUp(self):
+        self.cp = CacheProxy(ComplexNumber.as_labels,
+                             version='get_version',
+                             timeout=2,
+                             key_func=instance_cache_key,
+                             compact=True)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_TAGS_ENABLED=False)
+    def test(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        data = self.cp.get_or_set(c)
+        self.assertEqual(data, c.as_labels())
+
+        cache = get_cache('default')
+        entry = cache.get(self.cp.cache_key(c))
+        self.assertIsInstance(entry, codec.Encoded)
+        self.assertEqual(self.cp.get(c), data)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_TAGS_ENABLED=False,
+                       AVOCADO_DATA_CACHE_MAX_ITEM_SIZE=1000)
+    def test_chunks(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        data = self.cp.get_or_set(c)
+
+        cache = get_cache('default')
+        key = self.cp.cache_key(c)
+        entry = cache.get(key)
+        self.assertIsInstance(entry, codec.Chunked)
+        self.assertTrue(entry.count > 1)
+
+        chunk_keys = codec.chunk_keys(key, entry)
+        self.assertEqual(len(cache.get_many(chunk_keys)), entry.count)
+        self.assertEqual(self.cp.get(c), data)
+
+        # A missing chunk is a miss
+        cache.delete(chunk_keys[-1])
+        self.assertIsNone(self.cp.get(c))
+
+        # Flushing removes the chunks
+        self.assertEqual(self.cp.get_or_set(c), data)
+        entry = cache.get(key)
+        self.cp.flush(c)
+        self.assertEqual(cache.get_many(codec.chunk_keys(key, entry)), {})
+
+
+class CacheStatsTestCase(TestCase):
+    def setUp(self):
+        self.cp = CacheProxy(ComplexNumber.as_string,
+                             version='get_version',
+                             timeout=2,
+                             key_func=instance_cache_key)
+        self.events = []
+        reset_stats()
+
+    def tearDown(self):
+        reset_stats()
+
+    def hook(self, name, counter, amount):
+        self.events.append((name, counter, amount))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=True)
+    def test(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        self.cp.get_or_set(c)
+        self.cp.get_or_set(c)
+        self.cp.get_or_set(c)
+
+        counters = stats.snapshot()['complexnumber.as_string']
+        self.assertEqual(counters['hits'], 2)
+        self.assertEqual(counters['misses'], 1)
+        self.assertTrue(counters['bytes'] > 0)
+        self.assertEqual(counters['set_failures'], 0)
+
+        # Shared counters include the amounts not yet merged
+        self.assertEqual(get_stats()['complexnumber.as_string'], counters)
+
+        # Merged amounts are not merged again
+        self.assertEqual(get_stats()['complexnumber.as_string'], counters)
+
+        reset_stats()
+        self.assertEqual(stats.snapshot(), {})
+        self.assertEqual(get_stats(), {})
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=True)
+    def test_cached_none(self):
+        calls = []
+
+        def as_none(instance, *args, **kwargs):
+            calls.append(instance)
+
+        cp = CacheProxy(as_none, version='get_version', timeout=2,
+                        key_func=instance_cache_key)
+
+        c = ComplexNumber()
+        cp.flush(c)
+
+        # None is data like any other, only the first lookup is a miss
+        self.assertEqual(cp.get_or_set(c), None)
+        self.assertEqual(cp.get_or_set(c), None)
+        self.assertEqual(proxy.get_or_set_many([(cp, c)]), [None])
+        self.assertTrue(cp.cached(c))
+        self.assertEqual(len(calls), 1)
+
+        counters = stats.snapshot()['complexnumber.as_none']
+        self.assertEqual(counters['misses'], 1)
+        self.assertEqual(counters['hits'], 2)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=False)
+    def test_disabled(self):
+        c = ComplexNumber()
+        self.cp.get_or_set(c)
+        self.assertEqual(stats.snapshot(), {})
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=True)
+    def test_hook(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        with self.settings(AVOCADO_DATA_CACHE_STATS_HOOK=self.hook):
+            self.cp.get_or_set(c)
+
+        counters = [e[1] for e in self.events]
+        self.assertEqual(counters, ['misses', 'compute_time', 'bytes'])
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=True,
+                       AVOCADO_DATA_CACHE_TAGS_ENABLED=False)
+    def test_set_failure(self):
+        c = ComplexNumber()
+        self.cp.flush(c)
+
+        def failing_set(*args, **kwargs):
+            raise IOError
+
+        backend = get_cache('default').__class__
+        backend_set = backend.set
+        backend.set = failing_set
+
+        try:
+            # The data is still returned
+            self.assertEqual(self.cp.get_or_set(c), '2+3i')
+        finally:
+            backend.set = backend_set
+
+        counters = stats.snapshot()['complexnumber.as_string']
+        self.assertEqual(counters['set_failures'], 1)
+        self.assertEqual(counters['bytes'], 0)
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        self.cp = CacheProxy(ComplexNumber.as_string,
+                             version='get_version',
+                             timeout=10,
+                             key_func=instance_cache_key,
+                             single_flight=True)
+        self.c = ComplexNumber()
+        self.cp.flush(self.c)
+
+        self.cache = get_cache('default')
+        self.key = self.cp.cache_key(self.c)
+        self.lock_key = self.cp.lock_key(self.key)
+
+    def tearDown(self):
+        self.cache.delete(self.lock_key)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test(self):
+        self.assertEqual(self.cp.get_or_set(self.c), '2+3i')
+        self.assertTrue(self.cp.cached(self.c))
+
+        # Lock is released
+        self.assertFalse(self.lock_key in self.cache)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_LOCK_WAIT=0.3)
+    def test_wait_timeout(self):
+        # Simulate another process holding the lock
+        self.cache.add(self.lock_key, 1)
+
+        start = time.time()
+        self.assertEqual(self.cp.get_or_set(self.c), '2+3i')
+
+        # Computed after waiting on the other process
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertTrue(self.cp.cached(self.c))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_SERVE_STALE=True)
+    def test_serve_stale(self):
+        stale_key = self.cp.stale_cache_key(self.c)
+        self.cache.set(stale_key, '1+1i')
+
+        self.cache.add(self.lock_key, 1)
+
+        # Stale data is returned while the other process holds the lock
+        self.assertEqual(self.cp.get_or_set(self.c), '1+1i')
+        self.assertFalse(self.cp.cached(self.c))
+
+        self.cache.delete(self.lock_key)
+
+        # Lock is acquired, the data is computed and the stale copy updated
+        self.assertEqual(self.cp.get_or_set(self.c), '2+3i')
+        self.assertEqual(self.cache.get(stale_key), '2+3i')
+
+        # Flushing removes the stale data as well
+        self.cp.flush(self.c)
+        self.assertIsNone(self.cache.get(stale_key))
+
+
+class CacheTagsTestCase(TestCase):
+    def setUp(self):
+        self.f1 = Foo(value=1)
+        self.f1.save()
+
+        self.f2 = Foo(value=2)
+        self.f2.save()
+
+        self.f1.default_versioned.flush(self.f1)
+        self.f2.default_versioned.flush(self.f2)
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_instance(self):
+        self.assertEqual(self.f1.default_versioned(), [1])
+        self.assertEqual(self.f2.default_versioned(), [2])
+
+        invalidate_tags(instance_tag(self.f1))
+
+        self.assertFalse(self.f1.default_versioned.cached(self.f1))
+        self.assertTrue(self.f2.default_versioned.cached(self.f2))
+
+        # Recomputed with the new generation
+        self.assertEqual(self.f1.default_versioned(), [1])
+        self.assertTrue(self.f1.default_versioned.cached(self.f1))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_model(self):
+        self.f1.default_versioned()
+        self.f2.default_versioned()
+
+        invalidate_tags(model_tag('core', 'foo'))
+
+        self.assertFalse(self.f1.default_versioned.cached(self.f1))
+        self.assertFalse(self.f2.default_versioned.cached(self.f2))
+
+        self.f1.default_versioned()
+        invalidate_tags(app_tag('core'))
+        self.assertFalse(self.f1.default_versioned.cached(self.f1))
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_TAGS_ENABLED=False)
+    def test_disabled(self):
+        self.f1.default_versioned()
+
+        invalidate_tags(instance_tag(self.f1))
+
+        self.assertTrue(self.f1.default_versioned.cached(self.f1))
+
+
 class CacheManagerTestCase(TestCase):
     @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
     def test(self):
@@ -169,6 +617,44 @@ class TestIssue136(TestCase):
         self.assertTrue(self.f2.default_versioned.cached(self.f2))
 
 
+class CacheKeyTestCase(TestCase):
+    def test_prefix(self):
+        f = Foo(pk=1)
+
+        key = instance_cache_key(f, label='values', version=1)
+
+        # Memoized prefix results in the same key
+        self.assertEqual(instance_cache_key(f, label='values', version=1), key)
+        self.assertNotEqual(
+            instance_cache_key(f, label='labels', version=1), key)
+        self.assertNotEqual(
+            instance_cache_key(Foo(pk=2), label='values', version=1), key)
+
+        # Empty arguments do not affect the key
+        self.assertEqual(instance_cache_key(f, label='values', version=1,
+                                            args=(), kwargs={}), key)
+        self.assertEqual(instance_cache_key(f, label='values', version=1,
+                                            kwargs={'queryset': None}), key)
+
+    def test_queryset(self):
+        f = Foo(pk=1)
+        qs1 = Foo.objects.filter(value=1)
+        qs2 = Foo.objects.filter(value=1)
+        qs3 = qs1.filter(value=2)
+
+        key = instance_cache_key(f, label='values', kwargs={'queryset': qs1})
+
+        self.assertEqual(
+            instance_cache_key(f, label='values', kwargs={'queryset': qs1}),
+            key)
+        self.assertEqual(
+            instance_cache_key(f, label='values', kwargs={'queryset': qs2}),
+            key)
+        self.assertNotEqual(
+            instance_cache_key(f, label='values', kwargs={'queryset': qs3}),
+            key)
+
+
 class TestIssue309(TestCase):
     def test(self):
         qs1 = Foo.objects.all()
@@ -1,16 +1,20 @@
 from copy import deepcopy
 from django.test import TestCase
+from django.db.models import F
 from django.core import management
 from django.test.utils import override_settings
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from guardian.shortcuts import assign
+from avocado.core.cache import pk_cache_key
+from avocado.core.cache.model import instance_cache_key
 from avocado.models import DataField, DataConcept, DataConceptField, \
     DataContext, DataView, DataQuery, DataCategory
 from ...models import Employee
 
 
+@override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
 class ModelInstanceCacheTestCase(TestCase):
     def setUp(self):
         management.call_command('avocado', 'init', 'tests', publish=False,
@@ -34,6 +38,108 @@ class ModelInstanceCacheTestCase(TestCase):
         self.assertGreater(len(queryset), 0)
         self.assertEqual(queryset._result_cache[0].pk, pk)
 
+    def test_pk_in(self):
+        cache.clear()
+
+        pks = list(DataField.objects.values_list('pk', flat=True)[:3])
+        self.is_manager.save()
+
+        if self.is_manager.pk not in pks:
+            pks[-1] = self.is_manager.pk
+
+        # The default ordering of the model is cleared
+        queryset = DataField.objects.order_by()
+
+        # Only the fields missing from the cache are queried
+        with self.assertNumQueries(1):
+            fields = list(queryset.filter(pk__in=pks))
+
+        # Returned in the order of the lookup
+        self.assertEqual([f.pk for f in fields], pks)
+
+        # All fields were written back to the cache
+        with self.assertNumQueries(0):
+            fields = list(queryset.filter(pk__in=pks[::-1]))
+
+        self.assertEqual([f.pk for f in fields], pks[::-1])
+
+        # Unknown primary keys are omitted
+        with self.assertNumQueries(1):
+            fields = list(queryset.filter(pk__in=pks + [0]))
+
+        self.assertEqual([f.pk for f in fields], pks)
+
+        # Fields are ordered by their category by default, so the lookup
+        # is not cached
+        with self.assertNumQueries(1):
+            list(DataField.objects.filter(pk__in=pks))
+
+        with override_settings(AVOCADO_DATA_CACHE_ENABLED=False):
+            with self.assertNumQueries(1):
+                list(queryset.filter(pk__in=pks))
+
+    def test_pk_in_ordering(self):
+        cache.clear()
+
+        pks = list(DataField.objects.values_list('pk', flat=True)[:3])
+        list(DataField.objects.order_by().filter(pk__in=pks))
+
+        opts = DataField._meta
+        ordering = opts.ordering
+        opts.ordering = ('-name', 'pk')
+
+        # The cached instances are sorted by the default ordering
+        try:
+            with self.assertNumQueries(0):
+                fields = list(DataField.objects.filter(pk__in=pks))
+
+            expected = list(DataField.objects.filter(pk__in=pks)
+                            .order_by('-name', 'pk'))
+        finally:
+            opts.ordering = ordering
+
+        self.assertEqual(fields, expected)
+
+    def test_pk_cache_key(self):
+        pk = self.is_manager.pk
+
+        self.assertEqual(pk_cache_key(DataField, pk),
+                         instance_cache_key(self.is_manager))
+        self.assertEqual(pk_cache_key(DataField, pk, using='default'),
+                         pk_cache_key(DataField, pk))
+        self.assertNotEqual(pk_cache_key(DataField, pk, using='other'),
+                            pk_cache_key(DataField, pk))
+
+    def test_update(self):
+        cache.clear()
+
+        pk = self.is_manager.pk
+        list(DataField.objects.filter(pk__in=[pk]))
+
+        DataField.objects.filter(pk=pk) \
+            .update(data_version=F('data_version') + 1)
+
+        # The outdated instance is not served from the cache
+        with self.assertNumQueries(1):
+            field, = DataField.objects.filter(pk=pk)
+
+        self.assertEqual(field.data_version, self.is_manager.data_version + 1)
+
+    def test_pk_filtered(self):
+        cache.clear()
+
+        self.is_manager.published = False
+        self.is_manager.save()
+
+        # Other conditions are not bypassed by the cached instance
+        queryset = DataField.objects.published() \
+            .filter(pk=self.is_manager.pk)
+        self.assertEqual(list(queryset), [])
+
+        queryset = DataField.objects.filter(pk=self.is_manager.pk,
+                                            published=True)
+        self.assertEqual(list(queryset), [])
+
 
 class DataFieldTestCase(TestCase):
     def setUp(self):
@@ -166,6 +272,40 @@ class DataFieldManagerTestCase(TestCase):
         self.assertEqual(
             [x.pk for x in DataField.objects.published(user2)], [])
 
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_prefetch_cached(self):
+        cache.clear()
+
+        title = DataField.objects.get_by_natural_key(
+            'tests', 'title', 'name')
+        fields = [self.is_manager, title]
+
+        self.assertFalse(self.is_manager.values.cached(self.is_manager))
+        self.assertFalse(title.labels.cached(title))
+
+        data = DataField.objects.prefetch_cached(
+            fields, methods=['values', 'labels'])
+
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[(title.pk, 'values')], title.values())
+        self.assertEqual(data[(self.is_manager.pk, 'labels')],
+                         self.is_manager.labels())
+
+        self.assertTrue(self.is_manager.values.cached(self.is_manager))
+        self.assertTrue(self.is_manager.labels.cached(self.is_manager))
+        self.assertTrue(title.values.cached(title))
+        self.assertTrue(title.labels.cached(title))
+
+        # Non-cached methods are rejected
+        self.assertRaises(ValueError, DataField.objects.prefetch_cached,
+                          fields, methods=['value_labels'])
+
+        # Nothing is computed when the cache is disabled
+        with override_settings(AVOCADO_DATA_CACHE_ENABLED=False):
+            with self.assertNumQueries(0):
+                self.assertEqual(DataField.objects.prefetch_cached(
+                    fields, methods=['values', 'labels']), {})
+
 
 class DataFieldQuerysetTestCase(TestCase):
     fixtures = ['tests/fixtures/employee_data.json']
@@ -625,7 +765,7 @@ class DataQueryTestCase(TestCase):
 
         self.assertEqual(
             unicode(query.apply(tree=Employee).query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id", '
+            'SELECT "tests_employee"."id", '
             '"tests_office"."location" FROM '
             '"tests_employee" INNER JOIN "tests_title" ON '
             '("tests_employee"."title_id" = "tests_title"."id") INNER JOIN '
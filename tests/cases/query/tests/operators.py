@@ -103,6 +103,8 @@ class OperatorTestCase(TestCase):
         self.assertEqual(op.text([1, 2, 3]), 'is either 1, 2 or 3')
         self.assertEqual(op.text([1, 2, 3, 4, 5]),
                          'is either 1, 2, 3 ... (1 more) or 5')
+        self.assertEqual(op.text(range(10000)),
+                         'is either 0, 1, 2 ... (9996 more) or 9999')
 
     def test_notinlist(self):
         op = operators.get('-in')
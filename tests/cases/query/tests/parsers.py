@@ -1,10 +1,12 @@
 from copy import deepcopy
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.exceptions import ValidationError
 from django.core import management
 from avocado.query import oldparsers as parsers
-from avocado.models import DataConcept, DataField, DataConceptField
-from ....models import Employee
+from avocado.models import DataConcept, DataContext, DataField, \
+    DataConceptField
+from ....models import Employee, Office, Project, Title
 
 
 class DataContextParserTestCase(TestCase):
@@ -143,6 +145,46 @@ class DataContextParserTestCase(TestCase):
         self.assertFalse(attrs['children'][0]['enabled'])
         self.assertTrue(attrs['children'][1].get('enabled', True))
 
+    @override_settings(AVOCADO_IN_SUBQUERY_THRESHOLD=2)
+    def test_key_labels(self):
+        DataField(app_name='tests', model_name='title', field_name='id',
+                  label_field_name='name').save()
+
+        intern = Title.objects.create(name='Intern')
+        chef = Title.objects.create(name='Chef')
+
+        # Only the labels of the cleaned values are looked up
+        attrs = parsers.datacontext.validate({
+            'field': 'tests.title.id',
+            'operator': 'in',
+            'value': [intern.pk, chef.pk],
+        }, tree=Employee)
+
+        self.assertEqual(attrs['cleaned_value'], [
+            {'value': intern.pk, 'label': 'Intern'},
+            {'value': chef.pk, 'label': 'Chef'},
+        ])
+        self.assertFalse('cleaned_value_more' in attrs)
+
+        titles = [Title.objects.create(name='Title {0}'.format(i))
+                  for i in range(6)]
+
+        # Only the values displayed in the language are labeled
+        attrs = parsers.datacontext.validate({
+            'field': 'tests.title.id',
+            'operator': 'in',
+            'value': [t.pk for t in titles],
+        }, tree=Employee)
+
+        self.assertEqual(attrs['cleaned_value'], [
+            {'value': titles[0].pk, 'label': 'Title 0'},
+            {'value': titles[1].pk, 'label': 'Title 1'},
+            {'value': titles[2].pk, 'label': 'Title 2'},
+            {'value': titles[5].pk, 'label': 'Title 5'},
+        ])
+        self.assertEqual(attrs['cleaned_value_more'], 2)
+        self.assertTrue('(2 more)' in attrs['language'])
+
     def test_field_for_concept(self):
         f = DataField.objects.get(model_name='title', field_name='name')
         c1 = DataConcept()
@@ -175,6 +217,273 @@ class DataContextParserTestCase(TestCase):
 
         self.assertFalse(attrs['enabled'])
 
+    def test_bulk_resolve(self):
+        keys = ['tests.title.salary', 'tests.project.budget']
+
+        def context(n):
+            return {
+                'type': 'and',
+                'children': [{
+                    'field': keys[i % len(keys)],
+                    'operator': 'gt',
+                    'value': 0,
+                } for i in range(n)]
+            }
+
+        # The fields are resolved in one query regardless of the number
+        # of conditions.
+        with self.assertNumQueries(1):
+            node = parsers.datacontext.parse(context(2), tree=Employee)
+
+        with self.assertNumQueries(1):
+            node = parsers.datacontext.parse(context(20), tree=Employee)
+
+        self.assertEqual([c.field.natural_key() for c in node.children[:2]],
+                         [tuple(k.split('.')) for k in keys])
+
+        # Translating the conditions requires no further queries
+        with self.assertNumQueries(0):
+            node.condition
+
+        with self.assertNumQueries(1):
+            attrs = parsers.datacontext.validate(context(20), tree=Employee)
+
+        self.assertTrue(attrs.get('enabled', True))
+        self.assertEqual(attrs['children'][0]['language'],
+                         'Salary is greater than 0.0')
+
+    @override_settings(AVOCADO_QUERY_PLAN_CACHE_ENABLED=True)
+    def test_compiled_node(self):
+        attrs = {
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'gt',
+                'value': 10000,
+            }, {
+                'field': 'tests.title.name',
+                'operator': 'in',
+                'value': ['CEO', 'Programmer'],
+            }]
+        }
+
+        translated = []
+        translate = DataField.translate
+
+        def counted(self, *args, **kwargs):
+            translated.append(self.pk)
+            return translate(self, *args, **kwargs)
+
+        DataField.translate = counted
+
+        try:
+            node = parsers.datacontext.compile_node(attrs, tree=Employee)
+            self.assertEqual(len(translated), 2)
+
+            # The plan is reused, so only the fields are resolved
+            with self.assertNumQueries(1):
+                cached = parsers.datacontext.compile_node(attrs,
+                                                          tree=Employee)
+            self.assertEqual(len(translated), 2)
+
+            self.assertEqual(list(cached.apply().values_list('pk')),
+                             list(node.apply().values_list('pk')))
+            self.assertEqual(cached.language, node.language)
+
+            # The language is not compiled
+            del translated[:]
+
+            # Bumping the data version of a field results in a new plan
+            field = DataField.objects.get_by_natural_key('tests.title.name')
+            field.data_version += 1
+            field.save()
+
+            parsers.datacontext.compile_node(attrs, tree=Employee)
+            self.assertEqual(len(translated), 2)
+
+            # The plan is keyed by the context passed to the translators
+            parsers.datacontext.compile_node(attrs, tree=Employee,
+                                             required=False)
+            parsers.datacontext.compile_node(attrs, tree=Employee,
+                                             required=False)
+            self.assertEqual(len(translated), 4)
+
+            # and the settings it is compiled with
+            with override_settings(AVOCADO_IN_SUBQUERY_THRESHOLD=1):
+                parsers.datacontext.compile_node(attrs, tree=Employee)
+            self.assertEqual(len(translated), 6)
+
+            # Unhashable context is not cached
+            parsers.datacontext.compile_node(attrs, tree=Employee,
+                                             initial=[])
+            parsers.datacontext.compile_node(attrs, tree=Employee,
+                                             initial=[])
+            self.assertEqual(len(translated), 10)
+        finally:
+            DataField.translate = translate
+
+    @override_settings(AVOCADO_QUERY_OPTIMIZER_ENABLED=True)
+    def test_optimize(self):
+        def salary(operator, value):
+            return {'field': 'tests.title.salary', 'operator': operator,
+                    'value': value}
+
+        def name(operator, value):
+            return {'field': 'tests.title.name', 'operator': operator,
+                    'value': value}
+
+        def optimize(attrs):
+            return parsers.datacontext.optimize(
+                parsers.datacontext.parse(attrs, tree=Employee))
+
+        # Nested branches are flattened and duplicates removed
+        node = optimize({
+            'type': 'and',
+            'children': [{
+                'type': 'and',
+                'children': [salary('gt', 1000)],
+            }, salary('gt', 1000), {
+                'type': 'or',
+                'children': [salary('gt', 1000)],
+            }]
+        })
+        self.assertTrue(isinstance(node, parsers.datacontext.Condition))
+        self.assertEqual((node.operator, node.value), ('gt', 1000))
+
+        # Bounds on the same field are merged
+        node = optimize({
+            'type': 'and',
+            'children': [
+                salary('gte', 1000),
+                name('exact', 'CEO'),
+                salary('gt', 1000),
+                salary('lt', 50000),
+                salary('range', [0, 40000]),
+            ]
+        })
+        self.assertEqual([(c.operator, c.value) for c in node.children],
+                         [('gt', 1000), ('lte', 40000.0),
+                          ('exact', 'CEO')])
+
+        # Exact conditions on the same field are collapsed into `in`
+        node = optimize({
+            'type': 'or',
+            'children': [
+                name('exact', 'CEO'),
+                salary('lt', 10000),
+                name('in', ['Programmer', 'Analyst']),
+                name('exact', 'CEO'),
+            ]
+        })
+        self.assertEqual([(c.operator, c.value) for c in node.children],
+                         [('in', ['CEO', 'Programmer', 'Analyst']),
+                          ('lt', 10000)])
+
+        # Contradicting conditions
+        node = optimize({
+            'type': 'or',
+            'children': [{
+                'type': 'and',
+                'children': [salary('gt', 50000), salary('lte', 10000)],
+            }, {
+                'type': 'and',
+                'children': [salary('exact', 10000), salary('exact', 20000)],
+            }]
+        })
+        self.assertTrue(node.empty)
+
+        node = optimize({
+            'type': 'or',
+            'children': [{
+                'type': 'and',
+                'children': [salary('gt', 10000), salary('lt', 10000)],
+            }, salary('exact', 10000)]
+        })
+        self.assertFalse(node.empty)
+        self.assertEqual((node.operator, node.value), ('exact', 10000))
+
+        cxt = DataContext(json={
+            'type': 'and',
+            'children': [salary('gte', 10000), salary('exact', 5000)],
+        })
+
+        # Only the fields are resolved
+        with self.assertNumQueries(1):
+            self.assertEqual(list(cxt.apply(tree=Employee)), [])
+
+    def test_semijoin(self):
+        office = Office.objects.create(location='Outer Office')
+        employees = [Employee.objects.create(first_name=name, last_name='Bob',
+                                             office=office)
+                     for name in ('Zed', 'Zoe', 'Zack')]
+
+        a = Project.objects.create(name='A', budget=100,
+                                   manager=employees[0])
+        a.employees.add(employees[0], employees[1])
+        b = Project.objects.create(name='B', budget=5, manager=employees[2])
+        b.employees.add(employees[1], employees[2])
+
+        def project(field, operator, value):
+            return {'field': 'tests.project.{0}'.format(field),
+                    'operator': operator, 'value': value}
+
+        def subqueries(q):
+            return sum(subqueries(c) if hasattr(c, 'children')
+                       else int(c[0] == 'pk__in') for c in q.children)
+
+        def assertSemijoin(attrs, count):
+            node = parsers.datacontext.parse(attrs, tree=Employee)
+            condition = parsers.datacontext.semijoin_condition(node)
+            self.assertEqual(subqueries(condition), count)
+
+            self.assertEqual(
+                sorted(Employee.objects.filter(condition)
+                       .values_list('pk', flat=True)),
+                sorted(Employee.objects.filter(node.condition).distinct()
+                       .values_list('pk', flat=True)))
+
+        # Conditions on the same related row are grouped
+        assertSemijoin({
+            'type': 'and',
+            'children': [
+                project('budget', 'gte', 50),
+                project('name', 'exact', 'A'),
+                {'field': 'tests.employee.first_name', 'operator': 'exact',
+                 'value': 'Zoe'},
+            ]
+        }, 1)
+
+        assertSemijoin({
+            'type': 'or',
+            'children': [
+                project('budget', 'lt', 50),
+                {'type': 'and', 'children': [
+                    project('name', 'exact', 'A'),
+                    project('budget', 'gt', 50),
+                ]},
+            ]
+        }, 1)
+
+        # The project path is shared with a child on the meeting path, so
+        # its join is kept to apply both conditions to the same row. Only
+        # the meeting condition is grouped.
+        assertSemijoin({
+            'type': 'and',
+            'children': [
+                project('budget', 'gte', 50),
+                {'type': 'or', 'children': [
+                    project('name', 'exact', 'B'),
+                    {'field': 'tests.meeting.start_time', 'operator': 'lt',
+                     'value': '2000-01-01 00:00:00'},
+                ]},
+            ]
+        }, 1)
+
+        self.assertEqual(
+            DataContext(json=project('name', 'exact', 'A'))
+            .apply(tree=Employee).filter(pk__in=[e.pk for e in employees])
+            .count(), 2)
+
     def test_parsed_node(self):
         node = parsers.datacontext.parse({
             'type': 'and',
@@ -212,7 +521,7 @@ class DataContextParserTestCase(TestCase):
 
         self.assertEqual(
             unicode(node.apply().values('id').query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id" FROM "tests_employee" '
+            'SELECT "tests_employee"."id" FROM "tests_employee" '
             'INNER JOIN "tests_title" ON ("tests_employee"."title_id" = '
             '"tests_title"."id") WHERE "tests_title"."boss" = True '
             .replace(' ', ''))
@@ -240,7 +549,7 @@ class DataContextParserTestCase(TestCase):
 
         self.assertEqual(
             unicode(node.apply().values('id').query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id" FROM "tests_employee" '
+            'SELECT "tests_employee"."id" FROM "tests_employee" '
             'INNER JOIN "tests_title" ON ("tests_employee"."title_id" = '
             '"tests_title"."id") WHERE ("tests_employee"."first_name" = John '
             'AND "tests_title"."boss" = True )'.replace(' ', ''))
@@ -526,7 +835,7 @@ class DataQueryParserTestCase(TestCase):
 
         self.assertEqual(
             unicode(node.apply().query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id", '
+            'SELECT "tests_employee"."id", '
             '"tests_employee"."first_name", "tests_employee"."last_name" FROM '
             '"tests_employee" INNER JOIN "tests_title" ON '
             '("tests_employee"."title_id" = "tests_title"."id") '
@@ -543,7 +852,7 @@ class DataQueryParserTestCase(TestCase):
 
         self.assertEqual(
             unicode(node.apply().query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id", '
+            'SELECT "tests_employee"."id", '
             '"tests_employee"."first_name", '
             '"tests_employee"."last_name" FROM "tests_employee" '
             'ORDER BY "tests_employee"."first_name" DESC, '
@@ -560,7 +869,7 @@ class DataQueryParserTestCase(TestCase):
 
         self.assertEqual(
             unicode(node.apply().values('id').query).replace(' ', ''),
-            'SELECT DISTINCT "tests_employee"."id" FROM "tests_employee" '
+            'SELECT "tests_employee"."id" FROM "tests_employee" '
             'INNER JOIN "tests_title" ON ("tests_employee"."title_id" = '
             '"tests_title"."id") WHERE "tests_title"."boss" = True '
             .replace(' ', ''))
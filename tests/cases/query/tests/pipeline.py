@@ -1,7 +1,12 @@
 from django.core import management
-from django.test import TestCase
-from avocado.query.pipeline import QueryProcessor
-from avocado.models import DataConcept, DataView
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from avocado.query import pipeline
+from avocado.query.pipeline import QueryProcessor, stream_sql
+from avocado.query.utils import ensure_connection
+from avocado.models import DataConcept, DataField, DataView
 from tests.models import Employee
 
 
@@ -45,3 +50,189 @@ class QueryProcessorTestCase(TestCase):
         i = p.get_iterable(queryset=q)
 
         self.assertEqual(len(list(i)), 0)
+
+    def test_stream(self):
+        p = QueryProcessor(view=self.v, tree=Employee)
+        q = p.get_queryset()
+
+        rows = list(p.get_iterable(queryset=q))
+
+        # The query is not executed until the rows are iterated
+        with self.assertNumQueries(0):
+            i = p.get_iterable(queryset=q, stream=True)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(i), rows)
+
+        self.assertEqual(list(p.get_iterable(queryset=q.none(), stream=True)),
+                         [])
+
+    @override_settings(AVOCADO_QUERY_STREAMING_ENABLED=True,
+                       AVOCADO_QUERY_STREAMING_BATCH_SIZE=4)
+    def test_stream_batches(self):
+        p = QueryProcessor(view=self.v, tree=Employee)
+        q = p.get_queryset()
+
+        self.assertEqual(len(list(p.get_iterable(queryset=q))), 6)
+
+        compiler = q.query.get_compiler(q.db)
+        batches = list(stream_sql(compiler))
+
+        self.assertEqual([len(x) for x in batches], [4, 2])
+
+    def test_server_side_cursor_errors(self):
+        conn = connections['default']
+        ensure_connection(conn)
+
+        # Errors of the driver are raised as Django errors
+        cursor = pipeline.ServerSideCursor(conn, conn.connection.cursor())
+        self.assertRaises(DatabaseError, cursor.execute,
+                          'SELECT * FROM avocado_missing')
+        cursor.close()
+
+    def test_distinct(self):
+        name = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+        salary = DataField.objects.get_by_natural_key('tests', 'title',
+                                                      'salary')
+        view = DataView(json=[{
+            'concept': name.concepts.all()[0].pk,
+        }, {
+            'concept': salary.concepts.all()[0].pk,
+            'visible': False,
+            'sort': 'desc',
+        }])
+
+        p = QueryProcessor(view=view, tree=Employee, include_pk=False)
+        q = p.get_queryset()
+
+        # De-duplicated as they are read
+        expected = []
+        for row in p.get_iterable(queryset=q):
+            if row[:1] not in expected:
+                expected.append(row[:1])
+
+        rows = [row[:1] for row in p.get_distinct_iterable(1, queryset=q)]
+        self.assertEqual(rows, expected)
+        self.assertTrue(len(rows) < Employee.objects.count())
+
+        with self.assertNumQueries(1):
+            rows = list(p.get_distinct_iterable(1, queryset=q, offset=1,
+                                                limit=2))
+
+        self.assertEqual([row[:1] for row in rows], expected[1:3])
+
+        # Each row is for a distinct employee
+        p = QueryProcessor(view=view, tree=Employee)
+        rows = list(p.get_distinct_iterable(2, queryset=p.get_queryset()))
+        self.assertEqual(len(rows), 6)
+
+        # The derived table has unique column names
+        project = DataField.objects.get_by_natural_key('tests', 'project',
+                                                       'name')
+        view.json.insert(1, {'concept': project.concepts.all()[0].pk})
+
+        p = QueryProcessor(view=view, tree=Employee, include_pk=False)
+        q = p.get_queryset()
+
+        compiler = pipeline.distinct_compiler(q, 2)
+        sql, params = compiler.as_sql()
+        self.assertTrue('"tests_project"."name" AS Col' in sql)
+
+        rows = list(p.get_distinct_iterable(2, queryset=q))
+        self.assertEqual(len(rows), len(set(row[:2] for row in rows)))
+
+    def test_distinct_fallback(self):
+        name = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+        salary = DataField.objects.get_by_natural_key('tests', 'title',
+                                                      'salary')
+        view = DataView(json=[{
+            'concept': name.concepts.all()[0].pk,
+        }, {
+            'concept': salary.concepts.all()[0].pk,
+            'visible': False,
+            'sort': 'desc',
+        }])
+
+        p = QueryProcessor(view=view, tree=Employee, include_pk=False)
+        q = p.get_queryset()
+
+        supports_window_functions = pipeline.supports_window_functions
+
+        # The rows are de-duplicated as they are read instead
+        pipeline.supports_window_functions = lambda connection: False
+
+        try:
+            self.assertIsNone(p.get_distinct_iterable(1, queryset=q))
+        finally:
+            pipeline.supports_window_functions = supports_window_functions
+
+        distinct_compiler = pipeline.distinct_compiler
+
+        # Errors of the query are not hidden
+        def rejected(*args, **kwargs):
+            compiler = distinct_compiler(*args, **kwargs)
+            compiler.as_sql = lambda *args, **kwargs: (
+                'SELECT * FROM avocado_missing', ())
+            return compiler
+
+        pipeline.distinct_compiler = rejected
+
+        try:
+            rows = p.get_distinct_iterable(1, queryset=q, offset=1, limit=2)
+            self.assertRaises(DatabaseError, list, rows)
+        finally:
+            pipeline.distinct_compiler = distinct_compiler
+
+        # An empty result
+        q = q.filter(pk__in=[])
+        self.assertEqual(list(p.get_distinct_iterable(1, queryset=q)), [])
+
+
+if 'postgres' in settings.DATABASES:
+    class PostgresStreamTestCase(TransactionTestCase):
+        fixtures = ['tests/fixtures/employee_data.json']
+        multi_db = True
+
+        def setUp(self):
+            self.conn = connections['postgres']
+            ensure_connection(self.conn)
+            self.queryset = Employee.objects.using('postgres') \
+                .values_list('pk', flat=True).order_by('pk')
+
+        def tearDown(self):
+            pipeline.set_autocommit(self.conn, True)
+
+        def stream(self):
+            compiler = self.queryset.query.get_compiler('postgres')
+            return stream_sql(compiler, batch_size=2)
+
+        def test_autocommit(self):
+            pipeline.set_autocommit(self.conn, True)
+
+            # The rows are read in a transaction begun for the cursor
+            batches = self.stream()
+            next(batches)
+            self.assertFalse(self.conn.connection.autocommit)
+
+            batches.close()
+            self.assertTrue(self.conn.connection.autocommit)
+
+        def test_transaction(self):
+            pipeline.set_autocommit(self.conn, False)
+
+            rows = [row for batch in self.stream() for row in batch]
+            self.assertEqual(rows, list(self.queryset))
+
+            # The transaction is left to its owner
+            self.assertFalse(self.conn.connection.autocommit)
+            self.conn.connection.rollback()
+
+        def test_errors(self):
+            pipeline.set_autocommit(self.conn, True)
+
+            cursor = pipeline.server_side_cursor(self.conn)
+            self.assertRaises(DatabaseError, cursor.execute,
+                              'SELECT * FROM avocado_missing')
+            cursor.close()
+
+            self.assertTrue(self.conn.connection.autocommit)
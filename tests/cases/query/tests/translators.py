@@ -1,8 +1,13 @@
+from django import forms
 from django.test import TestCase
 from django.core import management
 from django.core.exceptions import ValidationError
+from django.test.utils import override_settings
 from avocado.models import DataField
-from ....models import Employee, Project
+from avocado.query import lookups
+from avocado.query.operators import registry as operators
+from avocado.query.translators import Translator
+from ....models import Employee, Office, Project, Title
 
 
 class BaseTestCase(TestCase):
@@ -81,6 +86,174 @@ class TranslatorTestCase(BaseTestCase):
                           value=50.3932, tree=Project)
 
 
+class TranslatorBulkTestCase(BaseTestCase):
+    def test_int_in(self):
+        trans = self.salary.translate(
+            value=[10000, '20000'], operator='in', tree=Employee)
+        self.assertEqual(trans['cleaned_data']['value'], [10000.0, 20000.0])
+
+        self.assertRaises(ValidationError, self.salary.translate,
+                          value=[10000, 'foo'], operator='in', tree=Employee)
+
+    def test_int_form_in(self):
+        class IntegerTranslator(Translator):
+            form_class = forms.IntegerField
+
+        trans = IntegerTranslator().translate(
+            self.salary, 'in', [10000, '20000'], Employee)
+        self.assertEqual(trans['cleaned_data']['value'], [10000, 20000])
+        self.assertEqual(type(trans['cleaned_data']['value'][1]), int)
+
+        self.assertRaises(ValidationError, IntegerTranslator().translate,
+                          self.salary, 'in', [10000, 1.5], Employee)
+
+    def test_float_validate(self):
+        # Newer versions of Django reject NaN and infinity in `validate`
+        def validate(formfield, value):
+            forms.Field.validate(formfield, value)
+
+            if value in (float('inf'), float('-inf')):
+                raise ValidationError('Infinite')
+
+        forms.FloatField.validate = validate
+        self.addCleanup(delattr, forms.FloatField, 'validate')
+
+        self.assertRaises(ValidationError, self.salary.translate,
+                          value=[10000, float('inf')], operator='in',
+                          tree=Employee)
+
+    def test_char_in(self):
+        values = ['Robert{0}'.format(i) for i in range(1000)]
+
+        trans = self.first_name.translate(
+            value=values, operator='in', tree=Employee)
+        self.assertEqual(trans['cleaned_data']['value'],
+                         [unicode(x) for x in values])
+
+        # The form field validators are still applied
+        self.assertRaises(ValidationError, self.first_name.translate,
+                          value=['Robert', 'x' * 51], operator='in',
+                          tree=Employee)
+
+    def test_key_in(self):
+        management.call_command('avocado', 'init', 'tests.employee',
+                                include_keys=True, quiet=True)
+        pk = DataField.objects.get_by_natural_key('tests', 'employee', 'id')
+        fk = DataField.objects.get_by_natural_key('tests', 'employee',
+                                                  'title')
+
+        office = Office.objects.create(location='Outer Office')
+        title = Title.objects.create(name='Intern')
+        ids = [Employee.objects.create(first_name='Jim', last_name='Bob',
+                                       office=office, title=title).pk
+               for i in range(3)]
+
+        # Existence is checked with a single query
+        with self.assertNumQueries(1):
+            trans = pk.translate(value=[ids[0], str(ids[1]), ids[2]],
+                                 operator='in', tree=Employee)
+
+        self.assertEqual(trans['cleaned_data']['value'], ids)
+        self.assertEqual(unicode(trans['query_modifiers']['condition']),
+                         "(AND: ('id__in', {0!r}))".format(ids))
+
+        trans = fk.translate(value=[title.pk], operator='in', tree=Employee)
+        self.assertEqual(unicode(trans['query_modifiers']['condition']),
+                         "(AND: ('title__in', [{0}]))".format(title.pk))
+
+        self.assertRaises(ValidationError, pk.translate,
+                          value=[ids[0], max(ids) + 1], operator='in',
+                          tree=Employee)
+        self.assertRaises(ValidationError, fk.translate,
+                          value=[title.pk, 'foo'], operator='in',
+                          tree=Employee)
+
+        # The choices of the foreign key are limited the same way as its
+        # form field
+        rel = Employee._meta.get_field('title').rel
+        rel.limit_choices_to = {'boss': True}
+        self.addCleanup(setattr, rel, 'limit_choices_to', {})
+
+        self.assertRaises(ValidationError, fk.translate,
+                          value=[title.pk], operator='in', tree=Employee)
+
+
+class TranslatorSubqueryTestCase(BaseTestCase):
+    def setUp(self):
+        super(TranslatorSubqueryTestCase, self).setUp()
+        office = Office.objects.create(location='Outer Office')
+
+        for name in ('Zed', 'Zoe', 'Zack'):
+            Employee.objects.create(first_name=name, last_name='Bob',
+                                    office=office)
+
+    @override_settings(AVOCADO_IN_SUBQUERY_THRESHOLD=2)
+    def test_char_in(self):
+        trans = self.first_name.translate(
+            value=['Zed', 'Zoe', None], operator='in', tree=Employee)
+        condition = trans['query_modifiers']['condition']
+
+        queryset = Employee.objects.filter(condition)
+
+        # Compiling the query does not execute any statements
+        with self.assertNumQueries(0):
+            self.assertTrue('json_each' in unicode(queryset.query))
+
+        self.assertEqual(
+            sorted(queryset.values_list('first_name', flat=True)),
+            ['Zed', 'Zoe'])
+
+        with self.assertNumQueries(1):
+            queryset.count()
+
+        trans = self.first_name.translate(
+            value=['Zed', 'Zoe'], operator='-in', tree=Employee)
+        queryset = Employee.objects.filter(
+            trans['query_modifiers']['condition'])
+        self.assertTrue('Zack' in queryset.values_list('first_name',
+                                                       flat=True))
+        self.assertFalse('Zed' in queryset.values_list('first_name',
+                                                       flat=True))
+
+    def test_mysql_version(self):
+        class Connection(object):
+            vendor = 'mysql'
+            settings_dict = {'HOST': 'mysql', 'PORT': '', 'NAME': 'test'}
+            connection = None
+
+            @property
+            def mysql_version(self):
+                versions.append(True)
+                return (8, 0, 11)
+
+        versions = []
+        conn = Connection()
+
+        # No connection is opened while compiling
+        self.assertFalse(lookups.supports_json_values(conn))
+        self.assertEqual(versions, [])
+
+        # The version of an open connection is kept
+        conn.connection = object()
+        self.assertTrue(lookups.supports_json_values(conn))
+        self.assertTrue(lookups.supports_json_values(Connection()))
+        self.assertEqual(versions, [True])
+
+        lookups._mysql_versions.clear()
+
+    def test_large_in(self):
+        # Exceeds the variable limit of SQLite as a list of literals
+        values = ['Zed'] + ['Z{0}'.format(i) for i in range(5000)]
+
+        trans = self.first_name.translate(
+            value=values, operator='in', tree=Employee)
+        queryset = Employee.objects.filter(
+            trans['query_modifiers']['condition'])
+
+        self.assertEqual(list(queryset.values_list('first_name', flat=True)),
+                         ['Zed'])
+
+
 class TranslatorValueDictTestCase(BaseTestCase):
     def test_bool(self):
         trans = self.is_manager.translate(
@@ -106,3 +279,90 @@ class TranslatorValueDictTestCase(BaseTestCase):
             value={'value': 'Robert', 'label': 'Robert'}, tree=Employee)
         self.assertEqual(unicode(trans['query_modifiers']['condition']),
                          "(AND: ('first_name__exact', u'Robert'))")
+
+
+class PreparedTranslatorTestCase(BaseTestCase):
+    def test_prepare(self):
+        prepared = self.salary.prepared_translator
+
+        # Built once per field instance
+        self.assertTrue(self.salary.prepared_translator is prepared)
+        self.assertEqual(prepared.simple_type, 'number')
+        self.assertEqual(prepared.operators[0], 'exact')
+        self.assertTrue('isnull' in prepared.allowed_operators)
+        self.assertFalse('isnull' in
+                         self.first_name.prepared_translator.allowed_operators)
+
+        # Prepared again for a different translator
+        self.salary.translator = 'Unknown'
+        self.assertFalse(self.salary.prepared_translator is prepared)
+        self.assertEqual(self.salary.operators,
+                         [(x, operators[x].verbose_name)
+                          for x in prepared.field_operators])
+
+    def test_translate(self):
+        self.salary.enumerable = True
+        self.salary.prepared_translator
+
+        # No field lookups or queries are repeated per translation
+        with self.assertNumQueries(0):
+            self.salary.translate(value=[10000, 20000], operator='in',
+                                  tree=Employee)
+            self.salary.translate(value=50000, operator='-exact',
+                                  tree=Employee)
+
+
+class TranslatorLanguageTestCase(BaseTestCase):
+    def setUp(self):
+        super(TranslatorLanguageTestCase, self).setUp()
+        self.calls = 0
+        translator = self.salary.prepared_translator.translator
+        language = translator.language
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return language(*args, **kwargs)
+
+        translator.language = counted
+        self.addCleanup(delattr, translator, 'language')
+
+    @override_settings(AVOCADO_LANGUAGE_CACHE_MAX_ENTRIES=100)
+    def test_memoized(self):
+        values = range(10000, 20000)
+
+        trans = self.salary.translate(value=values, operator='in',
+                                      tree=Employee)
+        self.assertEqual(trans['cleaned_data']['language'],
+                         'Salary is either 10000.0, 10001.0, 10002.0 ... '
+                         '(9996 more) or 19999.0')
+
+        self.salary.translate(value=values, operator='in', tree=Employee)
+        self.assertEqual(self.calls, 1)
+
+        # Rendered again when the operator, value or field changes
+        self.salary.translate(value=values, operator='-in', tree=Employee)
+        self.salary.translate(value=values[1:], operator='in', tree=Employee)
+        self.assertEqual(self.calls, 3)
+
+        self.salary.name = 'Pay'
+        trans = self.salary.translate(value=50000, tree=Employee)
+        self.assertEqual(trans['cleaned_data']['language'], 'Pay is 50000.0')
+
+    @override_settings(AVOCADO_LANGUAGE_CACHE_MAX_ENTRIES=100)
+    def test_data_version(self):
+        self.salary.translate(value=50000, tree=Employee)
+
+        # The labels may change with the data, so the language is rendered
+        # again for a new data version
+        self.salary.data_version += 1
+        self.salary.translate(value=50000, tree=Employee)
+        self.assertEqual(self.calls, 2)
+
+        self.salary.translate(value=50000, tree=Employee)
+        self.assertEqual(self.calls, 2)
+
+    @override_settings(AVOCADO_LANGUAGE_CACHE_MAX_ENTRIES=None)
+    def test_disabled(self):
+        self.salary.translate(value=50000, tree=Employee)
+        self.salary.translate(value=50000, tree=Employee)
+        self.assertEqual(self.calls, 2)
@@ -1,16 +1,19 @@
 import time
-from threading import Thread
+from datetime import date
+from threading import Event, Thread
 
 from django.conf import settings
-from django.core import management
+from django.core import management, signing
+from django.core.cache import cache
 from django.db import connections, DatabaseError
 from django.test import TransactionTestCase
+from django.test.utils import override_settings
 from rq.job import JobStatus
 
 from avocado.async import utils as async_utils
 from avocado.models import DataContext, DataField, DataView
 from avocado.query import utils
-from tests.models import Employee
+from tests.models import Employee, Project
 from tests.processors import ManagerQueryProcessor
 
 
@@ -100,6 +103,111 @@ if 'sqlite' in settings.DATABASES:
 
             self.run_cancel_test(runner, stopper)
 
+        @override_settings(AVOCADO_QUERY_CONNECTION_POOL_SIZE=1,
+                           AVOCADO_QUERY_CONNECTION_POOL_TIMEOUT=0)
+        def test_pool(self):
+            pool = utils.get_connection_pool(self.db)
+
+            conn = self.run_utils_test(self.db, self.name)
+            self.assertEqual(len(pool), 1)
+
+            # The open connection and its process ID are reused
+            reused = utils.named_connection(self.name, db=self.db)
+            self.assertIs(reused.connection, conn.connection)
+            self.assertEqual(utils._conn_info(self.name)[1], conn.backend_pid)
+
+            # The pool is bounded
+            self.assertRaises(utils.ConnectionPoolExhausted,
+                              utils.named_connection, 'other', db=self.db)
+
+            # A canceled connection is discarded
+            utils.cancel_query(self.name)
+            self.assertEqual(len(pool), 0)
+
+            # A connection released by another thread still counts towards
+            # the size of the pool until its owner discards it
+            leased = Event()
+            released = Event()
+
+            def owner():
+                utils.named_connection('other', db=self.db)
+                leased.set()
+                released.wait()
+                utils.close_connection('other')
+
+            t = Thread(target=owner)
+            t.daemon = True
+            t.start()
+            leased.wait(5)
+
+            try:
+                utils.cancel_query('other')
+                self.assertEqual(len(pool), 1)
+                self.assertRaises(utils.ConnectionPoolExhausted,
+                                  utils.named_connection, self.name,
+                                  db=self.db)
+            finally:
+                released.set()
+                t.join(5)
+
+            self.assertEqual(len(pool), 0)
+
+            utils.named_connection('other', db=self.db)
+            utils.close_connection('other')
+
+            pool.close()
+            self.assertEqual(len(pool), 0)
+
+        @override_settings(AVOCADO_QUERY_CONNECTION_POOL_SIZE=2)
+        def test_pool_threads(self):
+            pool = utils.get_connection_pool(self.db)
+            alias = utils.TEMP_DB_ALIAS_PREFIX.format(self.name)
+
+            leased = Event()
+            released = Event()
+
+            def owner():
+                utils.named_connection(self.name, db=self.db)
+                leased.set()
+                released.wait()
+                utils.close_connection(self.name)
+
+            t = Thread(target=owner)
+            t.daemon = True
+            t.start()
+            leased.wait(5)
+
+            try:
+                # The name cannot be reused while leased by another thread
+                conn = pool.leased(alias)
+                self.assertRaises(utils.ConnectionInUse,
+                                  utils.named_connection, self.name,
+                                  db=self.db)
+                self.assertIs(pool.leased(alias), conn)
+                self.assertEqual(len(pool), 1)
+
+                # Once canceled, the name is leased again by this thread
+                utils.cancel_query(self.name)
+                conn = utils.named_connection(self.name, db=self.db)
+                self.assertIs(pool.leased(alias), conn)
+            finally:
+                released.set()
+                t.join(5)
+
+            # The owner only discards its own connection
+            self.assertIs(pool.leased(alias), conn)
+            self.assertEqual(len(pool), 1)
+
+            utils.close_connection(self.name)
+            self.assertEqual(pool._idle, [conn])
+
+            pool.close()
+
+        @override_settings(AVOCADO_QUERY_CONNECTION_POOL_SIZE=None)
+        def test_no_pool(self):
+            self.assertIsNone(utils.get_connection_pool(self.db))
+            self.run_utils_test(self.db, self.name)
+
 
 if 'postgres' in settings.DATABASES:
     class PostgresTempConnTest(TempConnTest):
@@ -328,3 +436,372 @@ class ResultRowTestCase(TransactionTestCase):
         }
         result = utils.get_result_rows(context, view, query_options)
         self.assertEqual(len(list(result['rows'])), Employee.objects.count())
+
+    def test_multivalued_view(self):
+        employee = Employee.objects.get(pk=1)
+
+        # Both projects join to the employee with the same due date
+        for name in ('Project A', 'Project B'):
+            project = Project(name=name, manager=employee,
+                              due_date=date(2014, 1, 1))
+            project.save()
+            project.employees.add(employee)
+
+        field = DataField.objects.get_by_natural_key('tests', 'project',
+                                                     'due_date')
+        concept = field.concepts.all()[0]
+
+        context = DataContext()
+        view = DataView(json=[{'concept': concept.pk}])
+        result = utils.get_result_rows(context, view, {})
+
+        self.assertTrue(result['queryset'].query.distinct)
+
+        rows = [row for row in result['rows'] if row[0] == employee.pk]
+        self.assertEqual(len(rows), 1)
+
+    @override_settings(AVOCADO_QUERY_CONNECTION_POOL_SIZE=2)
+    def test_pooled_connection(self):
+        pool = utils.get_connection_pool()
+
+        context = DataContext()
+        view = DataView()
+        query_options = {
+            'query_name': 'pooled',
+            'page': 1,
+            'limit': 2,
+            'max_rows': 2,
+        }
+
+        utils.get_result_rows(context, view, query_options,
+                              evaluate_rows=True)
+
+        # The connection is returned to the pool once the budgeted rows
+        # are read
+        self.assertIsNone(utils._conn_info('pooled'))
+        self.assertEqual(len(pool), 1)
+        conn = pool._idle[0]
+
+        # and reused for the next page
+        query_options['page'] = 2
+        result = utils.get_result_rows(context, view, query_options,
+                                       evaluate_rows=True)
+
+        self.assertEqual(len(result['rows']), 2)
+        self.assertEqual(pool._idle, [conn])
+
+        pool.close()
+
+    def test_budget(self):
+        context = DataContext()
+        view = DataView()
+
+        query_options = {'query_name': 'budget', 'max_rows': 3}
+
+        with self.assertRaises(utils.QueryBudgetExceeded) as cm:
+            utils.get_result_rows(context, view, query_options,
+                                  evaluate_rows=True)
+
+        self.assertEqual(cm.exception.budget, 'max_rows')
+        self.assertEqual(cm.exception.limit, 3)
+
+        # The connection is discarded
+        self.assertIsNone(utils._conn_info('budget'))
+
+        query_options = {'query_name': 'budget', 'max_bytes': 3}
+        self.assertRaises(utils.QueryBudgetExceeded, utils.get_result_rows,
+                          context, view, query_options, evaluate_rows=True)
+
+        query_options = {
+            'query_name': 'budget',
+            'max_rows': Employee.objects.count(),
+            'timeout': 30,
+        }
+        result = utils.get_result_rows(context, view, query_options,
+                                       evaluate_rows=True)
+        self.assertEqual(len(result['rows']), Employee.objects.count())
+
+        with override_settings(AVOCADO_QUERY_MAX_ROWS=1):
+            self.assertRaises(utils.QueryBudgetExceeded,
+                              utils.get_result_rows, context, view, {},
+                              evaluate_rows=True)
+
+    def test_no_budget(self):
+        context = DataContext()
+        view = DataView()
+
+        result = utils.get_result_rows(context, view, {'query_name': 'open'},
+                                       evaluate_rows=True)
+
+        # The connection of the returned queryset is left open
+        queryset = result['queryset']
+        self.assertEqual(queryset.db, '_db:open')
+        self.assertEqual(queryset.count(), len(result['rows']))
+
+        utils.close_connection('open')
+        self.assertFalse('_db:open' in connections.databases)
+
+    def test_row_size(self):
+        self.assertEqual(utils._row_size([u'\u00e9t\u00e9', 'ab', 10, None]),
+                         9)
+
+    def test_timed_out(self):
+        class Connection(object):
+            settings_dict = {
+                'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            }
+            query_timeout = 1
+
+        conn = Connection()
+        message = 'canceling statement due to statement timeout'
+
+        # Django 1.5 re-raises the arguments of the driver error
+        self.assertTrue(utils._timed_out(conn, DatabaseError(message)))
+        self.assertFalse(utils._timed_out(
+            conn, DatabaseError('canceling statement due to user request')))
+
+        error = DatabaseError(message)
+        error.__cause__ = DatabaseError(message)
+        error.__cause__.pgcode = '57014'
+        self.assertTrue(utils._timed_out(conn, error))
+
+        conn.settings_dict = {'ENGINE': 'django.db.backends.mysql'}
+        error = DatabaseError(3024, 'Query execution was interrupted')
+        self.assertTrue(utils._timed_out(conn, error))
+
+    def test_timeout(self):
+        if connections['default'].vendor != 'sqlite':
+            return
+
+        conn = utils.named_connection('timeout')
+        utils.set_query_timeout(conn, 0.1)
+
+        def rows():
+            c = conn.cursor()
+            c.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                      'SELECT x + 1 FROM c) SELECT count(*) FROM c')
+            yield c.fetchone()
+
+        with self.assertRaises(utils.QueryBudgetExceeded) as cm:
+            list(utils.enforce_budget(rows(), 'timeout'))
+
+        self.assertEqual(cm.exception.budget, 'timeout')
+        self.assertIsNone(utils._conn_info('timeout'))
+
+    def test_keyset(self):
+        field = DataField.objects.get(field_name='salary')
+        concept = field.concepts.all()[0]
+
+        context = DataContext()
+        view = DataView(json=[{
+            'concept': concept.pk,
+            'visible': False,
+            'sort': 'desc',
+        }])
+
+        query_options = {'keyset': True, 'limit': 4}
+        result = utils.get_result_rows(context, view, query_options,
+                                       evaluate_rows=True)
+        rows = result['rows']
+        self.assertEqual(len(rows), 4)
+
+        query_options['cursor'] = result['cursor']
+        result = utils.get_result_rows(context, view, query_options,
+                                       evaluate_rows=True)
+        rows += result['rows']
+
+        self.assertEqual(len(rows), Employee.objects.count())
+        self.assertIsNone(result['cursor'])
+
+        expected = utils.get_result_rows(context, view, {},
+                                         evaluate_rows=True)['rows']
+        self.assertEqual(sorted(rows), sorted(expected))
+
+        # A last page that is exactly full has no next page
+        result = utils.get_result_rows(context, view, {
+            'keyset': True,
+            'limit': len(expected),
+        }, evaluate_rows=True)
+        self.assertEqual(len(result['rows']), len(expected))
+        self.assertIsNone(result['cursor'])
+
+        # The cursor is bound to the ordering of the view
+        view.json[0]['sort'] = 'asc'
+        self.assertRaises(ValueError, utils.get_result_rows, context, view,
+                          query_options)
+
+        query_options['cursor'] = 'invalid'
+        self.assertRaises(ValueError, utils.get_result_rows, context, view,
+                          query_options)
+
+    def test_keyset_condition(self):
+        condition = utils.keyset_condition(['-salary', 'id'], [None, 3])
+        self.assertEqual(unicode(condition),
+                         "(AND: ('salary__isnull', True), ('id__gt', 3))")
+
+        condition = utils.keyset_condition(['salary', 'id'], [1000, 3],
+                                           nulls_largest=True)
+        self.assertEqual(unicode(condition),
+                         "(OR: (OR: ('salary__gt', 1000), "
+                         "('salary__isnull', True)), "
+                         "(AND: ('salary', 1000), "
+                         "(OR: ('id__gt', 3), ('id__isnull', True))))")
+
+
+class ResultCacheTestCase(TransactionTestCase):
+    fixtures = ['tests/fixtures/employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+        cache.clear()
+
+        self.field = DataField.objects.get_by_natural_key('tests', 'title',
+                                                          'salary')
+        concept = self.field.concepts.all()[0]
+
+        self.context = DataContext(json={
+            'field': 'tests.title.salary',
+            'operator': 'gt',
+            'value': 10000,
+        })
+        self.view = DataView(json=[{'concept': concept.pk}])
+        self.options = {'page': 1, 'limit': 3}
+
+    def get_rows(self, **options):
+        query_options = dict(self.options, **options)
+        return utils.get_result_rows(self.context, self.view, query_options,
+                                     evaluate_rows=True)['rows']
+
+    @override_settings(AVOCADO_QUERY_RESULT_CACHE_ENABLED=True)
+    def test(self):
+        rows = self.get_rows()
+        self.assertEqual(len(rows), 3)
+
+        # Removing the data does not affect the cached page
+        Employee.objects.all().delete()
+        self.assertEqual(self.get_rows(), rows)
+
+        # Other pages and uncached requests are not affected
+        self.assertEqual(self.get_rows(page=2), [])
+        self.assertEqual(self.get_rows(cache=False), [])
+
+        # A new data version for a referenced field results in a new key
+        self.field.data_version += 1
+        self.field.save()
+        self.assertEqual(self.get_rows(), [])
+
+    @override_settings(AVOCADO_QUERY_RESULT_CACHE_ENABLED=True)
+    def test_keyset(self):
+        options = {'keyset': True, 'limit': 2, 'query_name': 'keyset'}
+        result = utils.get_result_rows(self.context, self.view, options,
+                                       evaluate_rows=True)
+        self.assertIsNotNone(result['cursor'])
+
+        # The cursor of a cached page is still returned
+        cached = utils.get_result_rows(self.context, self.view, options,
+                                       evaluate_rows=True)
+        self.assertEqual(cached['rows'], result['rows'])
+
+        # The tokens are signed with a timestamp, so their values are
+        # compared
+        self.assertEqual(signing.loads(cached['cursor'],
+                                       salt=utils.KEYSET_CURSOR_SALT),
+                         signing.loads(result['cursor'],
+                                       salt=utils.KEYSET_CURSOR_SALT))
+        self.assertIsNone(utils._conn_info('keyset'))
+
+    @override_settings(AVOCADO_QUERY_RESULT_CACHE_ENABLED=True)
+    def test_query_change(self):
+        rows = self.get_rows()
+
+        self.context.json['value'] = 100000
+        Employee.objects.all().delete()
+
+        self.assertNotEqual(self.get_rows(), rows)
+
+    @override_settings(AVOCADO_QUERY_RESULT_CACHE_ENABLED=True,
+                       AVOCADO_QUERY_RESULT_CACHE_MAX_ROWS=2)
+    def test_max_rows(self):
+        self.assertEqual(len(self.get_rows()), 3)
+
+        Employee.objects.all().delete()
+        self.assertEqual(self.get_rows(), [])
+
+    @override_settings(AVOCADO_QUERY_RESULT_CACHE_ENABLED=True)
+    def test_partial_read(self):
+        result = utils.get_result_rows(self.context, self.view,
+                                       dict(self.options))
+        next(result['rows'])
+
+        # Rows are only cached once fully read
+        Employee.objects.all().delete()
+        self.assertEqual(self.get_rows(), [])
+
+
+class ExplainTestCase(TransactionTestCase):
+    fixtures = ['tests/fixtures/employee_data.json']
+
+    def setUp(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+    def test_many_to_one(self):
+        context = DataContext(json={
+            'field': 'tests.title.boss',
+            'operator': 'exact',
+            'value': True,
+        })
+
+        output = utils.explain(context.apply(tree=Employee))
+
+        self.assertFalse(output['distinct'])
+        self.assertEqual(output['multivalued_joins'], [])
+        self.assertTrue('tests_title' in output['sql'])
+        self.assertTrue(output['plan'])
+
+    @override_settings(AVOCADO_QUERY_SEMIJOIN_ENABLED=False)
+    def test_multivalued(self):
+        context = DataContext(json={
+            'field': 'tests.project.name',
+            'operator': 'exact',
+            'value': 'Project A',
+        })
+
+        output = utils.explain(context.apply(tree=Employee))
+
+        self.assertTrue(output['distinct'])
+        self.assertEqual(output['multivalued_joins'],
+                         ['tests_project_employees'])
+
+    @override_settings(AVOCADO_QUERY_SEMIJOIN_ENABLED=True)
+    def test_semijoin(self):
+        context = DataContext(json={
+            'type': 'and',
+            'children': [{
+                'field': 'tests.project.name',
+                'operator': 'exact',
+                'value': 'Project A',
+            }, {
+                'field': 'tests.project.due_date',
+                'operator': 'isnull',
+                'value': False,
+            }],
+        })
+
+        # The conditions are compiled into a subquery
+        output = utils.explain(context.apply(tree=Employee))
+
+        self.assertFalse(output['distinct'])
+        self.assertEqual(output['multivalued_joins'], [])
+
+    def test_values(self):
+        context = DataContext(json={
+            'field': 'tests.title.boss',
+            'operator': 'exact',
+            'value': True,
+        })
+
+        # Rows with equal values are removed
+        queryset = Employee.objects.values('first_name')
+        output = utils.explain(context.apply(queryset=queryset))
+
+        self.assertTrue(output['distinct'])
@@ -1,13 +1,14 @@
 import os
 import sys
 import django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core import management
 from django.core.management.base import CommandError
 from django.test.utils import override_settings
 from avocado.models import DataField, DataConcept, DataCategory
+from avocado.core.cache import get_stats
 
-__all__ = ('CommandsTestCase',)
+__all__ = ('CommandsTestCase', 'CacheWorkersTestCase')
 
 
 class CommandsTestCase(TestCase):
@@ -59,6 +60,89 @@ class CommandsTestCase(TestCase):
             self.assertRaises(CommandError, management.call_command, 'avocado',
                               'cache', 'tests', methods=['invalid_function'])
 
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_cache_resume(self):
+        from avocado.management.subcommands.cache import warm_field, \
+            warm_run_key, completed_fields
+
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        title = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+        pks = list(DataField.objects.values_list('pk', flat=True))
+        methods = ('values', 'labels')
+        run_key = warm_run_key(pks, methods, True)
+
+        # Simulate an interrupted run that completed a single field
+        counts = warm_field(title.pk, methods, True, run_key)
+        self.assertEqual(counts, {'cached': 2, 'skipped': 0, 'errors': 0})
+        self.assertEqual(completed_fields(run_key, pks), set([title.pk]))
+
+        title.values.flush(title)
+
+        management.call_command('avocado', 'cache', flush=True,
+                                methods=methods, resume=True)
+
+        # The completed field was not pre-cached again
+        self.assertFalse(title.values.cached(title))
+
+        # Progress is reset once the run completes
+        self.assertEqual(completed_fields(run_key, pks), set())
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True,
+                       AVOCADO_DATA_CACHE_STATS_ENABLED=True)
+    def test_cache_stats(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+        management.call_command('avocado', 'cache', reset_stats=True)
+
+        title = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+        title.values.flush(title)
+        title.values()
+        title.values()
+
+        stats = get_stats()
+        self.assertEqual(stats['datafield.values']['hits'], 1)
+        self.assertEqual(stats['datafield.values']['misses'], 1)
+
+        management.call_command('avocado', 'cache', stats=True)
+        management.call_command('avocado', 'cache', reset_stats=True)
+        self.assertEqual(get_stats(), {})
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_cache_invalidate(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+
+        title = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+        salary = DataField.objects.get_by_natural_key('tests', 'title',
+                                                      'salary')
+        office = DataField.objects.get_by_natural_key('tests', 'office',
+                                                      'location')
+
+        for f in (title, salary, office):
+            f.values()
+
+        management.call_command('avocado', 'cache', 'tests.title',
+                                invalidate=True)
+
+        self.assertFalse(title.values.cached(title))
+        self.assertFalse(salary.values.cached(salary))
+        self.assertTrue(office.values.cached(office))
+
+        # Single field
+        title.values()
+        management.call_command('avocado', 'cache', 'tests.office.location',
+                                invalidate=True)
+
+        self.assertTrue(title.values.cached(title))
+        self.assertFalse(office.values.cached(office))
+
+        # Concept and its fields
+        concept = DataConcept.objects.filter(fields=title)[0]
+        management.call_command('avocado', 'cache', concepts=[concept.pk])
+        self.assertFalse(title.values.cached(title))
+
+        self.assertRaises(CommandError, management.call_command, 'avocado',
+                          'cache', invalidate=True)
+
     def test_init(self):
         management.call_command('avocado', 'init', 'tests', quiet=True)
 
@@ -82,3 +166,24 @@ class CommandsTestCase(TestCase):
         fields = DataField.objects.filter(published=False)
         self.assertEqual(fields.count(), 12)
         self.assertEqual(DataConcept.objects.count(), 0)
+
+
+class CacheWorkersTestCase(TransactionTestCase):
+    # Worker processes require committed data
+    fixtures = ['tests/fixtures/employee_data.json']
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test(self):
+        management.call_command('avocado', 'init', 'tests', quiet=True)
+        management.call_command('avocado', 'cache', 'tests',
+                                methods=['size'], workers=2)
+
+        for f in DataField.objects.all():
+            self.assertTrue(f.size.cached(f))
@@ -2,6 +2,7 @@ from django.test import TestCase
 from django.core import management
 from avocado.models import DataField, DataConcept, DataConceptField
 from avocado.query.validators import Validator, FieldValidator
+from avocado.query.parsers import TreeParser, apply_patch
 
 
 class ValidatorTestCase(TestCase):
@@ -149,3 +150,87 @@ class FieldValidatorTestCase(ValidatorTestCase):
         self.assertTrue('errors' in v.data)
         self.assertEqual(v.errors[0], 'ambiguous_field')
         self.assertFalse(v.data['enabled'])
+
+
+class TreeParserTestCase(ValidatorTestCase):
+    def setUp(self):
+        super(TreeParserTestCase, self).setUp()
+        self.data = {
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'gt',
+                'value': 50000,
+            }, {
+                'field': 'tests.employee.first_name',
+                'operator': 'exact',
+                'value': 'Robert',
+            }]
+        }
+
+    def test_valid(self):
+        p = TreeParser(self.data)
+
+        self.assertTrue(p.is_valid())
+        tree = p.cleaned_data['tree']
+        self.assertEqual(len(tree.cleaned_data['children']), 2)
+        self.assertEqual(tree.child_parsers[0].cleaned_data['value'], 50000)
+        self.assertFalse(tree.child_parsers[0].errors)
+
+    def test_patch(self):
+        p = TreeParser(self.data)
+        p.is_valid()
+        children = p.cleaned_data['tree'].child_parsers
+
+        patched = p.patch([
+            {'op': 'replace', 'path': '/children/1/value', 'value': 'Bob'},
+            {'op': 'add', 'path': '/children/0', 'value': {
+                'field': 'tests.title.name',
+                'operator': 'exact',
+                'value': 'CEO',
+            }},
+        ])
+
+        # The original data is unchanged
+        self.assertEqual(self.data['children'][1]['value'], 'Robert')
+        self.assertEqual(len(self.data['children']), 2)
+
+        self.assertTrue(patched.is_valid())
+        patched_children = patched.cleaned_data['tree'].child_parsers
+        self.assertEqual(len(patched_children), 3)
+
+        # Untouched nodes are not validated again
+        self.assertTrue(patched_children[1] is children[0])
+        self.assertFalse(patched_children[2] is children[1])
+        self.assertEqual(patched_children[2].cleaned_data['value'], 'Bob')
+        self.assertEqual(patched_children[0].cleaned_data['value'], 'CEO')
+
+    def test_patch_invalid(self):
+        p = TreeParser(self.data)
+        p.is_valid()
+
+        self.assertRaises(ValueError, p.patch, [
+            {'op': 'remove', 'path': '/children/5'}])
+        self.assertRaises(ValueError, p.patch, [
+            {'op': 'replace', 'path': '/children/0/foo', 'value': 1}])
+        self.assertRaises(ValueError, p.patch, [
+            {'op': 'test', 'path': '/type', 'value': 'or'}])
+
+
+class ApplyPatchTestCase(TestCase):
+    def test_operations(self):
+        data = {'a': {'b': [1, 2]}, 'c': {'d': 1}}
+
+        patched = apply_patch(data, [
+            {'op': 'add', 'path': '/a/b/-', 'value': 3},
+            {'op': 'move', 'from': '/a/b/0', 'path': '/e'},
+            {'op': 'copy', 'from': '/e', 'path': '/f~1g'},
+            {'op': 'test', 'path': '/a/b', 'value': [2, 3]},
+        ])
+
+        self.assertEqual(patched, {'a': {'b': [2, 3]}, 'c': {'d': 1},
+                                   'e': 1, 'f/g': 1})
+        self.assertEqual(data, {'a': {'b': [1, 2]}, 'c': {'d': 1}})
+
+        # Untouched values are shared
+        self.assertTrue(patched['c'] is data['c'])